@@ -0,0 +1,87 @@
+# coding: utf-8
+import heapq
+import itertools
+import time
+
+
+def queue_order(entry):
+    """Порядок запуска задач из очереди: сначала больший приоритет, при равенстве -- раньше поставленные"""
+    return -entry['priority'], entry['id']
+
+
+class RunQueue(object):
+    """Очередь задач, для которых не хватило места (см. ProcessManager.spawn_processes)
+
+    Задачи каждой команды хранятся в своей куче, упорядоченной по queue_order. pop выбирает
+    лучшую задачу среди голов куч тех команд, которые сейчас можно запускать, поэтому задачи
+    команды, упершейся в свой лимит, не задерживают остальные.
+
+    Entry example:
+        {
+            "id": 17,
+            "cmd": "worker",
+            "args": [],
+            "kwargs": {"name": "abc"},
+            "resources": null,
+            "priority": 0,
+            "registration_timeout": null,
+            "queued_at": 1498761885.682778
+        }
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._heaps = {}
+        self._size = 0
+        self._ids = itertools.count(1)
+
+    def __len__(self):
+        return self._size
+
+    def push(self, task):
+        """Постановка задачи в очередь
+
+        :param task: dict вида {"cmd": ..., "args": [...], "kwargs": {...}, "resources": {...}, "priority": 0}
+        :return: запись очереди или None, если очередь заполнена
+        """
+        if self._size >= self.max_size:
+            return None
+
+        entry = {
+            'id': next(self._ids),
+            'cmd': task['cmd'],
+            'args': task.get('args', []),
+            'kwargs': task.get('kwargs', {}),
+            'resources': task.get('resources'),
+            'priority': task.get('priority', 0),
+            'registration_timeout': task.get('registration_timeout'),
+            'queued_at': time.time(),
+        }
+        self.restore(entry)
+        return entry
+
+    def restore(self, entry):
+        """Возврат в очередь записи, которую не удалось запустить"""
+        heapq.heappush(self._heaps.setdefault(entry['cmd'], []), (queue_order(entry), entry))
+        self._size += 1
+
+    def pop(self, can_start):
+        """Извлечение следующей задачи для запуска
+
+        :param can_start: callable, принимает cmd и возвращает, можно ли сейчас запустить такую задачу
+        :return: запись очереди или None, если запускать нечего
+        """
+        heads = [heap[0] for cmd, heap in self._heaps.items() if can_start(cmd)]
+        if not heads:
+            return None
+
+        order, entry = min(heads)
+        heap = self._heaps[entry['cmd']]
+        heapq.heappop(heap)
+        if not heap:
+            del self._heaps[entry['cmd']]
+        self._size -= 1
+        return entry
+
+    def entries(self):
+        """Все записи в порядке запуска (без учета лимитов)"""
+        return sorted((entry for heap in self._heaps.values() for order, entry in heap), key=queue_order)
@@ -2,21 +2,39 @@
 import multiprocessing
 import os
 import signal
+from operator import attrgetter
 from urlparse import urlparse
 
 import tornado.ioloop
 import tornado.web
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.escape import json_decode
 from tornado.httpserver import HTTPServer
-from tornado.netutil import bind_unix_socket
+from tornado.netutil import bind_unix_socket, bind_sockets
 from tornado.web import HTTPError
 
-import tasks
 from daemonize import daemonize
-from logger import create_logger, setup_tornado_loggers
+from events import format_sse
+from executor import BoundedExecutor, ExecutorBusy
+from logger import create_logger, setup_tornado_loggers, start_log_writer, flush_logs
 from manager import ProcessManager
-from settings import unix_socket_path, db_path, port
-from utils import json_content, wrap_with_success_value, get_handler, post_handler
+from metrics import metrics_registry, ioloop_lag_seconds, IOLoopLagMonitor, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from output import TaskOutput
+from placement import validate_resources
+from reaper import Reaper
+from registry import ProcessRegistry
+from replica import ProcessReplica
+from settings import unix_socket_path, db_path, journal_path, journal_compact_threshold, journal_fsync, port, \
+    zygote_enabled, exited_history_size, handler_executor_max_workers, events_history_size, events_keepalive_sec, \
+    web_processes, unix_socket_url_prefix, replica_retry_sec, replica_sync_timeout, handler_executor_max_pending, \
+    spawn_executor_max_pending, journal_background, metrics_lag_interval_sec, resources_sample_interval_sec, \
+    max_processes, max_processes_per_cmd, run_queue_size, registration_timeout_sec, task_output_folder, \
+    task_output_buffer_lines, task_output_max_file_bytes, task_catalog_module, task_reload_interval_sec, \
+    run_queue_retry_sec
+from task_catalog import TaskCatalog, TaskCatalogError, TaskLoader
+from utils import encoded_content, wrap_with_success_value, get_handler, post_handler, etag_from, handler_names
+from zygote import Zygote
 
 
 # noinspection PyAbstractClass
@@ -29,7 +47,11 @@ class AgentdBaseHandler(tornado.web.RequestHandler):
     Идея и часть кода для диспатчинга post/get методов:
         http://code.activestate.com/recipes/576958-method-based-url-dispatcher-for-the-tornado-web-se/
 
+    Количество и длительность запросов по методам записываются в метрики (см. /metrics).
     """
+    # метка server в метриках запросов, задается в наследниках
+    server = None
+
     def post(self):
         body = json_decode(self.request.body)
         return self._dispatch(body=body)
@@ -52,6 +74,118 @@ class AgentdBaseHandler(tornado.web.RequestHandler):
 
         return callable_(**body)
 
+    def _get_list_argument(self, name):
+        """Значение query параметра вида a,b,c списком или None, если параметр не передан"""
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+
+        return [item for item in value.split(',') if item]
+
+    @gen.coroutine
+    def _stream_events(self):
+        """Отдача потока событий менеджера процессов в формате server-sent events, см. events"""
+        bus = self.process_manager.events
+        last_event_id = self.request.headers.get('Last-Event-ID') or self.get_argument('since', None)
+        try:
+            since = None if last_event_id is None else bus.parse_id(last_event_id)
+        except ValueError:
+            raise HTTPError(400)
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+
+        if last_event_id is None:
+            backlog = []
+        else:
+            backlog = None if since is None else bus.since(since)
+            if backlog is None:
+                backlog = [bus.reset_event()]
+
+        self._stream_closed = Future()
+        for event in backlog:
+            self.write(format_sse(event))
+        self.flush()
+
+        bus.subscribe(self._send_event)
+        keepalive = tornado.ioloop.PeriodicCallback(self._send_keepalive, events_keepalive_sec * 1000)
+        keepalive.start()
+        try:
+            yield self._stream_closed
+        finally:
+            keepalive.stop()
+            bus.unsubscribe(self._send_event)
+
+    def _send_event(self, event):
+        if not self.request.connection.stream.closed():
+            self.write(format_sse(event))
+            self.flush()
+
+    @gen.coroutine
+    def _stream_output(self, pid, num):
+        """Отдача последних строк вывода задачи и затем новых по мере появления, см. logs"""
+        self.set_header('Cache-Control', 'no-cache')
+        self._stream_closed = Future()
+        output = self.process_manager.output
+        followed = yield gen.maybe_future(output.follow(pid, num, self._send_output))
+        if not followed:
+            self._stream_closed = None
+            raise HTTPError(404)
+
+        try:
+            yield self._stream_closed
+        finally:
+            output.unfollow(pid, self._send_output)
+
+    def _send_output(self, lines):
+        if lines is None:
+            if not self._stream_closed.done():
+                self._stream_closed.set_result(None)
+            return
+
+        if not self.request.connection.stream.closed():
+            self.write(''.join(line + '\n' for line in lines))
+            self.flush()
+
+    def _send_keepalive(self):
+        if not self.request.connection.stream.closed():
+            self.write(': keepalive\n\n')
+            self.flush()
+
+    def send_error(self, status_code=500, **kwargs):
+        """Переполнение очереди пула (executor.ExecutorBusy) превращается в 503 вместо 500"""
+        exc_info = kwargs.get('exc_info')
+        if exc_info is not None and isinstance(exc_info[1], ExecutorBusy):
+            status_code = 503
+        super(AgentdBaseHandler, self).send_error(status_code, **kwargs)
+
+    def write_error(self, status_code, **kwargs):
+        if status_code == 503:
+            self.set_header('Retry-After', '1')
+        super(AgentdBaseHandler, self).write_error(status_code, **kwargs)
+
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, ExecutorBusy):
+            self._create_logger().warning('%s %s: executor is busy (%s)' % (self.request.method, self.request.uri, value))
+            return
+        super(AgentdBaseHandler, self).log_exception(typ, value, tb)
+
+    def on_finish(self):
+        handler = self.request.path.lstrip('/')
+        if handler not in _metric_handlers[self.server]:
+            handler = 'other'
+
+        http_requests_total.inc((self.server, handler, '%dxx' % (self.get_status() // 100)))
+        # у потоков (/events, /logs?follow=1) длительность запроса -- это время жизни подписки,
+        # в гистограмму ее не пишем
+        if getattr(self, '_stream_closed', None) is None:
+            http_request_seconds.observe(self.request.request_time(), (self.server, handler))
+
+    def on_connection_close(self):
+        closed = getattr(self, '_stream_closed', None)
+        if closed is not None and not closed.done():
+            closed.set_result(None)
+
     @staticmethod
     def _create_logger():
         raise NotImplementedError
@@ -62,7 +196,9 @@ class AgentdBaseHandler(tornado.web.RequestHandler):
         Потокобезопасно добавляем в следующую итерацию ioloop вызов функции spawn_killer
         (в свою очередь, spawn-killer отправляет SIGTERM в вызвавший его процесс).
 
-        todo: если сервер запущен в несколько потоков, то убит будет только один
+        Запрос приходит на unix сокет, который обслуживает процесс-супервизор, поэтому при
+        нескольких web процессах (--web_processes) сигнал получает супервизор, а он уже
+        останавливает web процессы (см. shutdown).
 
         :return:
         """
@@ -73,8 +209,13 @@ class AgentdBaseHandler(tornado.web.RequestHandler):
 # noinspection PyAbstractClass
 class AgentdWebSocket(AgentdBaseHandler):
     """Обработка публичных методов API"""
+    server = 'web'
+
+    # пул для блокирующих обработчиков, которые нельзя выполнять в ioloop; при переполнении отвечаем 503
+    executor = BoundedExecutor(max_workers=handler_executor_max_workers, max_pending=handler_executor_max_pending)
+
     @get_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def health(self):
         """
@@ -91,12 +232,19 @@ class AgentdWebSocket(AgentdBaseHandler):
 
     # noinspection PyUnresolvedReferences
     @get_handler
-    @json_content
+    @etag_from(attrgetter('process_manager.etag'))
+    @encoded_content
     @wrap_with_success_value
     def info(self):
         """
         GET
 
+        Query parameters:
+            cmd -- вернуть только процессы с этой командой (например, /info?cmd=worker)
+            state -- состояния через запятую: running, waiting, queued, exited (например, /info?state=running)
+            fields -- поля записей через запятую (например, /info?fields=pid,kwargs)
+            offset, limit -- пагинация, применяется к каждому состоянию отдельно
+
         Response example:
             {
                 "success": 1,
@@ -111,92 +259,490 @@ class AgentdWebSocket(AgentdBaseHandler):
                             }
                             "spawned_at": 1498761885.682778,
                             "host": "123.domain.server.com",
+                            "heartbeat_at": 1498761990.000001,
+                            "cpu_percent": 12.5,
+                            "rss_bytes": 52441088
                         },
                         ...
                     ],
                     "waiting": [
                         ...
+                    ],
+                    "queued": [
+                        {
+                            "id": 17,
+                            "cmd": "worker",
+                            "args": [],
+                            "kwargs": {"name": "abc"},
+                            "resources": null,
+                            "priority": 0,
+                            "queued_at": 1498761885.682778
+                        },
+                        ...
+                    ],
+                    "exited": [
+                        {
+                            "pid": 122,
+                            "cmd": "worker",
+                            ...
+                            "returncode": -15,
+                            "signal": 15,
+                            "exited_at": 1498761999.123456,
+                            "reason": null
+                        },
+                        ...
                     ]
                 }
             }
 
+        В exited хранится ограниченная история (settings.exited_history_size) последних
+        завершившихся процессов с кодом возврата и сигналом. reason -- почему процесс завершил демон
+        ("registration_timeout" или null). В queued -- задачи, ожидающие
+        запуска из-за settings.max_processes или settings.max_processes_per_cmd, в порядке запуска.
+
+        cpu_percent (средняя загрузка CPU за последний интервал замера) и rss_bytes обновляются
+        раз в settings.resources_sample_interval_sec, до первого замера процесса они null.
+
+        В заголовке Etag отдается версия реестра процессов. Если она не изменилась с прошлого
+        запроса, то на запрос с заголовком If-None-Match отдается пустой ответ 304.
+
         """
-        return self.process_manager.info()
+        states = self._get_list_argument('state')
+        if states is not None and not set(states) <= set(self.process_manager.states):
+            raise HTTPError(400)
+
+        try:
+            offset = int(self.get_argument('offset', 0))
+            limit = self.get_argument('limit', None)
+            limit = None if limit is None else int(limit)
+        except ValueError:
+            raise HTTPError(400)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise HTTPError(400)
+
+        return self.process_manager.info(
+            cmd=self.get_argument('cmd', None),
+            states=states,
+            fields=self._get_list_argument('fields'),
+            offset=offset,
+            limit=limit,
+        )
 
     # noinspection PyDefaultArgument, PyUnresolvedReferences
     @post_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
-    def run_task(self, cmd, args=tuple(), kwargs={}):
-        """Запуск отдельного процесса с командой cmd, которая будет искаться в модуле tasks
+    def run_task(self, cmd, args=tuple(), kwargs={}, resources=None, priority=0, registration_timeout=None):
+        """Запуск отдельного процесса с командой cmd, которая будет искаться в каталоге задач (см. /tasks)
 
         Поля args и kwargs будут использованы как аргументы при вызове команды: task(*args, **kwargs)
 
+        Необязательное поле resources задает привязку к процессорам, nice и лимиты задачи,
+        они применяются в ее процессе до запуска (см. placement.validate_resources). С "cpus": "auto"
+        демон привязывает задачу к одному ядру, равномерно распределяя такие задачи по ядрам
+        и перераспределяя их при завершении задач.
+
+        Если процессов уже столько, сколько разрешают settings.max_processes или
+        settings.max_processes_per_cmd, задача ставится в очередь и запускается, когда освободится
+        место. Из очереди задачи берутся по убыванию priority (по умолчанию 0), при равенстве --
+        в порядке постановки. Очередь видна в /info (state=queued).
+
+        Процесс, который не вызвал register_as_successfully_started за registration_timeout секунд
+        (по умолчанию -- registration_timeout задачи из каталога или settings.registration_timeout_sec),
+        завершается и убирается из waiting, в истории exited у него будет "reason": "registration_timeout".
+
         POST
 
+        Request example:
+            {
+                "cmd": "worker",
+                "kwargs": {"name": "abc"},
+                "resources": {"cpus": "auto", "nice": 10, "rlimit_as": 2147483648, "rlimit_nofile": 4096},
+                "priority": 5,
+                "registration_timeout": 30
+            }
+
         Response example:
             {
                 "success": 1,
+                "response": 123
             }
 
+        В ответе pid запущенного процесса, {"queued": id} -- задача поставлена в очередь запуска,
+        null -- задачу запустить не удалось (в том числе если задачи нет в каталоге или очередь заполнена).
+
         :param cmd: str
         :param args: list
         :param kwargs: dict
+        :param resources: dict
+        :param priority: int
+        :param registration_timeout: float
+        :return:
+        """
+        self._validate_task(
+            {'resources': resources, 'priority': priority, 'registration_timeout': registration_timeout}
+        )
+        return self.process_manager.spawn_process(
+            cmd=cmd,
+            args=args,
+            kwargs=kwargs,
+            resources=resources,
+            priority=priority,
+            registration_timeout=registration_timeout,
+        )
+
+    # noinspection PyUnresolvedReferences
+    @post_handler
+    @encoded_content
+    @wrap_with_success_value
+    def run_tasks(self, tasks):
+        """Запуск пачки процессов, аналогично run_task для каждого элемента tasks
+
+        Записи о всех запущенных процессах сохраняются в реестр одним коммитом.
+
+        POST
+
+        Request example:
+            {
+                "tasks": [
+                    {"cmd": "worker", "kwargs": {"name": "abc"}, "resources": {"cpus": "auto"}, "priority": 5},
+                    {"cmd": "sleep", "args": [10]},
+                    ...
+                ]
+            }
+
+        Response example:
+            {
+                "success": 1,
+                "response": [123, 124, null]
+            }
+
+        В ответе pid запущенных процессов в порядке tasks, null -- задачу запустить не удалось.
+
+        :param tasks: list of dict
         :return:
         """
-        self.process_manager.spawn_process(cmd=cmd, args=args, kwargs=kwargs)
+        if not isinstance(tasks, list) or not all(isinstance(task, dict) and 'cmd' in task for task in tasks):
+            raise HTTPError(400)
+        for task in tasks:
+            self._validate_task(task)
+
+        return self.process_manager.spawn_processes(tasks)
+
+    @staticmethod
+    def _validate_task(task):
+        priority = task.get('priority', 0)
+        if not isinstance(priority, (int, long)) or isinstance(priority, bool):
+            raise HTTPError(400, 'priority must be an integer')
+
+        timeout = task.get('registration_timeout')
+        if timeout is not None:
+            if not isinstance(timeout, (int, long, float)) or isinstance(timeout, bool) or timeout <= 0:
+                raise HTTPError(400, 'registration_timeout must be a positive number')
+
+        if task.get('resources') is None:
+            return
+
+        try:
+            validate_resources(task['resources'])
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+    # noinspection PyUnresolvedReferences
+    @get_handler
+    @encoded_content
+    @wrap_with_success_value
+    def tasks(self):
+        """Задачи, доступные для запуска, с параметрами из каталога задач (см. task_catalog.TaskCatalog)
+
+        Каталог и модули задач перечитываются без перезапуска демона, если они изменились
+        (проверка не чаще раза в settings.task_reload_interval_sec).
+
+        GET
+
+        Response example:
+            {
+                "success": 1,
+                "response": [
+                    {
+                        "name": "worker",
+                        "path": "tasks.tasks_workers:worker",
+                        "description": "Пример воркера: дописывает случайный текст в файл name до получения SIGTERM",
+                        "registration_timeout": null,
+                        "max_processes": null,
+                        "preload": true
+                    },
+                    ...
+                ]
+            }
+
+        """
+        catalog = self.process_manager.catalog
+        try:
+            catalog.refresh()
+        except TaskCatalogError as e:
+            self.logger.error(str(e))
+        return catalog.describe()
+
+    @get_handler
+    def events(self):
+        """Поток событий жизненного цикла процессов (server-sent events)
+
+        Соединение не закрывается, события spawn, register, unlink, kill, exit и heartbeat
+        (см. events.EventBus) отправляются по мере появления. Чтобы не пропустить события
+        при переподключении, нужно передать идентификатор последнего полученного события
+        в заголовке Last-Event-ID (браузеры делают это сами) или параметром since. Без них
+        отправляются только новые события. Если запрошенных событий уже нет в истории,
+        первым приходит событие reset: состояние нужно перечитать через /info.
+
+        Раз в settings.events_keepalive_sec секунд отправляется комментарий-keepalive.
+
+        GET
+
+        Query parameters:
+            since -- идентификатор или номер последнего полученного события
+
+        Response example:
+            id: kqzjcmax-42
+            event: exit
+            data: {"id":"kqzjcmax-42","seq":42,"type":"exit","pid":123,"data":{...},...}
+
+        """
+        return self._stream_events()
+
+    @get_handler
+    @gen.coroutine
+    def logs(self):
+        """Вывод задачи (stdout и stderr вместе) в виде текста
+
+        Отдаются последние строки из буфера в памяти (не больше settings.task_output_buffer_lines),
+        полный вывод задачи лежит в settings.task_output_folder/<pid>.log. С follow=1 соединение
+        не закрывается: новые строки отправляются по мере появления, пока задача не завершится.
+        Вывод хранится и для settings.exited_history_size последних завершившихся задач.
+
+        GET
+
+        Query parameters:
+            pid -- pid задачи
+            tail -- сколько последних строк отдать (по умолчанию 100)
+            follow -- 1, чтобы продолжать отдавать вывод (например, /logs?pid=123&tail=10&follow=1)
+
+        Response example:
+            processing file 1
+            processing file 2
+
+        """
+        try:
+            pid = int(self.get_argument('pid'))
+            num = int(self.get_argument('tail', 100))
+        except ValueError:
+            raise HTTPError(400)
+        if num < 0:
+            raise HTTPError(400)
+        num = min(num, task_output_buffer_lines)
+
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        if self.get_argument('follow', '0') == '1':
+            yield self._stream_output(pid, num)
+            return
+
+        lines = yield gen.maybe_future(self.process_manager.output.tail(pid, num))
+        if lines is None:
+            raise HTTPError(404)
+        self.write(''.join(line + '\n' for line in lines))
+
+    @get_handler
+    @encoded_content
+    @wrap_with_success_value
+    def plan_workers_globally(self):
+        """План глобальной оркестрации воркеров (задача set_workers_globally) без его выполнения
+
+        Опрос хостов выполняется в пуле потоков и не блокирует ioloop.
+
+        GET
+
+        Query parameters:
+            num -- требуемое суммарное число воркеров (например, /plan_workers_globally?num=10)
+
+        Response example:
+            {
+                "success": 1,
+                "response": {
+                    "num": 10,
+                    "plan": {
+                        "http://localhost:8001": {"current": 2, "target": 5},
+                        "http://localhost:8002": {"current": 7, "target": 5}
+                    },
+                    "hosts": {
+                        "http://localhost:8001": {"ok": true, "latency_sec": 0.012, "error": null},
+                        "http://localhost:8002": {"ok": true, "latency_sec": 0.015, "error": null}
+                    }
+                }
+            }
+
+        """
+        try:
+            num = int(self.get_argument('num'))
+        except ValueError:
+            raise HTTPError(400)
+
+        # модуль задач воркеров импортируется при первом запросе, а не при старте демона
+        from tasks.tasks_workers import plan_workers_globally
+        return self.executor.submit(plan_workers_globally, num)
+
+    @get_handler
+    def metrics(self):
+        """
+        GET
+
+        Метрики демона в текстовом формате Prometheus: количество и длительность запросов
+        по методам API, время запуска задач, время от запуска до регистрации, количество
+        собранных процессов по исходу, задержка ioloop, размер реестра, загрузка CPU
+        и память каждого процесса задачи. При нескольких
+        web процессах счетчики суммируются по всем процессам демона.
+
+        Response example:
+            # HELP agentd_http_requests_total HTTP requests by handler and status class
+            # TYPE agentd_http_requests_total counter
+            agentd_http_requests_total{server="web",handler="health",code="2xx"} 42
+            ...
+        """
+        manager = self.process_manager
+        usage = manager.resource_usage()
+        gauges = [
+            (
+                'agentd_processes',
+                'Task processes known to the daemon by state',
+                [({'state': state}, len(getattr(manager, state))) for state in manager.states],
+            ),
+            (
+                'agentd_process_cpu_percent',
+                'CPU usage of a task process over the last sampling interval',
+                [
+                    ({'pid': record['pid'], 'cmd': record['cmd']}, cpu)
+                    for record, cpu, rss in usage if cpu is not None
+                ],
+            ),
+            (
+                'agentd_process_rss_bytes',
+                'Resident memory of a task process',
+                [({'pid': record['pid'], 'cmd': record['cmd']}, rss) for record, cpu, rss in usage],
+            ),
+            (
+                'agentd_handler_executor_pending',
+                'Tasks queued or running in the handler executor of this process',
+                [({}, self.executor.pending)],
+            ),
+        ]
+        self.set_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.write(metrics_registry.render(gauges=gauges))
 
     @staticmethod
     def _create_logger():
         return create_logger('agentd_web_socket')
 
     # noinspection PyAttributeOutsideInit
-    def initialize(self):
+    def initialize(self, process_manager):
         self.logger = self._create_logger()
-        self.process_manager = ProcessManager(db_path=db_path, tasks_module=tasks)
+        self.process_manager = process_manager
 
 
 # noinspection PyAbstractClass
 class AgentdUnixSocket(AgentdBaseHandler):
     """Обработка приватных методов API"""
+    server = 'unix'
+
     @get_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def stop(self):
         self._stop()
 
     @post_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def register_process(self, pid):
         self.process_manager.register_process(pid)
 
     @post_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def unlink_process(self, pid):
         self.process_manager.unlink_process(pid)
 
     @post_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def stop_registered_process(self, pid):
         self.process_manager.stop_registered_process(pid)
 
     @post_handler
-    @json_content
+    @encoded_content
     @wrap_with_success_value
     def kill_waiting_process(self, pid):
         self.process_manager.kill_waiting_process(pid)
 
+    @post_handler
+    @encoded_content
+    @wrap_with_success_value
+    @gen.coroutine
+    def spawn_processes(self, tasks):
+        """Запуск пачки процессов по запросу web процесса (см. replica.ProcessReplica)
+
+        :return: {"pids": [...], "seq": номер последнего события после запуска}
+        """
+        pids = yield self.process_manager.spawn_processes(tasks)
+        raise gen.Return({'pids': pids, 'seq': self.process_manager.events.seq})
+
+    @get_handler
+    @encoded_content
+    @wrap_with_success_value
+    def snapshot(self):
+        """Полное состояние менеджера процессов для реплик, см. ProcessManager.snapshot"""
+        return self.process_manager.snapshot()
+
+    @get_handler
+    def events(self):
+        """Поток событий менеджера процессов для реплик, см. AgentdWebSocket.events"""
+        return self._stream_events()
+
     @staticmethod
     def _create_logger():
         return create_logger('agentd_unix_socket')
 
     # noinspection PyAttributeOutsideInit
-    def initialize(self):
+    def initialize(self, process_manager):
         self.logger = self._create_logger()
-        self.process_manager = ProcessManager(db_path=db_path)
+        self.process_manager = process_manager
+
+
+_metric_handlers = {
+    handler_class.server: set(handler_names(handler_class))
+    for handler_class in (AgentdWebSocket, AgentdUnixSocket)
+}
+_status_classes = ('2xx', '3xx', '4xx', '5xx')
+
+http_requests_total = metrics_registry.counter(
+    'agentd_http_requests_total',
+    'HTTP requests by handler and status class',
+    labelnames=('server', 'handler', 'code'),
+    labelvalues=[
+        (server, handler, code)
+        for server, handlers in sorted(_metric_handlers.items())
+        for handler in sorted(handlers) + ['other']
+        for code in _status_classes
+    ],
+)
+http_request_seconds = metrics_registry.histogram(
+    'agentd_http_request_duration_seconds',
+    'HTTP request latency by handler',
+    labelnames=('server', 'handler'),
+    labelvalues=[
+        (server, handler)
+        for server, handlers in sorted(_metric_handlers.items())
+        for handler in sorted(handlers) + ['other']
+    ],
+)
 
 
 def spawn_killer():
@@ -208,25 +754,118 @@ def spawn_killer():
     process_.start()
 
 
-def make_websocket_app():
+def make_websocket_app(process_manager):
     return tornado.web.Application([
-        (r"/.*", AgentdWebSocket),
+        (r"/.*", AgentdWebSocket, dict(process_manager=process_manager)),
     ])
 
 
-def make_unixsocket_app():
+def make_unixsocket_app(process_manager):
     return tornado.web.Application([
-        (r"/.*", AgentdUnixSocket),
+        (r"/.*", AgentdUnixSocket, dict(process_manager=process_manager)),
     ])
 
 
-def shutdown(web, unix):
-    """Останавливаем оба сервера, удаляем unix сокет"""
-    web.stop()
+def serve_web_process(sockets, metrics_row):
+    """Web процесс: обслуживание публичного API на общих с другими web процессами сокетах
+
+    Вместо менеджера процессов используется его реплика, соединения начинают приниматься
+    после ее первой синхронизации с супервизором.
+
+    :param sockets: слушающие сокеты публичного порта
+    :param metrics_row: строка разделяемого массива метрик, в которую пишет этот процесс
+    """
+    signal.signal(signal.SIGINT, sighandler)
+    signal.signal(signal.SIGTERM, sighandler)
+    metrics_registry.use_row(metrics_row)
+    IOLoopLagMonitor(ioloop_lag_seconds, interval=metrics_lag_interval_sec).start()
+
+    replica = ProcessReplica(
+        url_prefix=unix_socket_url_prefix,
+        exited_history_size=exited_history_size,
+        events_history_size=events_history_size,
+        retry_sec=replica_retry_sec,
+        sync_timeout=replica_sync_timeout,
+        output_folder=task_output_folder,
+        catalog=TaskCatalog(task_catalog_module, reload_interval=task_reload_interval_sec),
+    )
+    replica.start()
+
+    websocket_server = HTTPServer(make_websocket_app(replica))
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop.add_future(replica.ready, lambda future: websocket_server.add_sockets(sockets))
+    ioloop.start()
+
+    websocket_server.stop()
+    replica.stop()
+
+
+def start_web_processes(num, zygote=None):
+    """Порождение num web процессов, слушающих публичный порт
+
+    Сокеты порта открываются до fork и наследуются всеми web процессами, ядро само
+    распределяет между ними входящие соединения. Супервизор свои копии сокетов закрывает
+    (задачам они бы в любом случае не достались, см. main).
+    Метрики к этому моменту должны быть размещены в памяти на num + 1 процессов.
+
+    :param num: int
+    :param zygote: zygote.Zygote, каналы которой web процессам не нужны
+    :return: список pid web процессов
+    """
+    sockets = bind_sockets(port)
+    pids = []
+    for index in range(num):
+        pid = os.fork()
+        if pid == 0:
+            if zygote is not None:
+                zygote.close()
+            start_log_writer(rotate=False)
+            exitcode = 0
+            # noinspection PyBroadException
+            try:
+                serve_web_process(sockets, metrics_row=index + 1)
+            except Exception:
+                AgentdWebSocket._create_logger().exception('Web process failed')
+                exitcode = 1
+            finally:
+                flush_logs()
+                os._exit(exitcode)
+
+        pids.append(pid)
+
+    for sock in sockets:
+        sock.close()
+
+    return pids
+
+
+def stop_web_processes(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass    # уже собран reaper'ом
+
+
+def shutdown(web, unix, process_manager, web_processes_pids=()):
+    """Останавливаем оба сервера (или web процессы), удаляем unix сокет, закрываем реестр процессов и зиготу"""
+    if web is not None:
+        web.stop()
+    stop_web_processes(web_processes_pids)
 
     unix.stop()
     os.unlink(unix_socket_path)
 
+    process_manager.stop(keep_processess=True)
+    if process_manager.zygote is not None:
+        process_manager.zygote.stop()
+
 
 # noinspection PyUnusedLocal
 def sighandler(*args, **kwargs):
@@ -256,22 +895,84 @@ def main():
 
 
 
+    Реестр процессов и менеджер создаются один раз и разделяются обработчиками обоих серверов.
+
+    Если указан параметр --web_processes больше 1, то публичный порт обслуживают столько же
+    отдельных web процессов (serve_web_process) с репликами менеджера, а сам процесс становится
+    супервизором: держит реестр, порождает и собирает задачи и обслуживает unix сокет.
+
+    Если указан флаг --zygote, то до открытия сокетов и настройки логгеров запускается
+    fork-сервер (zygote.Zygote), через который затем порождаются все задачи.
+
+    При старте читается только каталог задач (task_catalog.TaskCatalog), сами модули задач
+    импортируются лениво тем процессом, который порождает задачи.
+
     Если выставлена переменная окружения DISABLE_DAEMON, то процесс запускается без демонизации.
 
     """
     if not os.getenv('DISABLE_DAEMON'):
         daemonize()
 
+    catalog = TaskCatalog(task_catalog_module, reload_interval=task_reload_interval_sec)
+    zygote = None
+    if zygote_enabled:
+        zygote = Zygote(loader=TaskLoader(reload_interval=task_reload_interval_sec), preload=catalog.preload_paths())
+        zygote.start()
+
+    # поток записи логов запускается после fork зиготы и демонизации, в них он бы не выжил
+    start_log_writer()
     setup_tornado_loggers()
 
-    websocket_server = HTTPServer(make_websocket_app())
-    websocket_server.bind(port)
-    websocket_server.start()
+    web_processes_pids = []
+    if web_processes > 1:
+        metrics_registry.allocate(rows=web_processes + 1)
+        web_processes_pids = start_web_processes(web_processes, zygote=zygote)
+    else:
+        metrics_registry.allocate()
+
+    if not os.path.exists(os.path.dirname(db_path)):
+        os.makedirs(os.path.dirname(db_path))
+    registry = ProcessRegistry(
+        db_path=db_path,
+        journal_path=journal_path,
+        compact_threshold=journal_compact_threshold,
+        fsync=journal_fsync,
+        background=journal_background,
+    )
+    process_manager = ProcessManager(
+        registry=registry,
+        catalog=catalog,
+        zygote=zygote,
+        exited_history_size=exited_history_size,
+        events_history_size=events_history_size,
+        spawn_executor=BoundedExecutor(max_workers=1, max_pending=spawn_executor_max_pending),
+        resources_interval=resources_sample_interval_sec,
+        max_processes=max_processes,
+        max_processes_per_cmd=max_processes_per_cmd,
+        run_queue_size=run_queue_size,
+        run_queue_retry_sec=run_queue_retry_sec,
+        registration_timeout=registration_timeout_sec,
+        output=TaskOutput(
+            folder=task_output_folder,
+            buffer_lines=task_output_buffer_lines,
+            history_size=exited_history_size,
+            max_file_bytes=task_output_max_file_bytes,
+        ),
+    )
+
+    # сокеты порта и unix сокета задачи не наследуют: при fork задача закрывает все дескрипторы
+    # демона, кроме своих (forking.fork_task), так что демон, остановленный с сохранением задач,
+    # можно сразу запустить снова на том же порту
+    websocket_server = None
+    if not web_processes_pids:
+        websocket_server = HTTPServer(make_websocket_app(process_manager))
+        websocket_server.bind(port)
+        websocket_server.start()
     AgentdWebSocket._create_logger().info('Server started.')
 
     if not os.path.exists(os.path.dirname(unix_socket_path)):
         os.makedirs(os.path.dirname(unix_socket_path))
-    unixsocket_server = HTTPServer(make_unixsocket_app())
+    unixsocket_server = HTTPServer(make_unixsocket_app(process_manager))
     socket = bind_unix_socket(unix_socket_path)
     unixsocket_server.add_socket(socket)
     unixsocket_server.start()
@@ -281,11 +982,32 @@ def main():
     signal.signal(signal.SIGINT, sighandler)
     signal.signal(signal.SIGTERM, sighandler)
 
+    def on_exit(exits):
+        for pid, returncode, signum in exits:
+            if pid in web_processes_pids:
+                web_processes_pids.remove(pid)
+                AgentdWebSocket._create_logger().error(
+                    'Web process %s exited (returncode=%s, signal=%s)' % (pid, returncode, signum)
+                )
+        process_manager.reap_processes(exits)
+
+    IOLoopLagMonitor(ioloop_lag_seconds, interval=metrics_lag_interval_sec).start()
+
+    # collect exited tasks: own children via SIGCHLD, zygote children via its event channel
+    Reaper(on_exit=on_exit).install()
+    if zygote is not None:
+        zygote.attach(on_exit=process_manager.reap_processes)
+
     # start eventloop (serve both unix- and web- socket HTTP servers)
     tornado.ioloop.IOLoop.instance().start()
 
     # after the ioloop.stop() shut all servers down
-    shutdown(web=websocket_server, unix=unixsocket_server)
+    shutdown(
+        web=websocket_server,
+        unix=unixsocket_server,
+        process_manager=process_manager,
+        web_processes_pids=web_processes_pids,
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""Пропускная способность демона с access логом: синхронная и асинхронная запись логов
+
+Для каждого режима (--log_async=false и --log_async=true) демон запускается в отдельном процессе
+(во временном каталоге, без демонизации), после чего --clients потоков в течение --duration секунд
+опрашивают /info?state=running. Каждый запрос пишет строку access лога tornado в all.log.
+Печатаются запросы в секунду, p50 и p99 задержки.
+
+Запуск:
+    $ python benchmarks/access_log_bench.py --duration 10 --clients 8
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def start_daemon(workdir, port, log_async):
+    env = dict(os.environ, DISABLE_DAEMON='1')
+    cmd = [sys.executable, os.path.join(ROOT, 'agentd.py'), '--port=%s' % port, '--log_async=%s' % log_async]
+    with open(os.path.join(workdir, 'agentd.log'), 'w') as log:
+        process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = 'http://localhost:%s/health' % port
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError('agentd did not start, see %s' % os.path.join(workdir, 'agentd.log'))
+
+
+def load(url, clients, duration):
+    """Опрос url из clients потоков в течение duration секунд
+
+    :return: (список задержек, количество ошибок)
+    """
+    latencies, errors = [], [0]
+    deadline = time.time() + duration
+
+    def client():
+        session = requests.Session()
+        while time.time() < deadline:
+            started_at = time.time()
+            try:
+                session.get(url, timeout=10).raise_for_status()
+            except requests.RequestException:
+                errors[0] += 1
+                continue
+            latencies.append(time.time() - started_at)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=10.0, help='длительность замера каждого режима')
+    parser.add_argument('--clients', type=int, default=8, help='количество параллельных клиентов')
+    parser.add_argument('--port', type=int, default=8899)
+    args = parser.parse_args()
+
+    print('%-6s %8s %10s %10s %10s %8s' % ('mode', 'requests', 'req/sec', 'p50_ms', 'p99_ms', 'errors'))
+    for log_async in ('false', 'true'):
+        workdir = tempfile.mkdtemp(prefix='agentd-bench-')
+        daemon = start_daemon(workdir, args.port, log_async)
+        try:
+            latencies, errors = load('http://localhost:%s/info?state=running' % args.port, args.clients, args.duration)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        print('%-6s %8s %10.1f %10.2f %10.2f %8s' % (
+            'async' if log_async == 'true' else 'sync',
+            len(latencies),
+            len(latencies) / args.duration,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            errors,
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+# coding: utf-8
+"""Пропускная способность и задержки API демона: /health, /info и полный цикл задачи
+
+Демон запускается в отдельном процессе (agentd.py, во временном каталоге со своим unix сокетом
+и реестром, на свободном порту, без демонизации). Затем для каждого сценария и каждого уровня
+параллельности из --concurrency клиентские потоки в течение --duration секунд выполняют
+запросы (первые --warmup секунд не учитываются):
+
+    health          GET /health
+    info            GET /info
+    run_task        POST /run_task с пустой задачей noop (tasks.tasks_bench), которая регистрируется
+                    и разрегистрируется по своему каналу; клиент ждет события unlink (/events)
+                    и только потом запускает следующую задачу
+    run_task_http   то же, но задача шлет /register_process и /unlink_process http запросами
+                    на unix сокет
+
+Для каждого замера считаются пропускная способность (запросов или циклов задачи в секунду)
+и p50/p99/p999/max задержки ответа, а для run_task* -- еще и задержки от отправки /run_task
+до событий register и unlink.
+
+Результаты пишутся в json (--output, по умолчанию в stdout), чтобы прогоны можно было сравнивать:
+    {
+        "meta": {"commit": "...", "python": "2.7.18", "cpus": 4, "args": {...}, ...},
+        "results": [
+            {
+                "scenario": "run_task",
+                "concurrency": 8,
+                "requests": 5123,
+                "errors": 0,
+                "throughput_per_sec": 1024.6,
+                "latency_ms": {"p50": 3.1, "p99": 9.8, "p999": 15.2, "max": 21.0},
+                "register_latency_ms": {...},
+                "unlink_latency_ms": {...}
+            },
+            ...
+        ]
+    }
+Сводная таблица печатается в stderr.
+
+Запуск:
+    $ python benchmarks/api_latency_bench.py --concurrency 1,8,32 --duration 5 --output before.json
+    $ python benchmarks/api_latency_bench.py --scenarios run_task --zygote --output after.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('health', 'info', 'run_task', 'run_task_http')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summary_ms(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 0.5) * 1000, 3),
+        'p99': round(percentile(values, 0.99) * 1000, 3),
+        'p999': round(percentile(values, 0.999) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_daemon(workdir, port, extra_args):
+    env = dict(os.environ, DISABLE_DAEMON='1')
+    cmd = [sys.executable, os.path.join(ROOT, 'agentd.py'), '--port=%s' % port] + extra_args
+    with open(os.path.join(workdir, 'agentd.log'), 'w') as log:
+        process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = 'http://localhost:%s/health' % port
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1).raise_for_status()
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError('agentd did not start, see %s' % os.path.join(workdir, 'agentd.log'))
+
+
+class LifecycleWatcher(threading.Thread):
+    """Чтение /events: время получения событий register и unlink по pid
+
+    События могут прийти раньше, чем клиент получит pid в ответе /run_task, поэтому они
+    складываются в таблицу, из которой клиент забирает свою задачу (wait).
+    """
+    def __init__(self, url_prefix):
+        super(LifecycleWatcher, self).__init__(name='lifecycle-watcher')
+        self.daemon = True
+        self.url_prefix = url_prefix
+        self.ready = threading.Event()
+        self._seen = {}
+        self._condition = threading.Condition()
+        self._response = None
+        self._stopped = False
+
+    def run(self):
+        self._response = requests.get('%s/events' % self.url_prefix, stream=True, timeout=(1, None))
+        self.ready.set()
+        try:
+            # chunk_size=None: события отдаются по мере прихода, а не после накопления 512 байт
+            for line in self._response.iter_lines(chunk_size=None):
+                if not line.startswith('data:'):
+                    continue
+                event = json.loads(line[len('data:'):])
+                if event['type'] in ('register', 'unlink'):
+                    with self._condition:
+                        self._seen.setdefault(event['pid'], {})[event['type']] = time.time()
+                        self._condition.notify_all()
+        # noinspection PyBroadException
+        except Exception:
+            if not self._stopped:
+                raise   # иначе соединение закрыто в stop
+
+    def wait(self, pid, timeout):
+        """Ожидание события unlink задачи pid
+
+        :return: {"register": время, "unlink": время} или None, если событие не пришло за timeout
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while 'unlink' not in self._seen.get(pid, {}):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._seen.pop(pid, None)
+                    return None
+                self._condition.wait(remaining)
+            return self._seen.pop(pid)
+
+    def stop(self):
+        self._stopped = True
+        if self._response is not None:
+            self._response.close()
+
+
+def make_request(scenario, url_prefix, watcher):
+    """Одна операция сценария для клиентского потока
+
+    :return: callable, принимает requests.Session и возвращает dict задержек в секундах
+        ("request", а для run_task* еще "register" и "unlink")
+    :raise Exception: при ошибке
+    """
+    if scenario in ('health', 'info'):
+        url = '%s/%s' % (url_prefix, scenario)
+
+        def request(session):
+            started_at = time.time()
+            session.get(url, timeout=10).raise_for_status()
+            return {'request': time.time() - started_at}
+        return request
+
+    body = {'cmd': 'noop', 'kwargs': {'via_http': scenario == 'run_task_http'}}
+
+    def request(session):
+        started_at = time.time()
+        response = session.post('%s/run_task' % url_prefix, json=body, timeout=10)
+        response.raise_for_status()
+        latencies = {'request': time.time() - started_at}
+
+        pid = response.json()['response']
+        if not isinstance(pid, int):
+            raise RuntimeError('task was not started: %r' % pid)
+        seen = watcher.wait(pid, timeout=10)
+        if seen is None or 'register' not in seen:
+            raise RuntimeError('no lifecycle events for pid %s' % pid)
+
+        latencies['register'] = seen['register'] - started_at
+        latencies['unlink'] = seen['unlink'] - started_at
+        return latencies
+    return request
+
+
+def measure(scenario, url_prefix, watcher, concurrency, duration, warmup):
+    """Нагрузка одного сценария из concurrency потоков
+
+    :return: dict результата замера
+    """
+    request = make_request(scenario, url_prefix, watcher)
+    samples, errors = [], [0]
+    started_at = time.time()
+    measure_from = started_at + warmup
+    deadline = measure_from + duration
+
+    def client():
+        session = requests.Session()
+        # json, а не msgpack: так ответы одинаково разбираются при любой сборке демона
+        session.headers['Accept'] = 'application/json'
+        while True:
+            request_started_at = time.time()
+            if request_started_at >= deadline:
+                return
+            try:
+                latencies = request(session)
+            except Exception:
+                if request_started_at >= measure_from:
+                    errors[0] += 1
+                continue
+            if request_started_at >= measure_from:
+                samples.append(latencies)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    result = {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'errors': errors[0],
+        'throughput_per_sec': round(len(samples) / duration, 1),
+        'latency_ms': summary_ms([sample['request'] for sample in samples]),
+    }
+    if scenario.startswith('run_task'):
+        result['register_latency_ms'] = summary_ms([sample['register'] for sample in samples])
+        result['unlink_latency_ms'] = summary_ms([sample['unlink'] for sample in samples])
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    def column(summary, key):
+        return '%10.2f' % summary[key] if summary else '%10s' % '-'
+
+    sys.stderr.write('%-14s %5s %8s %7s %10s %10s %10s %10s %12s\n' % (
+        'scenario', 'conc', 'requests', 'errors', 'per_sec', 'p50_ms', 'p99_ms', 'p999_ms', 'unlink_p99',
+    ))
+    for result in results:
+        sys.stderr.write('%-14s %5s %8s %7s %10.1f %s %s %s %s\n' % (
+            result['scenario'],
+            result['concurrency'],
+            result['requests'],
+            result['errors'],
+            result['throughput_per_sec'],
+            column(result['latency_ms'], 'p50'),
+            column(result['latency_ms'], 'p99'),
+            column(result['latency_ms'], 'p999'),
+            '  ' + column(result.get('unlink_latency_ms'), 'p99'),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='сценарии через запятую')
+    parser.add_argument('--concurrency', default='1,8', help='уровни параллельности через запятую')
+    parser.add_argument('--duration', type=float, default=5.0, help='длительность замера, сек')
+    parser.add_argument('--warmup', type=float, default=1.0, help='неучитываемый разогрев перед замером, сек')
+    parser.add_argument('--port', type=int, default=None, help='порт демона (по умолчанию -- свободный)')
+    parser.add_argument('--zygote', action='store_true', help='запускать задачи через зиготу')
+    parser.add_argument('--web_processes', type=int, default=1, help='количество web процессов демона')
+    parser.add_argument('--output', default=None, help='файл для json с результатами (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    levels = [int(level) for level in args.concurrency.split(',') if level]
+
+    port = args.port or free_port()
+    extra_args = ['--web_processes=%s' % args.web_processes]
+    if args.zygote:
+        extra_args.append('--zygote')
+
+    started_at = time.time()
+    workdir = tempfile.mkdtemp(prefix='agentd-bench-')
+    daemon = start_daemon(workdir, port, extra_args)
+    url_prefix = 'http://localhost:%s' % port
+    watcher = LifecycleWatcher(url_prefix)
+    results = []
+    try:
+        watcher.start()
+        watcher.ready.wait(10)
+        for scenario in scenarios:
+            for level in levels:
+                results.append(measure(scenario, url_prefix, watcher, level, args.duration, args.warmup))
+    finally:
+        watcher.stop()
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': started_at,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    print_table(results)
+
+
+if __name__ == '__main__':
+    main()
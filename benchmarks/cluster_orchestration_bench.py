@@ -0,0 +1,417 @@
+# coding: utf-8
+"""Сходимость глобальной оркестрации воркеров (set_workers_globally) на локальном кластере демонов
+
+Для каждого размера кластера из --sizes на этой машине запускается столько же демонов agentd
+(agentd.py без демонизации, каждый в своем временном каталоге со своими unix сокетом, реестром
+и логами, на своем порту, в своей группе процессов). Список хостов для оркестрации (--hosts)
+у всех демонов общий.
+
+Если заданы задержка или отказы, то хосты в этом списке указывают не на демоны, а на прокси
+(FaultProxy) в процессе бенчмарка, которые добавляют задержку к каждому запросу (--latency-ms,
+значение или диапазон "min-max", тогда задержка выбирается для каждого хоста случайно),
+обрывают соединение посреди запроса с вероятностью --drop-rate или не принимают запросы вовсе
+(--down-fraction хостов, кроме координатора). Сам бенчмарк опрашивает демоны напрямую.
+
+Для каждого целевого числа воркеров (--workers-per-host, на хост) на первом хосте (координаторе)
+запускается set_workers_globally, после чего воркеры на всех хостах считаются, пока их сумма
+не станет равна целевой. Если сумма перестала меняться (--settle-sec), а цели нет (например,
+часть запросов оборвана), оркестрация запускается снова, не больше --max-rounds раз.
+Замеряется время до завершения первой задачи-оркестратора и время до сходимости. Недоступные
+хосты оркестратор пропускает, поэтому цель считается только по доступным.
+
+Результаты пишутся в json (--output, по умолчанию в stdout), сводная таблица -- в stderr:
+    {
+        "meta": {"commit": "...", "cpus": 8, "args": {...}, ...},
+        "results": [
+            {
+                "hosts": 100,
+                "target": 200,
+                "converged": true,
+                "rounds": 1,
+                "orchestrator_sec": 1.8,
+                "converged_sec": 4.2,
+                "workers": 200,
+                "down_hosts": 0
+            },
+            ...
+        ]
+    }
+
+Каждый демон -- отдельный процесс python (десятки мегабайт памяти), плюс процессы воркеров,
+так что 500 хостов требуют порядка десятка гигабайт памяти.
+
+Запуск:
+    $ python benchmarks/cluster_orchestration_bench.py --sizes 10,100,500 --output cluster.json
+    $ python benchmarks/cluster_orchestration_bench.py --sizes 50 --latency-ms 5-50 --drop-rate 0.02
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FaultProxy(TCPServer):
+    """TCP прокси к демону с задержкой запросов и обрывами соединений
+
+    Задержка добавляется к каждой порции данных от клиента (запросы короткие, так что
+    фактически к каждому запросу), ответы передаются без задержки.
+    """
+    def __init__(self, backend_port, latency=0.0, drop_rate=0.0, down=False):
+        super(FaultProxy, self).__init__()
+        self.backend_port = backend_port
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.down = down
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        if self.down:
+            stream.close()
+            return
+
+        try:
+            backend = yield TCPClient().connect('127.0.0.1', self.backend_port)
+        except IOError:
+            stream.close()
+            return
+
+        yield [self._pipe(stream, backend, self.latency, self.drop_rate), self._pipe(backend, stream)]
+
+    @staticmethod
+    @gen.coroutine
+    def _pipe(source, destination, latency=0.0, drop_rate=0.0):
+        try:
+            while True:
+                data = yield source.read_bytes(65536, partial=True)
+                if latency:
+                    yield gen.sleep(latency)
+                if drop_rate and random.random() < drop_rate:
+                    break
+                yield destination.write(data)
+        except StreamClosedError:
+            pass
+        finally:
+            source.close()
+            destination.close()
+
+
+class ProxyPool(object):
+    """Прокси всех хостов кластера в одном ioloop в отдельном потоке"""
+    def __init__(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self._servers = []
+        self._thread = None
+
+    def add(self, port, backend_port, **faults):
+        server = FaultProxy(backend_port, **faults)
+        self.ioloop.make_current()
+        try:
+            server.add_sockets(bind_sockets(port, address='127.0.0.1'))
+        finally:
+            tornado.ioloop.IOLoop.clear_current()
+        self._servers.append(server)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.ioloop.start, name='fault-proxies')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self.ioloop.add_callback(self.ioloop.stop)
+            self._thread.join()
+        for server in self._servers:
+            server.stop()
+        self.ioloop.close(all_fds=True)
+
+
+def parse_range(value):
+    """"10" -> (10.0, 10.0), "5-50" -> (5.0, 50.0)"""
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+
+class Cluster(object):
+    """Локальный кластер из size демонов agentd (с прокси, если заданы задержка или отказы)"""
+    def __init__(self, size, base_port, latency_ms=(0.0, 0.0), drop_rate=0.0, down_fraction=0.0, zygote=False):
+        self.size = size
+        self.ports = [base_port + index for index in range(size)]
+        self.urls = ['http://localhost:%s' % port for port in self.ports]
+        self.workdir = tempfile.mkdtemp(prefix='agentd-cluster-')
+        self.zygote = zygote
+        self.daemons = []
+
+        # координатор (первый хост) доступен всегда
+        down = set(random.sample(range(1, size), int((size - 1) * down_fraction))) if size > 1 else set()
+        self.down_hosts = len(down)
+        self.proxies = None
+        self.host_urls = self.urls
+        if latency_ms != (0.0, 0.0) or drop_rate or down:
+            self.proxies = ProxyPool()
+            proxy_ports = [base_port + size + index for index in range(size)]
+            for index, (port, proxy_port) in enumerate(zip(self.ports, proxy_ports)):
+                self.proxies.add(
+                    proxy_port, port,
+                    latency=random.uniform(*latency_ms) / 1000.0, drop_rate=drop_rate, down=index in down,
+                )
+            self.host_urls = ['http://127.0.0.1:%s' % port for port in proxy_ports]
+
+    def start(self, timeout):
+        if self.proxies is not None:
+            self.proxies.start()
+
+        env = dict(os.environ, DISABLE_DAEMON='1')
+        for index, port in enumerate(self.ports):
+            workdir = os.path.join(self.workdir, 'host-%s' % index)
+            os.makedirs(workdir)
+            cmd = [
+                sys.executable, os.path.join(ROOT, 'agentd.py'),
+                '--port=%s' % port, '--hosts=%s' % ','.join(self.host_urls),
+            ]
+            if self.zygote:
+                cmd.append('--zygote')
+            with open(os.path.join(workdir, 'agentd.log'), 'w') as log:
+                self.daemons.append(subprocess.Popen(
+                    cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid,
+                ))
+
+        deadline = time.time() + timeout
+        session = requests.Session()
+        for index, url in enumerate(self.urls):
+            while True:
+                try:
+                    session.get('%s/health' % url, timeout=1).raise_for_status()
+                    break
+                except requests.RequestException:
+                    if time.time() > deadline or self.daemons[index].poll() is not None:
+                        raise RuntimeError('agentd on %s did not start, see %s/host-%s/agentd.log' % (
+                            url, self.workdir, index,
+                        ))
+                    time.sleep(0.1)
+
+    def stop(self):
+        """Остановка демонов вместе с их задачами (SIGTERM всей группе процессов демона)"""
+        for signum, grace in ((signal.SIGTERM, 10.0), (signal.SIGKILL, 5.0)):
+            alive = [daemon for daemon in self.daemons if daemon.poll() is None]
+            for daemon in alive:
+                try:
+                    os.killpg(daemon.pid, signum)
+                except OSError:
+                    pass
+
+            deadline = time.time() + grace
+            while any(daemon.poll() is None for daemon in alive) and time.time() < deadline:
+                time.sleep(0.1)
+
+        # воркеры, пережившие свой демон
+        for daemon in self.daemons:
+            try:
+                os.killpg(daemon.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        if self.proxies is not None:
+            self.proxies.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Observer(object):
+    """Опрос демонов кластера напрямую (минуя прокси)"""
+    def __init__(self, urls, max_workers=32):
+        self.urls = urls
+        self.executor = ThreadPoolExecutor(max_workers=min(len(urls), max_workers))
+        self.local = threading.local()
+
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.headers['Accept'] = 'application/json'
+        return session
+
+    def _get(self, url, params):
+        response = self._session().get('%s/info' % url, params=params, timeout=10)
+        response.raise_for_status()
+        return response.json()['response']
+
+    def count_workers(self):
+        """Суммарное число воркеров в running по всем хостам или None, если кто-то не ответил"""
+        params = {'cmd': 'worker', 'state': 'running', 'fields': 'pid'}
+        try:
+            infos = list(self.executor.map(lambda url: self._get(url, params), self.urls))
+        except requests.RequestException:
+            return None
+        return sum(len(info['running']) for info in infos)
+
+    def is_running(self, url, cmd, pid):
+        info = self._get(url, {'cmd': cmd, 'state': 'running,waiting', 'fields': 'pid'})
+        return any(record['pid'] == pid for state in ('running', 'waiting') for record in info[state])
+
+    def run_task(self, url, cmd, kwargs):
+        response = self._session().post('%s/run_task' % url, json={'cmd': cmd, 'kwargs': kwargs}, timeout=10)
+        response.raise_for_status()
+        pid = response.json()['response']
+        if not isinstance(pid, int):
+            raise RuntimeError('%s was not started on %s: %r' % (cmd, url, pid))
+        return pid
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+
+
+def converge(cluster, observer, target, args):
+    """Запуск set_workers_globally на координаторе до сходимости к target воркерам
+
+    :return: dict результата
+    """
+    coordinator = cluster.urls[0]
+    started_at = time.time()
+    deadline = started_at + args.timeout
+    result = {
+        'hosts': cluster.size,
+        'target': target,
+        'converged': False,
+        'rounds': 0,
+        'orchestrator_sec': None,
+        'converged_sec': None,
+        'workers': None,
+        'down_hosts': cluster.down_hosts,
+    }
+
+    while result['rounds'] < args.max_rounds and time.time() < deadline:
+        result['rounds'] += 1
+        pid = observer.run_task(coordinator, 'set_workers_globally', {'num': target})
+        while observer.is_running(coordinator, 'set_workers_globally', pid) and time.time() < deadline:
+            time.sleep(args.poll_interval)
+        if result['orchestrator_sec'] is None:
+            result['orchestrator_sec'] = round(time.time() - started_at, 3)
+
+        # локальные оркестраторы (set_workers) запускают и останавливают воркеров уже после
+        # завершения глобального, сумма проверяется, пока она меняется
+        changed_at, last = time.time(), None
+        while time.time() < deadline:
+            result['workers'] = observer.count_workers()
+            if result['workers'] == target:
+                result['converged'] = True
+                result['converged_sec'] = round(time.time() - started_at, 3)
+                return result
+
+            if result['workers'] != last:
+                changed_at, last = time.time(), result['workers']
+            elif time.time() - changed_at > args.settle_sec:
+                break
+            time.sleep(args.poll_interval)
+
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    sys.stderr.write('%6s %7s %10s %7s %16s %14s %8s %6s\n' % (
+        'hosts', 'target', 'converged', 'rounds', 'orchestrator_s', 'converged_s', 'workers', 'down',
+    ))
+    for result in results:
+        sys.stderr.write('%6s %7s %10s %7s %16s %14s %8s %6s\n' % (
+            result['hosts'],
+            result['target'],
+            result['converged'],
+            result['rounds'],
+            result['orchestrator_sec'],
+            result['converged_sec'],
+            result['workers'],
+            result['down_hosts'],
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,500', help='размеры кластера через запятую')
+    parser.add_argument('--workers-per-host', default='2,1', help='целевое число воркеров на хост по фазам')
+    parser.add_argument('--base-port', type=int, default=20000, help='порты демонов, затем прокси -- подряд')
+    parser.add_argument('--latency-ms', default='0', help='задержка запроса к хосту, мс: "20" или "5-50"')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='вероятность обрыва запроса к хосту')
+    parser.add_argument('--down-fraction', type=float, default=0.0, help='доля недоступных хостов')
+    parser.add_argument('--zygote', action='store_true', help='запускать задачи демонов через зиготу')
+    parser.add_argument('--max-rounds', type=int, default=5, help='сколько раз запускать оркестрацию')
+    parser.add_argument('--settle-sec', type=float, default=5.0, help='сколько ждать изменения числа воркеров')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='интервал опроса демонов, сек')
+    parser.add_argument('--timeout', type=float, default=300.0, help='ограничение на сходимость одной фазы, сек')
+    parser.add_argument('--seed', type=int, default=None, help='seed выбора задержек и недоступных хостов')
+    parser.add_argument('--output', default=None, help='файл для json с результатами (по умолчанию stdout)')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    phases = [float(num) for num in args.workers_per_host.split(',') if num]
+    latency_ms = parse_range(args.latency_ms)
+
+    # по дескриптору на каждое соединение через прокси и на каждый опрашиваемый хост
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    started_at = time.time()
+    results = []
+    for size in sizes:
+        cluster = Cluster(
+            size, args.base_port,
+            latency_ms=latency_ms, drop_rate=args.drop_rate, down_fraction=args.down_fraction, zygote=args.zygote,
+        )
+        observer = Observer(cluster.urls)
+        try:
+            cluster.start(timeout=30 + size * 0.5)
+            for per_host in phases:
+                target = int((size - cluster.down_hosts) * per_host)
+                results.append(converge(cluster, observer, target, args))
+        finally:
+            observer.stop()
+            cluster.stop()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': started_at,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# coding: utf-8
+"""Задержка /health во время всплеска запусков задач
+
+Демон запускается в отдельном процессе (во временном каталоге, без демонизации). Фоновый поток
+непрерывно опрашивает /health и замеряет задержку ответов: сначала на холостом демоне, затем
+во время запуска --num задач sleep(0) через /run_tasks пачками по --batch. Для каждой фазы
+печатаются p50, p99 и максимум задержки /health. Ответы 503 (очередь пула переполнена)
+считаются отдельно.
+
+p99 во время всплеска должен оставаться близким к холостому: если он больше p99 холостого
+демона на --max-p99-increase-ms, то скрипт завершается с кодом 1 (до переноса запусков
+задач с ioloop разница была порядка 500 мс, после -- порядка 15 мс).
+
+Запуск:
+    $ python benchmarks/health_latency_bench.py --num 1000 --batch 50 --zygote
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class HealthPoller(threading.Thread):
+    """Опрос /health в цикле, задержки складываются в текущую фазу"""
+    def __init__(self, url):
+        super(HealthPoller, self).__init__(name='health-poller')
+        self.daemon = True
+        self.url = url
+        self.phase = None
+        self.latencies = {}
+        self.errors = {}
+        self._stopped = False
+
+    def run(self):
+        session = requests.Session()
+        while not self._stopped:
+            phase = self.phase
+            started_at = time.time()
+            try:
+                session.get(self.url, timeout=10).raise_for_status()
+            except requests.RequestException:
+                self.errors[phase] = self.errors.get(phase, 0) + 1
+                continue
+            self.latencies.setdefault(phase, []).append(time.time() - started_at)
+
+    def stop(self):
+        self._stopped = True
+
+
+def start_daemon(workdir, port, zygote):
+    env = dict(os.environ, DISABLE_DAEMON='1')
+    cmd = [sys.executable, os.path.join(ROOT, 'agentd.py'), '--port=%s' % port]
+    if zygote:
+        cmd.append('--zygote')
+    with open(os.path.join(workdir, 'agentd.log'), 'w') as log:
+        process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = 'http://localhost:%s/health' % port
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return process
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError('agentd did not start, see %s' % os.path.join(workdir, 'agentd.log'))
+
+
+def burst(url_prefix, num, batch):
+    """Запуск num задач пачками по batch
+
+    :return: (количество запущенных задач, количество ответов 503)
+    """
+    spawned, rejected = 0, 0
+    task = {'cmd': 'sleep', 'args': [0], 'kwargs': {}}
+    for offset in range(0, num, batch):
+        tasks = [task] * min(batch, num - offset)
+        response = requests.post('%s/run_tasks' % url_prefix, json={'tasks': tasks})
+        if response.status_code == 503:
+            rejected += 1
+            continue
+        response.raise_for_status()
+        spawned += len([pid for pid in response.json()['response'] if pid is not None])
+    return spawned, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num', type=int, default=1000, help='количество задач во всплеске')
+    parser.add_argument('--batch', type=int, default=50, help='задач в одном запросе /run_tasks')
+    parser.add_argument('--idle-sec', type=float, default=2.0, help='длительность замера на холостом демоне')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--zygote', action='store_true', help='запускать задачи через зиготу')
+    parser.add_argument(
+        '--max-p99-increase-ms', type=float, default=50.0,
+        help='на сколько p99 во время всплеска может превышать p99 холостого демона',
+    )
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='agentd-bench-')
+    daemon = start_daemon(workdir, args.port, args.zygote)
+    url_prefix = 'http://localhost:%s' % args.port
+    poller = HealthPoller('%s/health' % url_prefix)
+    try:
+        poller.phase = 'idle'
+        poller.start()
+        time.sleep(args.idle_sec)
+
+        poller.phase = 'burst'
+        started_at = time.time()
+        spawned, rejected = burst(url_prefix, args.num, args.batch)
+        elapsed = time.time() - started_at
+        poller.stop()
+        poller.join()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('spawned %s tasks in %.2f sec, %s batches rejected with 503' % (spawned, elapsed, rejected))
+    print('%-8s %8s %10s %10s %10s %8s' % ('phase', 'requests', 'p50_ms', 'p99_ms', 'max_ms', 'errors'))
+    for phase in ('idle', 'burst'):
+        latencies = poller.latencies.get(phase, [])
+        print('%-8s %8s %10.2f %10.2f %10.2f %8s' % (
+            phase,
+            len(latencies),
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            max(latencies or [float('nan')]) * 1000,
+            poller.errors.get(phase, 0),
+        ))
+
+    idle_p99 = percentile(poller.latencies.get('idle', []), 0.99) * 1000
+    burst_p99 = percentile(poller.latencies.get('burst', []), 0.99) * 1000
+    if not burst_p99 <= idle_p99 + args.max_p99_increase_ms:
+        sys.stderr.write('FAIL: /health p99 during the burst is %.2f ms, idle p99 is %.2f ms (allowed +%.2f ms)\n' % (
+            burst_p99, idle_p99, args.max_p99_increase_ms,
+        ))
+        sys.exit(1)
+    print('OK: /health p99 during the burst is within +%.2f ms of idle' % args.max_p99_increase_ms)
+
+
+if __name__ == '__main__':
+    main()
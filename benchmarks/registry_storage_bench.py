@@ -0,0 +1,140 @@
+# coding: utf-8
+"""Сравнение хранилищ реестра процессов: TinyDB 3.3 (JSONStorage) и журнал с group commit
+
+Моделируется всплеск из N процессов: сначала N раз spawn (insert в waiting), затем N раз
+register (перенос из waiting в running), затем N раз unlink (удаление из running). Для каждой
+фазы печатается пропускная способность в операциях в секунду.
+
+Для журнала --batch задает количество изменений, попадающих в один group commit, т.е. сколько
+запросов обрабатывается за одну итерацию ioloop. --batch 1 -- худший случай (fsync на каждое изменение).
+
+Запуск:
+    $ python benchmarks/registry_storage_bench.py --num 2000 --batch 50
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinydb import TinyDB, Query  # noqa: E402
+
+from registry import ProcessRegistry  # noqa: E402
+
+q = Query()
+
+
+def make_record(pid):
+    return {
+        'pid': pid,
+        'cmd': 'worker',
+        'args': [],
+        'kwargs': {'name': 'w%s' % pid},
+        'spawned_at': time.time(),
+        'host': 'localhost',
+    }
+
+
+class TinyDBOperations(object):
+    """Операции менеджера процессов в том виде, как они выполнялись поверх TinyDB"""
+    def __init__(self, db):
+        self.waiting = db.table('waiting')
+        self.running = db.table('running')
+
+    def spawn(self, pid):
+        self.waiting.insert(make_record(pid))
+
+    def register(self, pid):
+        record = self.waiting.get(q.pid == pid)
+        self.waiting.remove(q.pid == pid)
+        if not self.running.contains(q.pid == pid):
+            self.running.insert(record)
+
+    def unlink(self, pid):
+        self.running.get(q.pid == pid)
+        self.running.remove(q.pid == pid)
+
+
+class RegistryOperations(object):
+    """Операции менеджера процессов поверх registry.ProcessRegistry"""
+    def __init__(self, registry):
+        self.registry = registry
+
+    def spawn(self, pid):
+        self.registry.waiting.insert(make_record(pid))
+
+    def register(self, pid):
+        if not self.registry.running.contains(pid):
+            self.registry.move(pid, 'waiting', 'running')
+
+    def unlink(self, pid):
+        self.registry.running.get(pid)
+        self.registry.running.remove(pid)
+
+
+def run_phases(operations, num, commit):
+    """Прогон трех фаз, commit(i) вызывается после каждого изменения"""
+    timings = []
+    for phase in ('spawn', 'register', 'unlink'):
+        operation = getattr(operations, phase)
+        started_at = time.time()
+        for pid in range(num):
+            operation(pid)
+            commit(pid)
+        timings.append((phase, time.time() - started_at))
+
+    return timings
+
+
+def bench_tinydb(folder, num):
+    db = TinyDB(os.path.join(folder, 'tinydb.json'))
+    try:
+        return run_phases(TinyDBOperations(db), num, commit=lambda i: None)
+    finally:
+        db.close()
+
+
+def bench_journal(folder, num, batch, fsync):
+    registry = ProcessRegistry(
+        db_path=os.path.join(folder, 'db.json'),
+        journal_path=os.path.join(folder, 'db.journal'),
+        fsync=fsync,
+    )
+
+    def commit(i):
+        if (i + 1) % batch == 0:
+            registry.journal.flush()
+
+    try:
+        return run_phases(RegistryOperations(registry), num, commit=commit)
+    finally:
+        registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num', type=int, default=500, help='количество процессов во всплеске')
+    parser.add_argument('--batch', type=int, default=20, help='изменений на один group commit')
+    parser.add_argument('--no-fsync', action='store_true', help='не вызывать fsync в журнале')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='agentd_bench_')
+    try:
+        results = [
+            ('tinydb', bench_tinydb(folder, args.num)),
+            ('journal', bench_journal(folder, args.num, args.batch, fsync=not args.no_fsync)),
+        ]
+    finally:
+        shutil.rmtree(folder)
+
+    print('%-10s %-10s %12s %10s' % ('backend', 'phase', 'ops/sec', 'sec'))
+    for backend, timings in results:
+        for phase, elapsed in timings:
+            print('%-10s %-10s %12.0f %10.3f' % (backend, phase, args.num / elapsed, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# coding: utf-8
+"""Скорость порождения задач: multiprocessing.Process из демона против зиготы (zygote.Zygote)
+
+Зигота запускается до того, как процесс бенчмарка "обрастает" памятью (--heap-mb), как это
+происходит с демоном, который запускает зиготу до открытия сокетов и работы с реестром.
+Затем N раз порождается процесс с пустой задачей, и печатается количество запусков в секунду
+и средняя задержка одного запуска.
+
+Запуск:
+    $ python benchmarks/spawn_bench.py --num 500 --heap-mb 200
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from task_catalog import TaskLoader  # noqa: E402
+from zygote import Zygote  # noqa: E402
+
+
+def noop():
+    pass
+
+
+def bench_multiprocessing(num):
+    processes = []
+    started_at = time.time()
+    for _ in range(num):
+        process_ = multiprocessing.Process(target=noop)
+        process_.start()
+        processes.append(process_)
+    elapsed = time.time() - started_at
+
+    for process_ in processes:
+        process_.join()
+
+    return elapsed
+
+
+def bench_zygote(zygote, num):
+    started_at = time.time()
+    for _ in range(num):
+        pid, channel_fd, output_fd = zygote.spawn(cmd='noop', path='__main__:noop', args=[], kwargs={})
+        os.close(channel_fd)
+        os.close(output_fd)
+    return time.time() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num', type=int, default=300, help='количество запусков')
+    parser.add_argument('--heap-mb', type=int, default=100, help='объем памяти родителя на момент запусков')
+    args = parser.parse_args()
+
+    zygote = Zygote(loader=TaskLoader())
+    zygote.start()
+
+    # имитация памяти, накопленной демоном
+    heap = [bytearray(1024 * 1024) for _ in range(args.heap_mb)]
+
+    try:
+        results = [
+            ('multiprocessing', bench_multiprocessing(args.num)),
+            ('zygote', bench_zygote(zygote, args.num)),
+        ]
+    finally:
+        zygote.stop()
+        del heap
+
+    print('%-16s %12s %14s' % ('mode', 'spawns/sec', 'latency_ms'))
+    for mode, elapsed in results:
+        print('%-16s %12.0f %14.3f' % (mode, args.num / elapsed, elapsed / args.num * 1000))
+
+
+if __name__ == '__main__':
+    main()
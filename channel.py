@@ -0,0 +1,104 @@
+# coding: utf-8
+import errno
+import json
+import os
+
+import tornado.ioloop
+
+from utils import set_nonblocking
+
+CHANNEL_FD_ENV = 'AGENTD_CHANNEL_FD'
+
+
+class ChildChannel(object):
+    """Канал задачи к демону (сторона задачи)
+
+    При запуске задачи демон создает pipe, пишущий конец которого наследуется задачей, а номер
+    дескриптора передается в переменной окружения AGENTD_CHANNEL_FD. Сообщения -- json строки
+    вида {"op": "register"}, pid отправителя демону известен по самому каналу. Сообщение короче
+    PIPE_BUF, поэтому записывается в pipe атомарно одним вызовом write.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def send(self, op):
+        data = json.dumps({'op': op}) + '\n'
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def close(self):
+        os.close(self.fd)
+
+
+_child_channel = None
+
+
+def get_child_channel():
+    """Канал текущей задачи или None, если процесс запущен не демоном (или без канала)"""
+    global _child_channel
+
+    fd = os.environ.get(CHANNEL_FD_ENV)
+    if fd is None:
+        return None
+
+    if _child_channel is None or _child_channel.fd != int(fd):
+        _child_channel = ChildChannel(int(fd))
+
+    return _child_channel
+
+
+class ChannelReader(object):
+    """Чтение канала задачи в ioloop демона (сторона демона)
+
+    Читающий конец pipe переводится в неблокирующий режим и регистрируется в ioloop.
+    Каждое полученное сообщение передается в on_message(pid, message). Когда задача
+    закрывает канал (в том числе при завершении), дескриптор снимается с ioloop и закрывается.
+    """
+    def __init__(self, pid, fd, on_message, ioloop=None):
+        self.pid = pid
+        self.fd = fd
+        self.on_message = on_message
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._buf = ''
+
+    def start(self):
+        set_nonblocking(self.fd)
+        self.ioloop.add_handler(self.fd, self._handle_read, tornado.ioloop.IOLoop.READ)
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        self.ioloop.remove_handler(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+    def drain(self):
+        """Чтение и обработка всех сообщений, уже находящихся в канале"""
+        if self.fd is not None:
+            self._handle_read(self.fd, tornado.ioloop.IOLoop.READ)
+
+    # noinspection PyUnusedLocal
+    def _handle_read(self, fd, events):
+        closed = False
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+
+            if not chunk:
+                closed = True
+                break
+            self._buf += chunk
+
+        lines = self._buf.split('\n')
+        self._buf = lines.pop()
+        for line in lines:
+            self.on_message(self.pid, json.loads(line))
+
+        if closed:
+            self.close()
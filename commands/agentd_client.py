@@ -0,0 +1,141 @@
+# coding: utf-8
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse, unquote
+# noinspection PyUnresolvedReferences
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+# noinspection PyUnresolvedReferences
+from requests.packages.urllib3.util.retry import Retry
+from requests_unixsocket.adapters import UnixHTTPConnection
+
+from settings import client_connect_timeout, client_read_timeout, client_retries, client_pool_maxsize
+from utils import msgpack, JSON_CONTENT_TYPE, MSGPACK_CONTENT_TYPE
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    """Пул соединений с unix сокетом с настраиваемым размером"""
+    def __init__(self, socket_url, timeout, maxsize):
+        HTTPConnectionPool.__init__(self, 'localhost', timeout=timeout, maxsize=maxsize)
+        self.socket_url = socket_url
+
+    def _new_conn(self):
+        return UnixHTTPConnection(self.socket_url, self.timeout.connect_timeout)
+
+
+class PooledUnixAdapter(HTTPAdapter):
+    """Адаптер requests для схемы http+unix с переиспользованием соединений
+
+    requests_unixsocket.UnixAdapter создает новый пул (и новое соединение) на каждый запрос,
+    здесь же пул создается один раз на каждый путь к сокету.
+    """
+    def __init__(self, pool_maxsize, max_retries):
+        super(PooledUnixAdapter, self).__init__(max_retries=max_retries)
+        self._pool_maxsize = pool_maxsize
+        self._unix_pools = {}
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+        pool = self._unix_pools.get(socket_path)
+        if pool is None:
+            pool = UnixHTTPConnectionPool(url, timeout=None, maxsize=self._pool_maxsize)
+            self._unix_pools[socket_path] = pool
+
+        return pool
+
+    def close(self):
+        for pool in self._unix_pools.values():
+            pool.close()
+        self._unix_pools.clear()
+        super(PooledUnixAdapter, self).close()
+
+
+class AgentdClient(object):
+    """Клиент API демонов agentd
+
+    Держит пулы keep-alive соединений на каждый хост (tcp) и на каждый unix сокет, так что
+    серия запросов к одному демону не платит за установку соединения. Для всех запросов
+    выставляются таймауты на соединение и на чтение ответа.
+
+    Повторы ограничены retries: ошибки соединения повторяются для любых запросов (запрос
+    до демона не дошел), ошибки чтения -- только для идемпотентных методов (GET), чтобы
+    не запустить задачу дважды.
+
+    Если установлен пакет msgpack, то ответы запрашиваются в нем (заголовок Accept),
+    разбирать ответ нужно через decode_response.
+    """
+    def __init__(
+        self,
+        connect_timeout=client_connect_timeout,
+        read_timeout=client_read_timeout,
+        retries=client_retries,
+        pool_maxsize=client_pool_maxsize,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        max_retries = Retry(total=retries, connect=retries, read=retries, backoff_factor=0.1)
+
+        self.session = requests.Session()
+        tcp_adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=max_retries)
+        self.session.mount('http://', tcp_adapter)
+        self.session.mount('https://', tcp_adapter)
+        self.session.mount('http+unix://', PooledUnixAdapter(pool_maxsize=pool_maxsize, max_retries=max_retries))
+        if msgpack is not None:
+            self.session.headers['Accept'] = '%s, %s' % (MSGPACK_CONTENT_TYPE, JSON_CONTENT_TYPE)
+
+    def get(self, url, params=None, timeout=None):
+        """
+        :param timeout: float, если указан, то ограничивает таймаут чтения ответа
+        """
+        return self.session.get(url, params=params, timeout=self._get_timeout(timeout))
+
+    def stream(self, url, params=None, read_timeout=None):
+        """Потоковый GET запрос (тело ответа читается по мере поступления)
+
+        :param read_timeout: float, таймаут чтения очередной порции ответа
+        """
+        timeout = (self.timeout[0], read_timeout)
+        return self.session.get(url, params=params, timeout=timeout, stream=True)
+
+    def post(self, url, json=None):
+        return self.session.post(url, json=json, timeout=self.timeout)
+
+    def _get_timeout(self, timeout):
+        if timeout is None:
+            return self.timeout
+
+        connect_timeout, read_timeout = self.timeout
+        return min(connect_timeout, timeout), min(read_timeout, timeout)
+
+    def close(self):
+        self.session.close()
+
+
+def decode_response(response):
+    """Тело ответа демона (json или msgpack, по Content-Type)
+
+    :param response: requests.Response
+    :return: dict
+    """
+    if response.headers.get('Content-Type', '').startswith(MSGPACK_CONTENT_TYPE):
+        return msgpack.unpackb(response.content, raw=False)
+
+    return response.json()
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """Общий клиент текущего процесса
+
+    Соединения не должны разделяться между процессами, поэтому после fork создается новый клиент.
+    """
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        _client = AgentdClient()
+        _client_pid = os.getpid()
+
+    return _client
@@ -1,16 +1,46 @@
+# coding: utf-8
+import errno
 import os
 from functools import wraps
 
-import requests
-import requests_unixsocket
-
+from channel import get_child_channel
+from commands.agentd_client import get_client
 from settings import unix_socket_url_prefix
 
 
+def _send_to_channel(channel, op):
+    """Отправка сообщения по каналу задачи
+
+    :return: False, если демон уже закрыл свой конец канала (например, остановлен
+        с сохранением задач)
+    """
+    try:
+        channel.send(op)
+    except OSError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        return False
+    return True
+
+
+def _send_to_daemon(op, handler):
+    """Отправка сообщения демону от имени текущего процесса
+
+    Если процесс запущен демоном, то сообщение уходит по унаследованному каналу
+    (channel.ChildChannel), иначе -- http запросом на unix сокет. Если канал закрыт
+    (задача пережила перезапуск демона), то сообщение тоже уходит http запросом:
+    новый демон не родитель задачи и не узнает о ее завершении иначе.
+    """
+    channel = get_child_channel()
+    if channel is not None and _send_to_channel(channel, op):
+        return
+
+    url = '%s/%s' % (unix_socket_url_prefix, handler)
+    get_client().post(url, json={'pid': os.getpid()})
+
+
 def unlink_as_successfully_completed():
-    url = '%s/unlink_process' % unix_socket_url_prefix
-    with requests_unixsocket.monkeypatch():
-        requests.post(url, json={'pid': os.getpid()})
+    _send_to_daemon('unlink', 'unlink_process')
 
 
 def unlink_at_exit(func):
@@ -23,12 +53,19 @@ def unlink_at_exit(func):
 
 
 def register_as_successfully_started():
-    url = '%s/register_process' % unix_socket_url_prefix
-    with requests_unixsocket.monkeypatch():
-        requests.post(url, json={'pid': os.getpid()})
+    _send_to_daemon('register', 'register_process')
+
+
+def send_heartbeat():
+    """Сообщение демону о том, что задача жива
+
+    Работает только по каналу задачи: если канал закрыт, то сообщение молча теряется.
+    """
+    channel = get_child_channel()
+    if channel is not None:
+        _send_to_channel(channel, 'heartbeat')
 
 
 def stop_registered_process(pid):
     url = '%s/stop_registered_process' % unix_socket_url_prefix
-    with requests_unixsocket.monkeypatch():
-        requests.post(url, json={'pid': pid})
+    get_client().post(url, json={'pid': pid})
@@ -1,28 +1,196 @@
-import requests
+# coding: utf-8
+import json
+import time
 
-from settings import local_host_prefix, hosts
+from concurrent.futures import ThreadPoolExecutor, wait
 
+from commands.agentd_client import get_client, decode_response
+from settings import local_host_prefix, hosts, fanout_deadline, fanout_max_workers, events_keepalive_sec
 
-def info(url_prefix=local_host_prefix):
-    response = requests.get('%s/info' % url_prefix)
-    return response.json()['response']
 
+def _join(items):
+    return None if items is None else ','.join(items)
 
-def cumulative_info():
-    full_table = {'running': {}, 'waiting': {}}
-    for host in hosts:
-        url = '%s/info' % host
-        response = requests.get(url)
-        host_info = response.json()['response']
+
+def info(url_prefix=local_host_prefix, cmd=None, states=None, fields=None, timeout=None):
+    """Данные о процессах демона, см. /info
+
+    :param cmd: str, только процессы с этой командой
+    :param states: список состояний (running, waiting, queued, exited)
+    :param fields: список полей записей
+    :param timeout: float, секунды
+    :return: dict
+    """
+    params = {'cmd': cmd, 'state': _join(states), 'fields': _join(fields)}
+    response = get_client().get('%s/info' % url_prefix, params=params, timeout=timeout)
+    response.raise_for_status()
+    return decode_response(response)['response']
+
+
+def _timed_info(host, deadline, **filters):
+    started_at = time.time()
+    host_info = info(url_prefix=host, timeout=deadline, **filters)
+    return host_info, time.time() - started_at
+
+
+def cumulative_info(hosts_list=None, deadline=fanout_deadline, cmd=None, states=None, fields=None):
+    """Данные о процессах со всех хостов
+
+    Хосты опрашиваются параллельно в пуле потоков, на весь опрос отводится deadline секунд.
+    Хосты, которые не ответили вовремя или ответили ошибкой, в таблицы процессов не попадают,
+    а их статус виден в поле hosts результата:
+
+        {
+            "running": {host: [...], ...},
+            "waiting": {host: [...], ...},
+            "exited": {host: [...], ...},
+            "hosts": {
+                host: {"ok": true, "latency_sec": 0.012, "error": null},
+                other_host: {"ok": false, "latency_sec": null, "error": "timeout"},
+                ...
+            }
+        }
+
+    Фильтры cmd, states и fields передаются в /info каждого хоста.
+
+    :param hosts_list: список адресов демонов, по умолчанию settings.hosts
+    :param deadline: float, секунды
+    :param cmd: str
+    :param states: list
+    :param fields: list
+    :return: dict
+    """
+    hosts_list = hosts if hosts_list is None else hosts_list
+    full_table = {'running': {}, 'waiting': {}, 'exited': {}, 'hosts': {}}
+    if not hosts_list:
+        return full_table
+
+    executor = ThreadPoolExecutor(max_workers=min(len(hosts_list), fanout_max_workers))
+    try:
+        future_to_host = {
+            executor.submit(_timed_info, host, deadline, cmd=cmd, states=states, fields=fields): host
+            for host in hosts_list
+        }
+        done, _ = wait(future_to_host, timeout=deadline)
+    finally:
+        executor.shutdown(wait=False)
+
+    for future, host in future_to_host.items():
+        if future not in done:
+            full_table['hosts'][host] = {'ok': False, 'latency_sec': None, 'error': 'timeout'}
+            continue
+
+        try:
+            host_info, latency = future.result()
+        except Exception as e:
+            full_table['hosts'][host] = {'ok': False, 'latency_sec': None, 'error': repr(e)}
+            continue
+
+        full_table['hosts'][host] = {'ok': True, 'latency_sec': latency, 'error': None}
         for process_type, process_list in host_info.items():
-            full_table[process_type][host] = process_list
+            full_table.setdefault(process_type, {})[host] = process_list
 
     return full_table
 
 
-def run_task(cmd, args=None, kwargs=None, url_prefix=local_host_prefix):
-    return requests.post(
-        '%s/run_task' % url_prefix,
-        json={'cmd': cmd, 'kwargs': kwargs or {}, 'args': args or []}
+def iter_events(url_prefix=local_host_prefix, since=None):
+    """События жизненного цикла процессов демона, см. /events
+
+    Генератор не завершается, пока демон не закроет соединение. Если keepalive от демона
+    не приходит дольше трех интервалов, то выбрасывается requests.exceptions.ConnectionError.
+
+    :param url_prefix: str
+    :param since: идентификатор последнего полученного события, с которого нужно продолжить
+    :return: генератор dict событий
+    """
+    response = get_client().stream(
+        '%s/events' % url_prefix, params={'since': since}, read_timeout=events_keepalive_sec * 3
     )
+    response.raise_for_status()
+    try:
+        for line in response.iter_lines():
+            if line.startswith('data:'):
+                yield json.loads(line[len('data:'):])
+    finally:
+        response.close()
+
+
+def logs(pid, tail=100, url_prefix=local_host_prefix, timeout=None):
+    """Последние tail строк вывода задачи, см. /logs
+
+    :return: список строк
+    """
+    response = get_client().get('%s/logs' % url_prefix, params={'pid': pid, 'tail': tail}, timeout=timeout)
+    response.raise_for_status()
+    return response.text.splitlines()
+
+
+def iter_logs(pid, tail=100, url_prefix=local_host_prefix):
+    """Вывод задачи по мере появления, см. /logs?follow=1
+
+    Генератор завершается вместе с задачей.
+
+    :return: генератор строк
+    """
+    response = get_client().stream('%s/logs' % url_prefix, params={'pid': pid, 'tail': tail, 'follow': 1})
+    response.raise_for_status()
+    try:
+        for line in response.iter_lines():
+            yield line
+    finally:
+        response.close()
+
+
+def run_task(cmd, args=None, kwargs=None, url_prefix=local_host_prefix, resources=None):
+    body = {'cmd': cmd, 'kwargs': kwargs or {}, 'args': args or []}
+    if resources is not None:
+        body['resources'] = resources
+    return get_client().post('%s/run_task' % url_prefix, json=body)
+
+
+def run_tasks(tasks, url_prefix=local_host_prefix):
+    """Запуск пачки задач одним запросом
+
+    :param tasks: список dict вида {"cmd": ..., "args": [...], "kwargs": {...}, "resources": {...}}
+    :param url_prefix: str
+    :return: список pid в порядке tasks, None для задач, которые запустить не удалось
+    """
+    response = get_client().post('%s/run_tasks' % url_prefix, json={'tasks': tasks})
+    response.raise_for_status()
+    return decode_response(response)['response']
+
+
+def run_task_on_hosts(cmd, host_to_kwargs, deadline=fanout_deadline):
+    """Параллельный запуск задачи cmd на нескольких хостах, на каждом со своими kwargs
+
+    :param cmd: str
+    :param host_to_kwargs: dict, хост -> kwargs задачи
+    :param deadline: float, секунды
+    :return: dict, хост -> None при успехе или описание ошибки
+    """
+    if not host_to_kwargs:
+        return {}
+
+    executor = ThreadPoolExecutor(max_workers=min(len(host_to_kwargs), fanout_max_workers))
+    try:
+        future_to_host = {
+            executor.submit(run_task, cmd=cmd, kwargs=kwargs, url_prefix=host): host
+            for host, kwargs in host_to_kwargs.items()
+        }
+        done, _ = wait(future_to_host, timeout=deadline)
+    finally:
+        executor.shutdown(wait=False)
+
+    errors = {}
+    for future, host in future_to_host.items():
+        if future not in done:
+            errors[host] = 'timeout'
+            continue
+
+        try:
+            future.result().raise_for_status()
+            errors[host] = None
+        except Exception as e:
+            errors[host] = repr(e)
 
+    return errors
@@ -0,0 +1,134 @@
+# coding: utf-8
+import json
+import time
+from collections import deque
+
+from utils import random_string
+
+
+class EventBus(object):
+    """Поток событий жизненного цикла процессов
+
+    Менеджер процессов публикует сюда события spawn, register, unlink, kill, exit, heartbeat, resources,
+    expire (процесс не зарегистрировался вовремя и убран из waiting), remove (процесс убран из waiting
+    по другой причине, например, остановлен через /kill_waiting_process), а также enqueue и dequeue
+    (задача поставлена в очередь запуска и извлечена из нее).
+    Каждое событие получает порядковый номер seq, последние history_size событий хранятся
+    в кольцевом буфере, чтобы переподключившийся подписчик мог дочитать пропущенное (since).
+
+    Номера событий начинаются заново при каждом старте демона, поэтому идентификатор события
+    для клиента включает эпоху: "<epoch>-<seq>". Если клиент просит события, которых уже
+    (или еще) нет в буфере, то он получает событие reset и должен перечитать /info.
+
+    Реплика менеджера в web процессе ведет копию потока (mirror) с теми же идентификаторами,
+    поэтому клиент может переподключиться к любому web процессу.
+
+    События resources (потребление CPU и памяти всеми процессами, см. resources.ResourceSampler)
+    получают номер, но не хранятся в буфере: каждое следующее заменяет предыдущее, а хранение
+    снимков по тысячам процессов вытеснило бы из буфера остальные события.
+
+    Event example:
+        {
+            "id": "kqzjcmax-42",
+            "seq": 42,
+            "type": "exit",
+            "time": 1498761999.123456,
+            "pid": 123,
+            "data": {"cmd": "worker", ..., "returncode": -15, "signal": 15}
+        }
+    """
+    types = (
+        'spawn', 'register', 'unlink', 'kill', 'expire', 'remove', 'exit', 'heartbeat', 'resources', 'enqueue', 'dequeue',
+    )
+    transient_types = ('resources',)
+
+    def __init__(self, history_size=10000):
+        self.epoch = random_string(8)
+        self.seq = 0
+        self.history = deque(maxlen=history_size)
+        self._subscribers = []
+
+    def publish(self, type_, pid, data=None):
+        self.seq += 1
+        event = {
+            'id': '%s-%s' % (self.epoch, self.seq),
+            'seq': self.seq,
+            'type': type_,
+            'time': time.time(),
+            'pid': pid,
+            'data': data,
+        }
+        self._notify(event)
+
+    def mirror(self, event):
+        """Добавление события из другого потока (с его номером)"""
+        self.seq = event['seq']
+        self._notify(event)
+
+    def reset(self, epoch, seq):
+        """Переход к другой эпохе: история очищается, подписчики получают событие reset"""
+        self.epoch = epoch
+        self.seq = seq
+        self.history.clear()
+
+        reset_event = self.reset_event()
+        for callback in list(self._subscribers):
+            callback(reset_event)
+
+    def _notify(self, event):
+        if event['type'] not in self.transient_types:
+            self.history.append(event)
+        for callback in list(self._subscribers):
+            callback(event)
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def parse_id(self, event_id):
+        """Номер события по идентификатору "<epoch>-<seq>" или просто seq
+
+        :return: int или None, если идентификатор относится к другой эпохе
+        :raise ValueError: если идентификатор некорректный
+        """
+        epoch, _, seq = event_id.rpartition('-')
+        if epoch and epoch != self.epoch:
+            return None
+
+        return int(seq)
+
+    def since(self, seq):
+        """События после события с номером seq
+
+        :param seq: int
+        :return: список событий или None, если часть из них уже вытеснена из буфера
+        """
+        if seq > self.seq:
+            return None
+
+        first_seq = self.history[0]['seq'] if self.history else self.seq + 1
+        if seq < first_seq - 1:
+            return None
+
+        return [event for event in self.history if event['seq'] > seq]
+
+    def reset_event(self):
+        """Событие reset: предыдущие события потеряны, состояние нужно перечитать целиком"""
+        return {
+            'id': '%s-%s' % (self.epoch, self.seq),
+            'seq': self.seq,
+            'type': 'reset',
+            'time': time.time(),
+            'pid': None,
+            'data': None,
+        }
+
+
+def format_sse(event):
+    """Событие в формате server-sent events"""
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (
+        event['id'], event['type'], json.dumps(event, separators=(',', ':'))
+    )
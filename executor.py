@@ -0,0 +1,42 @@
+# coding: utf-8
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorBusy(Exception):
+    """Очередь пула переполнена. Обработчики http запросов отвечают на нее 503"""
+    pass
+
+
+class BoundedExecutor(object):
+    """Пул потоков с ограниченной очередью
+
+    Блокирующая работа (порождение задач через зиготу, опрос хостов и т.п.) выполняется
+    в пуле, чтобы не останавливать ioloop. Если в пуле уже max_pending невыполненных
+    заданий, то submit сразу бросает ExecutorBusy, а не копит очередь: клиент получает 503
+    и может повторить запрос позже, а задержка уже принятых запросов не растет.
+    """
+    def __init__(self, max_workers, max_pending):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise ExecutorBusy('%s tasks pending' % self.pending)
+            self.pending += 1
+
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    # noinspection PyUnusedLocal
+    def _on_done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,124 @@
+# coding: utf-8
+import os
+import signal
+import sys
+import traceback as tb
+
+from channel import CHANNEL_FD_ENV
+from placement import apply_resources
+
+
+def _close_inherited_fds(keep_fds):
+    """Закрытие в дочернем процессе всех дескрипторов, кроме stdin, stdout, stderr и keep_fds
+
+    Открытые дескрипторы берутся из /proc/self/fd (если его нет -- перебираются все возможные).
+    """
+    try:
+        fds = [int(name) for name in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+
+    for fd in fds:
+        if fd > 2 and fd not in keep_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass    # например, дескриптор самого /proc/self/fd, уже закрытый listdir
+
+
+def fork_task(callable_, args, kwargs, keep_fds=(), env=None, resources=None, output_fd=None):
+    """Порождает процесс, выполняющий callable_(*args, **kwargs), и возвращает его pid
+
+    В дочернем процессе обработчики сигналов возвращаются к поведению по умолчанию
+    (обработчики родителя, например ioloop.stop() демона, задаче не нужны), закрываются
+    все дескрипторы родителя, кроме keep_fds и output_fd (задача выполняется без exec, так что
+    иначе ей достались бы слушающие сокеты, журнал, epoll и концы каналов других задач демона),
+    stdin перенаправляется в /dev/null, а stdout и stderr -- в output_fd
+    (если он передан). Процесс завершается через
+    os._exit с кодом 0 при успешном выполнении задачи и 1 при исключении (traceback
+    пишется в stderr), SystemExit обрабатывается так же, как в multiprocessing.
+
+    Ограничения resources (привязка к процессорам, nice, rlimit, см. placement.apply_resources)
+    применяются в дочернем процессе до запуска задачи; если применить их не удалось, задача
+    не запускается и процесс завершается с кодом 1.
+
+    :param callable_: задача
+    :param args: list
+    :param kwargs: dict
+    :param keep_fds: дескрипторы родителя, которые должны остаться открытыми в задаче
+    :param env: dict, переменные окружения, которые нужно выставить в задаче
+    :param resources: dict, описание ресурсов задачи (см. placement.validate_resources)
+    :param output_fd: пишущий конец pipe для вывода задачи (см. output.TaskOutput)
+    :return: int
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exitcode = 1
+    # noinspection PyBroadException
+    try:
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+
+        _close_inherited_fds(set(keep_fds) | {output_fd})
+
+        os.environ.update(env or {})
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+
+        if output_fd is not None:
+            os.dup2(output_fd, 1)
+            os.dup2(output_fd, 2)
+            os.close(output_fd)
+
+        if resources:
+            apply_resources(resources)
+
+        callable_(*args, **kwargs)
+        exitcode = 0
+    except SystemExit as e:
+        if not e.args or e.args[0] is None:
+            exitcode = 0
+        elif isinstance(e.args[0], int):
+            exitcode = e.args[0]
+        else:
+            sys.stderr.write(str(e.args[0]) + '\n')
+    except BaseException:
+        sys.stderr.write(tb.format_exc())
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exitcode)
+
+
+def fork_task_with_channel(callable_, args, kwargs, resources=None):
+    """Порождает процесс задачи вместе с каналом для сообщений от нее (см. channel.ChildChannel)
+    и pipe, в который направлены ее stdout и stderr
+
+    :return: (pid, читающий конец канала, читающий конец pipe вывода)
+    """
+    channel_fd, child_fd = os.pipe()
+    output_fd, child_output_fd = os.pipe()
+    try:
+        pid = fork_task(
+            callable_, args, kwargs,
+            keep_fds=(child_fd,),
+            env={CHANNEL_FD_ENV: str(child_fd)},
+            resources=resources,
+            output_fd=child_output_fd,
+        )
+    except Exception:
+        os.close(channel_fd)
+        os.close(output_fd)
+        raise
+    finally:
+        os.close(child_fd)
+        os.close(child_output_fd)
+
+    return pid, channel_fd, output_fd
@@ -0,0 +1,117 @@
+# coding: utf-8
+import json
+import os
+
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Journal(object):
+    """Журнал изменений реестра процессов (append-only)
+
+    Каждое изменение таблиц записывается в конец файла журнала одной компактной
+    json строкой. Записи, накопленные за одну итерацию ioloop, сбрасываются на диск
+    одним вызовом write + fsync (group commit): первый append в итерации планирует
+    flush на следующую итерацию, остальные просто дописываются в буфер.
+
+    Когда в журнале накапливается compact_threshold записей, вызывается compact_callback:
+    владелец журнала сохраняет снимок своего состояния и обрезает журнал через checkpoint.
+
+    С флагом background запись на диск (write, fsync, сохранение снимка) выполняется
+    в отдельном потоке, чтобы медленный диск не останавливал ioloop. Поток один, поэтому
+    порядок записей и снимков сохраняется.
+
+    При аварийном завершении последняя строка журнала может оказаться недописанной,
+    такая строка при чтении игнорируется.
+    """
+    def __init__(
+        self, path, compact_threshold=10000, compact_callback=None, fsync=True, background=False, ioloop=None
+    ):
+        self.path = path
+        self.compact_threshold = compact_threshold
+        self.compact_callback = compact_callback
+        self.fsync = fsync
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._writer = ThreadPoolExecutor(max_workers=1) if background else None
+
+        self._pending = []
+        self._flush_scheduled = False
+        self._entries_num = 0
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def read(self):
+        """Чтение всех записей журнала
+
+        :return: list
+        """
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break   # недописанный хвост после аварийного завершения
+
+        self._entries_num = len(entries)
+        return entries
+
+    def append(self, entry):
+        self._pending.append(json.dumps(entry, separators=(',', ':')))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.ioloop.add_callback(self.flush)
+
+    def flush(self):
+        """Сброс накопленных записей на диск одним write + fsync"""
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+
+        data = '\n'.join(self._pending) + '\n'
+        self._entries_num += len(self._pending)
+        self._pending = []
+        self._run(self._write, data)
+
+        if self.compact_callback is not None and self._entries_num >= self.compact_threshold:
+            self.compact_callback()
+
+    def checkpoint(self, save_snapshot):
+        """Сохранение снимка состояния владельца и очистка журнала
+
+        save_snapshot вызывается после записи всех уже сброшенных записей, затем журнал
+        обрезается. Снимок уже содержит все изменения, поэтому еще не сброшенные записи
+        отбрасываются. Повторное применение журнала поверх снимка безопасно, т.к. все операции
+        идемпотентны.
+
+        :param save_snapshot: callable без аргументов
+        """
+        self._pending = []
+        self._entries_num = 0
+        self._run(self._checkpoint, save_snapshot)
+
+    def _run(self, fn, *args):
+        if self._writer is None:
+            fn(*args)
+            return
+
+        # ошибки записи попадают в лог ioloop
+        self.ioloop.add_future(self._writer.submit(fn, *args), lambda future: future.result())
+
+    def _write(self, data):
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def _checkpoint(self, save_snapshot):
+        save_snapshot()
+        os.ftruncate(self._fd, 0)
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+        os.close(self._fd)
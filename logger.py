@@ -1,33 +1,248 @@
 # coding=utf-8
+import atexit
 import logging
 import os
+import threading
+import time
+import traceback
+from collections import deque
 
-from settings import log_folder
+from settings import log_folder, log_async, log_queue_size, log_batch_size, log_flush_interval_sec, \
+    log_max_bytes, log_backup_count, log_rotate_interval_sec
 
 
-class StreamToLogger(object):
+class AsyncFileHandler(logging.Handler):
+    """Запись логов в файл фоновым потоком (log_writer) пачками
+
+    emit только фиксирует сообщение записи и кладет ее в очередь в памяти, форматирование
+    и запись в файл выполняются в потоке LogWriter: раз в flush_interval секунд или раньше,
+    если в очереди набралось batch_size записей, все накопленное пишется одним os.write.
+    Очередь ограничена max_queue записями: при переполнении новые записи отбрасываются,
+    а в файл затем пишется, сколько их было отброшено.
+
+    Файл открывается на дозапись (O_APPEND) и ротируется по размеру (max_bytes) и/или по времени
+    (rotate_interval): текущий файл переименовывается в <имя>.1, <имя>.1 -- в <имя>.2 и т.д.,
+    хранится backup_count старых файлов. Ротирует только процесс-супервизор, web процессы
+    (см. LogWriter.start) замечают ротацию по смене inode и переоткрывают файл.
+
+    Обработчик без блокировок и не держит буферов файла, поэтому он безопасен при fork:
+    в процессе, где поток записи не запущен (задачи, зигота), записи пишутся в файл сразу.
+    Один обработчик на файл разделяется всеми логгерами, которые в него пишут.
     """
-    Fake file-like stream object that redirects writes to a logger instance.
+    def __init__(self, path, max_queue=10000, max_bytes=0, backup_count=0, rotate_interval=None):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.max_queue = max_queue
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.rotate = True
+        self.dropped = 0
+        self._queue = deque()
+        self._fd = None
+        self._rollover_at = None
+
+    def createLock(self):
+        # emit сводится к добавлению в deque, которое атомарно; без блокировки fork не может
+        # унаследовать ее захваченной
+        self.lock = None
+
+    def emit(self, record):
+        if log_writer.pid != os.getpid():
+            self._write([self.format(record)])
+            return
+
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        # сообщение и traceback фиксируются сразу: аргументы записи могут измениться до ее записи в файл
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = (self.formatter or logging._defaultFormatter).formatException(record.exc_info)
+            record.exc_info = None
+        self._queue.append(record)
+        if len(self._queue) >= log_writer.batch_size:
+            log_writer.wakeup()
+
+    def reset(self):
+        """Сброс очереди, унаследованной от родительского процесса (ее записи пишет он)"""
+        self._queue = deque()
+        self.dropped = 0
+
+    def flush(self):
+        if log_writer.pid == os.getpid():
+            log_writer.flush()
+
+    def drain(self):
+        """Запись накопленных записей в файл (вызывается из потока LogWriter)"""
+        lines = []
+        while self._queue:
+            lines.append(self.format(self._queue.popleft()))
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append('%s - %d log records dropped, the log queue is full' % (
+                time.strftime('%Y-%m-%d %H:%M:%S'), dropped
+            ))
+
+        if lines:
+            self._write(lines)
+        elif self._fd is not None and self._should_rotate(0):
+            # в файл пишут и web процессы, поэтому размер проверяется и без своих записей
+            self._rotate()
+
+    def _write(self, lines):
+        data = ''.join((line.encode('utf-8') if isinstance(line, unicode) else line) + '\n' for line in lines)
+
+        if self._fd is None:
+            self._open()
+        elif self._should_rotate(len(data)):
+            self._rotate()
+        elif not self.rotate and log_writer.pid == os.getpid():
+            self._reopen_if_rotated()
+
+        os.write(self._fd, data)
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._rollover_at = time.time() + self.rotate_interval if self.rotate_interval else None
+
+    def _should_rotate(self, num_bytes):
+        if not self.rotate or log_writer.pid != os.getpid():
+            return False
+        if self.max_bytes:
+            size = os.fstat(self._fd).st_size
+            if size and size + num_bytes > self.max_bytes:
+                return True
+        return self._rollover_at is not None and time.time() >= self._rollover_at
+
+    def _rotate(self):
+        os.close(self._fd)
+        if self.backup_count:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = '%s.%d' % (self.path, index)
+                if os.path.exists(source):
+                    os.rename(source, '%s.%d' % (self.path, index + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
 
-    originally taken from
-    https://www.electricmonk.nl/log/2011/08/14/redirect-stdout-and-stderr-to-a-logger-in-python/
+    def _reopen_if_rotated(self):
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self._fd).st_ino
+        except OSError:
+            rotated = True
+        if rotated:
+            os.close(self._fd)
+            self._open()
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+
+class LogWriter(object):
+    """Фоновый поток, который пишет в файлы записи всех AsyncFileHandler
+
+    Пока поток не запущен (start) в текущем процессе, обработчики пишут в файл сразу.
+    При завершении процесса поток останавливается (stop, через atexit) до того, как интерпретатор
+    начнет разрушать модули.
     """
+    def __init__(self, batch_size=500, flush_interval=0.2):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.handlers = []
+        self.pid = None
+        self._wakeup = None
+        self._lock = None
+        self._thread = None
+
+    def register(self, handler):
+        self.handlers.append(handler)
 
-    def __init__(self, logger, log_level=logging.INFO):
-        self.logger = logger
-        self.log_level = log_level
-        self.linebuf = ''
+    def start(self, rotate=True):
+        """Запуск потока записи в текущем процессе
 
-    def write(self, buf):
-        # xxx: этот метод искажает traceback
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
+        В web процессе (после fork) очереди обработчиков, доставшиеся от супервизора, сбрасываются,
+        а файлы ротирует только супервизор (rotate=False).
+        """
+        for handler in self.handlers:
+            handler.reset()
+            handler.rotate = rotate
+
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Остановка потока записи и запись накопленного, дальше обработчики пишут в файл сразу"""
+        if self.pid != os.getpid():
+            return
+
+        self.pid = None
+        self._wakeup.set()
+        self._thread.join(self.flush_interval * 10)
+        self.flush()
+
+    def wakeup(self):
+        self._wakeup.set()
 
     def flush(self):
-        pass
+        with self._lock:
+            for handler in list(self.handlers):
+                # noinspection PyBroadException
+                try:
+                    handler.drain()
+                except Exception:
+                    traceback.print_exc()
+
+    def _run(self):
+        pid = self.pid
+        while self.pid == pid:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
 
-    def fileno(self):
-        return self.logger.handlers[0].stream.fileno()
+
+log_writer = LogWriter(batch_size=log_batch_size, flush_interval=log_flush_interval_sec)
+_async_handlers = {}
+
+
+def start_log_writer(rotate=True):
+    """Включение асинхронной записи логов в текущем процессе (если она разрешена settings.log_async)"""
+    if log_async:
+        log_writer.start(rotate=rotate)
+        atexit.register(log_writer.stop)
+
+
+def flush_logs():
+    """Запись накопленных логов, например перед os._exit, при котором atexit (logging.shutdown) не вызывается"""
+    if log_writer.pid == os.getpid():
+        log_writer.flush()
+
+
+def make_file_handler(path):
+    """Обработчик записи в файл path: асинхронный (один на файл) или обычный logging.FileHandler"""
+    if not log_async:
+        return logging.FileHandler(path)
+
+    handler = _async_handlers.get(path)
+    if handler is None:
+        handler = AsyncFileHandler(
+            path,
+            max_queue=log_queue_size,
+            max_bytes=log_max_bytes,
+            backup_count=log_backup_count,
+            rotate_interval=log_rotate_interval_sec,
+        )
+        _async_handlers[path] = handler
+        log_writer.register(handler)
+    return handler
 
 
 def setup_tornado_loggers():
@@ -49,7 +264,7 @@ def set_root_handler(logger):
     """Установка основного хендлера для логов. Для удобства все логи аккуммулируются в одном файле.
 
     """
-    root_handler = logging.FileHandler(make_log_path('all'))
+    root_handler = make_file_handler(make_log_path('all'))
 
     function_info_str = (
         '- [%(filename)s:%(lineno)s '
@@ -82,7 +297,7 @@ def create_logger(logger_name, level=logging.INFO):
 
     custom_handler_name = '%s_file_handler' % logger_name
     if custom_handler_name not in handler_names:
-        custom_handler = logging.FileHandler(make_log_path(logger_name))
+        custom_handler = make_file_handler(make_log_path(logger_name))
         formatter = logging.Formatter(
             '%(asctime)s '
             '- %(levelname)s '
@@ -1,26 +1,128 @@
 # coding: utf-8
-import logging
-import multiprocessing
 import os
 import signal
-import sys
+import time
 import traceback as tb
+from collections import deque, OrderedDict, Counter
+
+import tornado.ioloop
+from tornado import gen
+
+from admission import RunQueue
+from channel import ChannelReader
+from events import EventBus
+from executor import BoundedExecutor
+from forking import fork_task_with_channel
+from logger import create_logger
+from metrics import metrics_registry
+from placement import AUTO_SPREAD, CoreAllocator, get_cpu_affinity, set_cpu_affinity
+from resources import ResourceSampler, is_same_process
+from settings import task_output_folder, task_catalog_module, task_reload_interval_sec
+from models import Process as ProcessModel
+from output import TaskOutput
+from task_catalog import TaskCatalog, TaskCatalogError, TaskLoader
+from watchdog import Watchdog
+
+spawn_seconds = metrics_registry.histogram(
+    'agentd_spawn_seconds',
+    'Time to fork a task process',
+    labelnames=('mode',),
+    labelvalues=[('direct',), ('zygote',)],
+)
+registration_seconds = metrics_registry.histogram(
+    'agentd_registration_seconds',
+    'Time from spawn to registration of a task (waiting to running)',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+reaped_total = metrics_registry.counter(
+    'agentd_reaped_total',
+    'Reaped task processes by outcome',
+    labelnames=('result',),
+    labelvalues=[('ok',), ('error',), ('signal',)],
+)
+registration_expired_total = metrics_registry.counter(
+    'agentd_registration_expired_total',
+    'Task processes killed for not registering within the registration timeout',
+)
+
+REGISTRATION_TIMEOUT = 'registration_timeout'
+KILLED = 'killed'
+STOPPED = 'stopped'
+DUPLICATE = 'duplicate'
+LOST = 'lost'
+
+
+class ProcessInfoMixin(object):
+    """Чтение таблиц процессов для /info
+
+    Требует атрибутов running и waiting (registry.Table), exited (последовательность
+    записей о завершившихся процессах), queued (записи очереди запуска в порядке запуска,
+    см. admission.RunQueue), _heartbeats (pid -> время последнего heartbeat)
+    и _resources (pid -> (загрузка CPU в процентах, rss в байтах)).
+    Используется менеджером процессов и его репликой в web процессах (replica.ProcessReplica).
+    """
+    states = ('running', 'waiting', 'queued', 'exited')
 
-from tinydb import TinyDB, Query
+    def info(self, cmd=None, states=None, fields=None, offset=0, limit=None):
+        """Данные о процессах в таблицах running и waiting, о задачах в очереди запуска, а также
+        о недавно завершившихся процессах
 
-from logger import create_logger, StreamToLogger
-from models import Process as ProcessModel
+        Фильтрация по cmd выполняется по индексу реестра, пагинация применяется к каждому
+        состоянию отдельно, а данные о процессе собираются только для попавших в страницу записей.
+
+        :param cmd: если указан, то возвращаются только процессы с этой командой
+        :param states: список состояний из states, по умолчанию все
+        :param fields: список полей записи, которые нужно вернуть, по умолчанию все
+        :param offset: int, сколько записей каждого состояния пропустить
+        :param limit: int, сколько записей каждого состояния вернуть, по умолчанию все
+        :return: dict
+        """
+        stop = None if limit is None else offset + limit
+        info = {}
+        for state in states or self.states:
+            if state in ('exited', 'queued'):
+                records = list(getattr(self, state))
+                records = records if cmd is None else [rec for rec in records if rec['cmd'] == cmd]
+                records = records[offset:stop]
+            else:
+                table = self.running if state == 'running' else self.waiting
+                records = table.all() if cmd is None else table.search_by_cmd(cmd)
+                records = [self._process_info(rec, waiting=state == 'waiting') for rec in records[offset:stop]]
+
+            if fields is not None:
+                records = [{field: rec[field] for field in fields if field in rec} for rec in records]
+
+            info[state] = records
+
+        return info
 
-q = Query()
+    def _process_info(self, record, waiting=False):
+        process_info = ProcessModel.from_record(waiting=waiting, **record)._asdict()
+        process_info['heartbeat_at'] = self._heartbeats.get(record['pid'])
+        process_info['cpu_percent'], process_info['rss_bytes'] = self._resources.get(record['pid'], (None, None))
+        return process_info
+
+    def resource_usage(self):
+        """Потребление ресурсов процессами из running и waiting
+
+        :return: список (запись о процессе, загрузка CPU в процентах, rss в байтах)
+        """
+        usage = []
+        for table in (self.running, self.waiting):
+            for record in table:
+                if record['pid'] in self._resources:
+                    usage.append((record,) + self._resources[record['pid']])
+        return usage
 
 
 # noinspection PyProtectedMember
-class ProcessManager(object):
+class ProcessManager(ProcessInfoMixin):
     """Менеджер запущенных процессов
 
-    При каждом запросе к демону agentd создается экземпляр ProcessManager и открывается
-    соединение с базой данных. После завершения обработки соединение с БД закрывается
-    и экземпляр менеджера уничтожается.
+    Экземпляр ProcessManager создается один раз при старте демона agentd поверх
+    общего реестра процессов (registry.ProcessRegistry) и используется обработчиками
+    обоих серверов. Таблицы реестра находятся в памяти, поэтому чтение (например, /info)
+    не требует разбора файла базы данных.
 
 
     Все запущенные в рамках исполнения заданий процессы делятся на running и waiting.
@@ -37,19 +139,113 @@ class ProcessManager(object):
     С помощью демона agentd запросы проксируются в этот менджер, который по стуи является бекендом
     этого фреймворка. Менеджер и выполняет реальное обслуживание запросов. Задачи для выполнения бывают
     либо служебными (например, регистрация/разрегистрация процессов, остановка процессов и т.д.),
-    либо задачами из модуля tasks.
+    либо задачами из каталога задач (task_catalog.TaskCatalog).
+
+
+    Каталог сопоставляет имени задачи путь к ней и параметры запуска: registration_timeout,
+    лимит процессов и preload. Модули задач импортирует процесс, который делает fork: зигота или,
+    без нее, сам менеджер (task_catalog.TaskLoader) -- при первом запуске задачи или, для задач
+    с preload, сразу после старта. Изменения каталога и модулей задач подхватываются без перезапуска.
+
+
+    Таблицы хранятся в реестре процессов (registry.ProcessRegistry), изменения записываются
+    в журнал и сбрасываются на диск один раз за итерацию ioloop. Записи таблиц индексированы
+    по pid и по cmd.
 
 
-    В качестве базы данных используется TinyDB.
+    Завершившиеся процессы собирает reaper.Reaper (либо зигота, если задачи порождаются через нее)
+    и передает в reap_processes: процесс удаляется из running/waiting, а данные о нем вместе с кодом
+    возврата и сигналом попадают в ограниченную историю exited (хранится только в памяти).
+    Поэтому явный /unlink_process из задачи не обязателен.
 
-    XXX: использовать tinyrecord (примеры здесь https://github.com/eugene-eeo/tinyrecord) для атомарных операций
+
+    Каждая задача получает канал к демону (channel.ChildChannel), по которому она сообщает
+    о регистрации, разрегистрации и шлет heartbeat без http запросов к unix сокету. Сообщения
+    из каналов читаются в ioloop (channel.ChannelReader) и обрабатываются теми же методами,
+    что и запросы /register_process и /unlink_process. Время последнего heartbeat отдается в /info.
+
+
+    Если задан resources_interval, то раз в resources_interval секунд потребление CPU и памяти
+    процессами из running и waiting замеряется по /proc (resources.ResourceSampler) и отдается
+    в /info и /metrics.
+
+
+    Если процесс не зарегистрировался за registration_timeout секунд (можно задать для задачи),
+    то он завершается, а запись о нем убирается из waiting (см. _expire_waiting). Дедлайны
+    отслеживает watchdog.Watchdog, поэтому таблица waiting на каждом срабатывании не просматривается.
+    Причина попадает в историю exited (reason). Процессы из waiting, пережившие перезапуск демона,
+    перед завершением проверяются по времени старта: их pid мог достаться другому процессу.
+
+
+    stdout и stderr задач читаются демоном через pipe (output.TaskOutput): последние строки
+    хранятся в памяти, полный вывод -- в файле задачи, оба отдаются через /logs.
+
+
+    Количество процессов можно ограничить (max_processes и max_processes_per_cmd по командам):
+    задачи сверх лимита ждут в очереди запуска (admission.RunQueue) и отдаются в /info как queued.
+
+
+    Все изменения жизненного цикла процессов (spawn, register, unlink, kill, expire, remove, exit, heartbeat), замеры
+    ресурсов (resources) и движение очереди запуска (enqueue, dequeue) публикуются в поток событий
+    events (events.EventBus), на который можно подписаться через /events.
     """
-    def __init__(self, db_path, tasks_module=None):
+    def __init__(
+        self,
+        registry,
+        catalog=None,
+        zygote=None,
+        exited_history_size=100,
+        events_history_size=10000,
+        spawn_executor=None,
+        resources_interval=None,
+        max_processes=None,
+        max_processes_per_cmd=None,
+        run_queue_size=10000,
+        run_queue_retry_sec=0.5,
+        registration_timeout=None,
+        output=None,
+    ):
         self.logger = create_logger('process_manager')
-        self.db = TinyDB(db_path)
-        self.tasks = tasks_module
-        self._waiting_for_registration_processes_table = self.db.table('waiting')
-        self._running_processes_table = self.db.table('running')
+        self.registry = registry
+        self.catalog = catalog or TaskCatalog(task_catalog_module, reload_interval=task_reload_interval_sec)
+        self.loader = TaskLoader(reload_interval=self.catalog.reload_interval)
+        self.zygote = zygote
+        self.exited = deque(maxlen=exited_history_size)
+        self._unlinked = OrderedDict()
+        self._unlinked_max_size = exited_history_size
+        self._channels = {}
+        self._heartbeats = {}
+        self._resources = {}
+        self.events = EventBus(history_size=events_history_size)
+        self.output = output or TaskOutput(folder=task_output_folder, history_size=exited_history_size)
+        self.spawn_executor = spawn_executor or BoundedExecutor(max_workers=1, max_pending=64)
+        self._spawns_in_flight = 0
+        self._early_exits = OrderedDict()
+        self._early_messages = OrderedDict()
+        self.max_processes = max_processes
+        self.max_processes_per_cmd = max_processes_per_cmd or {}
+        self.queue = RunQueue(max_size=run_queue_size)
+        self.run_queue_retry_sec = run_queue_retry_sec
+        self._queue_retry = None
+        self._starting = Counter()
+        self._starting_total = 0
+        self.registration_timeout = registration_timeout
+        self.watchdog = Watchdog(self._on_registration_expired)
+        self._waiting_for_registration_processes_table = registry.waiting
+        self._running_processes_table = registry.running
+        self.cores = CoreAllocator(get_cpu_affinity())
+        self._restored = set()
+        self._restore_waiting()
+        self._restore_cores()
+
+        if zygote is None:
+            # задачи из preload импортируются в первой итерации ioloop, не задерживая старт
+            tornado.ioloop.IOLoop.current().add_callback(self._preload_tasks)
+
+        self.sampler = None
+        if resources_interval:
+            self.sampler = ResourceSampler(self._sampled_pids, self._on_resources_sample, interval=resources_interval)
+            self.sampler.start()
 
     @property
     def running(self):
@@ -59,13 +255,37 @@ class ProcessManager(object):
     def waiting(self):
         return self._waiting_for_registration_processes_table
 
-    def info(self):
-        info = {
-            'running': [ProcessModel.from_record(**rec)._asdict() for rec in self.running],
-            'waiting': [ProcessModel.from_record(waiting=True, **rec)._asdict() for rec in self.waiting],
-        }
+    @property
+    def queued(self):
+        """Задачи в очереди на запуск
 
-        return info
+        Очередь не хранится в реестре, поэтому при каждом ее изменении вызывается registry.touch(),
+        чтобы etag /info учитывал и ее.
+        """
+        return self.queue.entries()
+
+    @property
+    def etag(self):
+        return self.registry.etag
+
+    def snapshot(self):
+        """Полное состояние менеджера вместе с номером последнего события
+
+        Реплика (replica.ProcessReplica) загружает снимок и затем применяет события
+        с номерами после seq.
+
+        :return: dict
+        """
+        return {
+            'epoch': self.events.epoch,
+            'seq': self.events.seq,
+            'running': self.running.all(),
+            'waiting': self.waiting.all(),
+            'exited': list(self.exited),
+            'queued': self.queued,
+            'heartbeats': list(self._heartbeats.items()),
+            'resources': [[pid, cpu, rss] for pid, (cpu, rss) in self._resources.items()],
+        }
 
     def stop(self, keep_processess=False):
         """Завершение работы менеджера, сохранение данных, завершение процессов (если требуется)
@@ -76,16 +296,27 @@ class ProcessManager(object):
         if not keep_processess:
             self.stop_all_processes()
 
-        self.db.close()
+        for channel in list(self._channels.values()):
+            channel.close()
+
+        if self.sampler is not None:
+            self.sampler.stop()
+        self.output.stop()
+        self.watchdog.stop()
+        if self._queue_retry is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._queue_retry)
+        self.spawn_executor.shutdown(wait=False)
+        self.registry.close()
 
     def stop_all_processes(self):
         running = self.running.all()   # prevent the `changed size during iteration` error
         for record in running:
             self.stop_registered_process(pid=record['pid'])
 
-        for record in self.waiting:
+        for record in self.waiting.all():
             self._kill_process(pid=record['pid'])
-        self.waiting.purge()
+            self._remember_unlinked(dict(record, reason=STOPPED))
+            self._remove_waiting(record['pid'], STOPPED)
 
     def stop_registered_process(self, pid):
         """Остановка процесса, удаление его из списка работающих
@@ -108,6 +339,18 @@ class ProcessManager(object):
             pass
         else:
             self.logger.info('Kill process with pid %s' % pid)
+            self.events.publish('kill', int(pid), {'signal': signal.SIGTERM})
+
+    def _preload_tasks(self):
+        for path, error in self.loader.preload(self.catalog.preload_paths()):
+            self.logger.error('Failed to preload task %s:\n%s' % (path, error))
+
+    def _refresh_catalog(self):
+        try:
+            if self.catalog.refresh():
+                self.logger.info('Task catalog reloaded')
+        except TaskCatalogError as e:
+            self.logger.error(str(e))
 
     def register_process(self, pid):
         """Перенос процесса из списка запущенных в список работающих (штатно запустился и начал работу)
@@ -115,14 +358,24 @@ class ProcessManager(object):
         :param pid:
         :return:
         """
-        process = ProcessModel.from_record(waiting=True, **self.waiting.get(q.pid == pid))
-        self.waiting.remove(q.pid == pid)
+        record = self.waiting.get(pid)
+        if record is None:
+            if not self._defer_early_message(pid, 'register'):
+                self.logger.error('Attempt to register unknown process with pid %s, aborting' % pid)
+            return
+
+        process = ProcessModel.from_record(waiting=True, **record)
 
-        if self.running.contains(q.pid == process.pid):
-            self.logger.error('Attempt to register already presented process with pid %s, aborting' % process.pid)
+        if self.running.contains(pid):
+            self._remove_waiting(pid, DUPLICATE)
+            self.logger.error('Attempt to register already presented process with pid %s, aborting' % pid)
             return
 
-        self.running.insert(process._asdict())
+        registration_seconds.observe(process.waisted_time_sec)
+        self.watchdog.discard(pid)
+        self._restored.discard(pid)
+        self.registry.move(pid, 'waiting', 'running')
+        self.events.publish('register', pid, record)
         self.logger.info('Register %s' % process)
 
     def unlink_process(self, pid):
@@ -131,9 +384,153 @@ class ProcessManager(object):
         :param pid:
         :return:
         """
-        process = ProcessModel.from_record(**self.running.get(q.pid == pid))
-        self.running.remove(q.pid == pid)
-        self.logger.info('Unlink %s' % process)
+        record = self.running.get(pid)
+        if record is None:
+            if not self._defer_early_message(pid, 'unlink'):
+                self.logger.error('Attempt to unlink unknown process with pid %s, aborting' % pid)
+            return
+
+        self.running.remove(pid)
+        self._remember_unlinked(record)
+        self.events.publish('unlink', pid, record)
+        self.logger.info('Unlink %s' % ProcessModel.from_record(**record))
+        self._start_queued()
+
+    def _defer_early_message(self, pid, op):
+        """Сообщение от задачи, запись о которой, возможно, еще не добавлена (см. spawn_processes)
+
+        Так бывает с /register_process и /unlink_process по http: между fork'ами пачки ioloop
+        обслуживает запросы, а записи о процессах добавляются после запуска всей пачки.
+
+        :return: True, если сообщение отложено до добавления записей
+        """
+        if not self._spawns_in_flight or self.waiting.contains(pid) or self.running.contains(pid):
+            return False
+
+        self._early_messages.setdefault(pid, []).append(op)
+        if len(self._early_messages) > self._unlinked_max_size:
+            self._log_unknown_messages(*self._early_messages.popitem(last=False))
+        return True
+
+    def _log_unknown_messages(self, pid, ops):
+        for op in ops:
+            self.logger.error('Attempt to %s unknown process with pid %s, aborting' % (op, pid))
+
+    def _remember_unlinked(self, record):
+        """Запись о процессе сохраняется до его сбора, чтобы в истории exited были данные о задаче"""
+        self._unlinked[record['pid']] = record
+        if len(self._unlinked) > self._unlinked_max_size:
+            self._unlinked.popitem(last=False)
+
+    def reap_processes(self, exits):
+        """Обработка пачки завершившихся дочерних процессов
+
+        :param exits: список (pid, код возврата, номер сигнала)
+        :return:
+        """
+        cores_released = False
+        for pid, returncode, signum in exits:
+            if self.zygote is not None and pid == self.zygote.pid:
+                self.logger.error(
+                    'Zygote process %s exited (returncode=%s), falling back to direct fork' % (pid, returncode)
+                )
+                self.zygote.stop()
+                self.zygote = None
+                continue
+
+            # сообщения, отправленные задачей до завершения, обрабатываются раньше ее сбора
+            self._close_channel(pid)
+            self.output.finish(pid)
+            self._heartbeats.pop(pid, None)
+            self._resources.pop(pid, None)
+            self.watchdog.discard(pid)
+            self._restored.discard(pid)
+            # ядро освобождается, даже если записи о процессе уже нет (например, она удалена без сбора)
+            cores_released = self.cores.release(pid) or cores_released
+
+            record = self.running.get(pid)
+            if record is not None:
+                self.running.remove(pid)
+            else:
+                record = self.waiting.get(pid)
+                if record is not None:
+                    self.waiting.remove(pid)
+                else:
+                    record = self._unlinked.pop(pid, None)
+
+            if record is None:
+                if self._spawns_in_flight:
+                    # возможно, задача, запись о которой еще не добавлена (см. spawn_processes)
+                    self._early_exits[pid] = (returncode, signum)
+                    if len(self._early_exits) > self._unlinked_max_size:
+                        self._early_exits.popitem(last=False)
+                continue    # не задача (например, служебный процесс spawn_killer)
+
+            if signum is not None:
+                reaped_total.inc(('signal',))
+            else:
+                reaped_total.inc(('ok',) if returncode == 0 else ('error',))
+
+            self._add_exited(record, returncode, signum)
+            self.logger.info(
+                'Reap %s, returncode=%s, signal=%s' % (ProcessModel.from_record(**record), returncode, signum)
+            )
+
+        if cores_released:
+            self._rebalance_cores()
+        self._start_queued()
+
+    def _add_exited(self, record, returncode, signum):
+        """Запись о завершившемся процессе в историю exited"""
+        exited = ProcessModel.from_record(**record)._asdict()
+        exited.update(returncode=returncode, signal=signum, exited_at=time.time(), reason=record.get('reason'))
+        self.exited.append(exited)
+        self.registry.touch()
+        self.events.publish('exit', record['pid'], exited)
+
+    def _rebalance_cores(self):
+        """Перенос задач с "cpus": "auto" на освободившиеся ядра (см. placement.CoreAllocator)"""
+        for pid, core in self.cores.rebalance():
+            try:
+                set_cpu_affinity(pid, [core])
+            except OSError as e:
+                self.logger.warning('Failed to move process %s to cpu %s: %s' % (pid, core, e))
+                continue
+            self.logger.info('Move process %s to cpu %s' % (pid, core))
+
+    def _restore_cores(self):
+        """Учет ядер задач с "cpus": "auto", переживших перезапуск демона, по их текущей привязке"""
+        for table in (self.running, self.waiting):
+            for record in table:
+                if (record.get('resources') or {}).get('cpus') != AUTO_SPREAD:
+                    continue
+
+                try:
+                    cpus = get_cpu_affinity(record['pid'])
+                except OSError:
+                    # процесс уже завершился; он не дочерний для этого демона, так что reap_processes
+                    # его не соберет (записи waiting таких процессов убирает _restore_waiting)
+                    continue
+                if len(cpus) == 1 and cpus[0] in self.cores.cores:
+                    self.cores.assign(record['pid'], cpus[0])
+
+    def _restore_waiting(self):
+        """Записи waiting, пережившие перезапуск демона
+
+        Процессы из них -- не дочерние для нового демона: reap_processes их не соберет, а pid
+        задачи, завершившейся, пока демон не работал, мог достаться другому процессу. Поэтому
+        записи процессов, которых уже нет (см. resources.is_same_process), сразу переносятся
+        в историю exited с reason="lost", а за остальными снова следит watchdog.
+        """
+        for record in self.waiting.all():
+            if is_same_process(record['pid'], record['spawned_at']):
+                self._restored.add(record['pid'])
+                self._watch_registration(record)
+                continue
+
+            self.logger.warning('Process %s is gone, removing it' % ProcessModel.from_record(waiting=True, **record))
+            self.waiting.remove(record['pid'])
+            self._add_exited(dict(record, reason=LOST), None, None)
 
     def kill_waiting_process(self, pid):
         """Остановка процесса (если он есть) и удаление его из списка ждущих подтвержения (если он там есть)
@@ -141,38 +538,401 @@ class ProcessManager(object):
         :param pid:
         :return:
         """
+        record = self.waiting.get(pid)
+        self._kill_process(pid)
+        if record is not None:
+            self._remember_unlinked(dict(record, reason=KILLED))
+            self._remove_waiting(pid, KILLED)
+        self._start_queued()
+
+    def _remove_waiting(self, pid, reason):
+        """Удаление записи из waiting не по регистрации, с событием remove для реплик
+
+        Если процесс завершен, то в историю exited он попадает при сборе (см. _remember_unlinked).
+
+        :param pid:
+        :param reason: str, причина удаления
+        :return:
+        """
+        self.waiting.remove(pid)
+        self.watchdog.discard(pid)
+        self._restored.discard(pid)
+        self.events.publish('remove', pid, {'reason': reason})
+
+    def _watch_registration(self, record):
+        timeout = record.get(REGISTRATION_TIMEOUT) or self.registration_timeout
+        if timeout:
+            self.watchdog.watch(record['pid'], record['spawned_at'] + timeout)
+
+    def _on_registration_expired(self, pids):
+        for pid in pids:
+            self._expire_waiting(pid)
+        self._start_queued()
+
+    def _expire_waiting(self, pid):
+        """Завершение процесса, не зарегистрировавшегося за registration_timeout
+
+        Запись убирается из waiting сразу, а в историю exited процесс попадает при сборе
+        с reason="registration_timeout".
+
+        :param pid:
+        :return:
+        """
+        record = self.waiting.get(pid)
+        if record is None:
+            return
+
+        process = ProcessModel.from_record(waiting=True, **record)
+        if pid in self._restored:
+            self._restored.discard(pid)
+            # процесс пережил перезапуск демона и мог с тех пор завершиться, а его pid -- достаться
+            # другому процессу, который завершать нельзя (см. _restore_waiting)
+            if not is_same_process(pid, record['spawned_at']):
+                self.logger.warning('Process %s is gone, removing it' % process)
+                self.waiting.remove(pid)
+                self._add_exited(dict(record, reason=LOST), None, None)
+                return
+
+        timeout = record.get(REGISTRATION_TIMEOUT) or self.registration_timeout
+        self.logger.error('Process %s did not register in %s sec, killing' % (process, timeout))
+        registration_expired_total.inc()
         self._kill_process(pid)
-        self.waiting.remove(q.pid == pid)
+        self.waiting.remove(pid)
+        self._remember_unlinked(dict(record, reason=REGISTRATION_TIMEOUT))
+        self.events.publish('expire', pid, {'reason': REGISTRATION_TIMEOUT, 'timeout': timeout})
+
+    @gen.coroutine
+    def spawn_process(self, cmd, args, kwargs, resources=None, priority=0, registration_timeout=None):
+        """Порождает новый процесс с задачей. Задача берется из каталога задач (catalog)
+
+        Если менеджеру передана зигота (zygote.Zygote), то fork выполняет она, а запрос к ней
+        выполняется в пуле spawn_executor, не блокируя ioloop. Иначе процесс порождается самим
+        демоном (forking.fork_task_with_channel) прямо в ioloop: fork из потока пула небезопасен,
+        т.к. блокировки, захваченные другими потоками, достались бы задаче захваченными. Зато
+        между fork'ами пачки ioloop обслуживает другие запросы. В обоих
+        случаях демон получает читающие концы канала задачи и pipe ее stdout и stderr
+        и начинает слушать их в ioloop. Вывод задачи отдается в /logs (см. output.TaskOutput).
 
-    def spawn_process(self, cmd, args, kwargs):
-        """Порождает новый процесс с задачей. Задача берется из модуля tasks
+        Ограничения resources применяются в процессе задачи до ее запуска (см. forking.fork_task).
+        Задачам с "cpus": "auto" ядро выбирает менеджер (placement.CoreAllocator).
 
-        stderr поток при запуске процесса перенаправляется в логгер.
-        XXX: перенаправление искажает реальный traceback
+        Если процессов (всего или с командой cmd) уже столько, сколько разрешает max_processes
+        (max_processes_per_cmd), задача ставится в очередь (см. spawn_processes).
 
         :param kwargs:
         :param cmd:
         :param args:
-        :return:
+        :param resources: dict, описание ресурсов задачи (см. placement.validate_resources)
+        :param priority: int, приоритет задачи в очереди запуска
+        :param registration_timeout: float, сколько секунд ждать регистрации процесса (по умолчанию
+            registration_timeout задачи из каталога, если его нет -- registration_timeout менеджера)
+        :return: Future с pid нового процесса, {"queued": id} для задачи, поставленной в очередь,
+            или None, если запустить задачу не удалось
+        :raise executor.ExecutorBusy: если очередь spawn_executor переполнена
+        """
+        task = {
+            'cmd': cmd,
+            'args': args,
+            'kwargs': kwargs,
+            'resources': resources,
+            'priority': priority,
+            REGISTRATION_TIMEOUT: registration_timeout,
+        }
+        pids = yield self.spawn_processes([task])
+        raise gen.Return(pids[0])
+
+    @gen.coroutine
+    def spawn_processes(self, tasks):
+        """Порождает пачку процессов с задачами (см. spawn_process)
+
+        Задача запускается сразу, только если процессов в running и waiting вместе с запускаемыми
+        меньше max_processes, а процессов с той же командой -- меньше max_processes_per_cmd[cmd]
+        (если для команды он не задан -- max_processes задачи из каталога).
+        Иначе она ставится в очередь (admission.RunQueue) и запускается, когда освободится место:
+        после unlink, сбора процесса или kill_waiting_process (а если переполнен пул запуска --
+        повторно через run_queue_retry_sec). Из очереди задачи берутся в порядке
+        priority (больше -- раньше), при равенстве -- в порядке постановки. Очередь хранится только
+        в памяти; если она заполнена, задача не запускается.
+
+        Записи обо всех запущенных процессах добавляются в waiting одной записью журнала.
+        Задачи, которых нет в каталоге, не запускаются и в очередь не ставятся.
+
+        :param tasks: список dict вида
+            {"cmd": ..., "args": [...], "kwargs": {...}, "resources": {...}, "priority": 0, "registration_timeout": 30}
+        :return: Future со списком в порядке tasks: pid, {"queued": id} для задач, поставленных
+            в очередь, None для задач, которые запустить не удалось
+        :raise executor.ExecutorBusy: если очередь spawn_executor переполнена
         """
-        callable_ = getattr(self.tasks, cmd, None)
-        if callable_ is None:
+        self._refresh_catalog()
+        # место, освободившееся с прошлого запуска, сначала достается очереди
+        self._start_queued()
+
+        results, admitted = [], []
+        for index, task in enumerate(tasks):
+            results.append(None)
+            if task['cmd'] not in self.catalog:
+                self.logger.error('Unknown command "%s"' % task['cmd'])
+                continue
+
+            if self._can_start(task['cmd']):
+                self._reserve(task['cmd'])
+                admitted.append(index)
+                continue
+
+            entry = self.queue.push(task)
+            if entry is None:
+                self.logger.error('Run queue is full, task %s is rejected' % task['cmd'])
+                continue
+
+            # очередь отдается в /info вместе с реестром, etag должен измениться
+            self.registry.touch()
+            self.events.publish('enqueue', None, entry)
+            results[index] = {'queued': entry['id']}
+
+        pids = yield self._spawn_tasks([tasks[index] for index in admitted])
+        for index, pid in zip(admitted, pids):
+            results[index] = pid
+
+        raise gen.Return(results)
+
+    def _can_start(self, cmd):
+        total = len(self.running) + len(self.waiting) + self._starting_total
+        if self.max_processes is not None and total >= self.max_processes:
+            return False
+
+        limit = self.max_processes_per_cmd.get(cmd, self.catalog.max_processes(cmd))
+        if limit is not None:
+            count = self.running.count_by_cmd(cmd) + self.waiting.count_by_cmd(cmd) + self._starting[cmd]
+            if count >= limit:
+                return False
+
+        return True
+
+    def _reserve(self, cmd):
+        """Учет запускаемой задачи в лимитах до появления записи о ней в waiting"""
+        self._starting[cmd] += 1
+        self._starting_total += 1
+
+    def _release(self, cmd):
+        self._starting[cmd] -= 1
+        if not self._starting[cmd]:
+            del self._starting[cmd]
+        self._starting_total -= 1
+
+    def _start_queued(self):
+        """Запуск задач из очереди, для которых освободилось место"""
+        entries = []
+        while True:
+            entry = self.queue.pop(self._can_start)
+            if entry is None:
+                break
+
+            self._reserve(entry['cmd'])
+            self.events.publish('dequeue', None, {'id': entry['id']})
+            entries.append(entry)
+
+        if entries:
+            self.registry.touch()
+            tornado.ioloop.IOLoop.current().add_future(
+                self._spawn_tasks(entries), lambda future: self._on_queued_spawned(entries, future)
+            )
+
+    def _on_queued_spawned(self, entries, future):
+        try:
+            future.result()
+        except Exception as e:
+            # например, переполнен spawn_executor: задачи возвращаются в очередь, и запуск повторяется
+            # через run_queue_retry_sec, даже если место больше не освобождается
+            self.logger.warning('Failed to start %s queued tasks, requeueing: %r' % (len(entries), e))
+            for entry in entries:
+                self.queue.restore(entry)
+                self.events.publish('enqueue', None, entry)
+            self.registry.touch()
+
+            if self._queue_retry is None:
+                self._queue_retry = tornado.ioloop.IOLoop.current().call_later(
+                    self.run_queue_retry_sec, self._retry_queued
+                )
+
+    def _retry_queued(self):
+        self._queue_retry = None
+        self._start_queued()
+
+    @gen.coroutine
+    def _spawn_tasks(self, tasks):
+        """Запуск задач, место для которых уже зарезервировано (_reserve)
+
+        :return: Future со списком pid в порядке tasks, None для задач, которые запустить не удалось
+        """
+        if not tasks:
+            raise gen.Return([])
+
+        try:
+            pids = yield self._spawn_reserved(tasks)
+        finally:
+            for task in tasks:
+                self._release(task['cmd'])
+
+        raise gen.Return(pids)
+
+    @gen.coroutine
+    def _spawn_reserved(self, tasks):
+        cores = [self._reserve_core(task) for task in tasks]
+        placed = [
+            task if core is None else dict(task, resources=dict(task['resources'], cpus=[core]))
+            for task, core in zip(tasks, cores)
+        ]
+
+        spawned = [None] * len(tasks)
+        self._spawns_in_flight += 1
+        try:
+            if self.zygote is not None:
+                spawned = yield self.spawn_executor.submit(self._spawn_batch, placed, self.zygote)
+            else:
+                spawned = []
+                for task in placed:
+                    spawned.extend(self._spawn_batch([task]))
+                    yield gen.moment    # между fork'ами ioloop успевает обслужить другие запросы
+        finally:
+            self._spawns_in_flight -= 1
+            for core, result in zip(cores, spawned):
+                if core is not None and result is None:
+                    self.cores.cancel(core)
+
+        pids, records = [], []
+        for task, core, result in zip(tasks, cores, spawned):
+            if result is None:
+                pids.append(None)
+                continue
+
+            pid, channel_fd, output_fd = result
+            if core is not None:
+                self.cores.bind(pid, core)
+            process = ProcessModel(
+                cmd=task['cmd'],
+                pid=pid,
+                args=task.get('args', []),
+                kwargs=task.get('kwargs', {}),
+                resources=task.get('resources'),
+                registration_timeout=(
+                    task.get(REGISTRATION_TIMEOUT)
+                    or self.catalog.registration_timeout(task['cmd'])
+                    or self.registration_timeout
+                ),
+            )
+            self._watch_channel(pid, channel_fd)
+            self.output.watch(pid, output_fd)
+            self.logger.info('Spawn %s' % process)
+            pids.append(pid)
+            records.append(process._asdict())
+
+        self.waiting.insert_many(records)
+        for record in records:
+            self._watch_registration(record)
+            self.events.publish('spawn', record['pid'], record)
+
+        # сообщения, пришедшие по http до добавления записей (см. _defer_early_message)
+        for pid in pids:
+            for op in self._early_messages.pop(pid, ()):
+                self._on_channel_message(pid, {'op': op})
+        if not self._spawns_in_flight:
+            # запусков больше нет, оставшиеся сообщения -- от неизвестных процессов
+            while self._early_messages:
+                self._log_unknown_messages(*self._early_messages.popitem(last=False))
+
+        # задачи, которые успели завершиться и были собраны до добавления записей о них
+        early_exits = [(pid_,) + self._early_exits.pop(pid_) for pid_ in pids if pid_ in self._early_exits]
+        if early_exits:
+            self.reap_processes(early_exits)
+
+        raise gen.Return(pids)
+
+    def _reserve_core(self, task):
+        """Ядро для задачи с "cpus": "auto" или None"""
+        resources = task.get('resources') or {}
+        if resources.get('cpus') != AUTO_SPREAD:
+            return None
+        return self.cores.acquire()
+
+    def _spawn_batch(self, tasks, zygote=None):
+        """Порождение процессов для tasks
+
+        :return: список (pid, читающий конец канала) или None для задач, которые запустить не удалось
+        """
+        return [
+            self._spawn(task['cmd'], task.get('args', []), task.get('kwargs', {}), zygote, task.get('resources'))
+            for task in tasks
+        ]
+
+    def _spawn(self, cmd, args, kwargs, zygote=None, resources=None):
+        spec = self.catalog.get(cmd)
+        if spec is None:
+            # задача могла пропасть из каталога, пока ждала в очереди
             self.logger.error('Unknown command "%s"' % cmd)
             return
 
-        old_err = sys.stderr
-        sys.stderr = StreamToLogger(self.logger, log_level=logging.ERROR)
+        started_at = time.time()
+        if zygote is not None:
+            # noinspection PyBroadException
+            try:
+                result = zygote.spawn(cmd=cmd, path=spec['path'], args=args, kwargs=kwargs, resources=resources)
+            except Exception:
+                self.logger.error(tb.format_exc())
+                return
+
+            spawn_seconds.observe(time.time() - started_at, ('zygote',))
+            return result
 
         # noinspection PyBroadException
         try:
-            process_ = multiprocessing.Process(target=callable_, args=args, kwargs=kwargs)
-            process_.start()
+            callable_ = self.loader.load(spec['path'])
+            result = fork_task_with_channel(callable_, args, kwargs, resources=resources)
         except Exception:
-            msg = tb.format_exc()
-            self.logger.error(msg)
+            self.logger.error(tb.format_exc())
+            return
+
+        spawn_seconds.observe(time.time() - started_at, ('direct',))
+        return result
+
+    def _watch_channel(self, pid, channel_fd):
+        channel = ChannelReader(pid=pid, fd=channel_fd, on_message=self._on_channel_message)
+        channel.start()
+        self._channels[pid] = channel
+
+    def _close_channel(self, pid):
+        channel = self._channels.pop(pid, None)
+        if channel is not None:
+            channel.drain()
+            channel.close()
+
+    def _sampled_pids(self):
+        return [record['pid'] for table in (self.running, self.waiting) for record in table]
+
+    def _on_resources_sample(self, usage):
+        # процессы, собранные во время замера, в результат не попадают
+        usage = {pid: value for pid, value in usage.items() if self.running.contains(pid) or self.waiting.contains(pid)}
+        if usage == self._resources:
+            return  # версия реестра (etag /info) не меняется, пока потребление ресурсов то же
+
+        self._resources = usage
+        self.registry.touch()
+        self.events.publish('resources', None, [[pid, cpu, rss] for pid, (cpu, rss) in self._resources.items()])
+
+    def _on_channel_message(self, pid, message):
+        """Обработка сообщения из канала задачи
+
+        :param pid: pid задачи-отправителя
+        :param message: dict вида {"op": "register" | "unlink" | "heartbeat"}
+        :return:
+        """
+        op = message.get('op')
+        if op == 'register':
+            self.register_process(pid)
+        elif op == 'unlink':
+            self.unlink_process(pid)
+        elif op == 'heartbeat':
+            self._heartbeats[pid] = time.time()
+            self.registry.touch()
+            self.events.publish('heartbeat', pid)
         else:
-            process = ProcessModel(cmd=cmd, process_obj=process_)
-            self.waiting.insert(process._asdict())
-            self.logger.info('Spawn %s' % process)
-        finally:
-            sys.stderr = old_err
+            self.logger.error('Unknown channel message %r from pid %s' % (message, pid))
@@ -0,0 +1,194 @@
+# coding: utf-8
+from bisect import bisect_left
+from multiprocessing.sharedctypes import RawArray
+
+import tornado.ioloop
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry(object):
+    """Счетчики и гистограммы демона в формате Prometheus
+
+    Все метрики объявляются заранее вместе со всеми значениями меток, после чего allocate()
+    выделяет под них один массив double в разделяемой памяти. Запись в метрику -- это сложение
+    в заранее известную ячейку массива, без аллокаций на каждый запрос.
+
+    Массив выделяется до порождения web процессов (--web_processes) и наследуется ими: у каждого
+    процесса своя строка массива (use_row), в которую пишет только он, а render() суммирует строки.
+    Поэтому любой web процесс отдает метрики всего демона, включая запуски и сборы задач
+    в процессе-супервизоре. Каждую ячейку пишет один поток процесса, блокировки не нужны.
+    """
+    def __init__(self):
+        self._metrics = []
+        self.size = 0
+        self.rows = 0
+        self.values = None
+        self.base = 0
+
+    def counter(self, name, documentation, labelnames=(), labelvalues=((),)):
+        return self._add(Counter(self, name, documentation, labelnames, labelvalues))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS, labelnames=(), labelvalues=((),)):
+        return self._add(Histogram(self, name, documentation, buckets, labelnames, labelvalues))
+
+    def _add(self, metric):
+        assert self.values is None, 'metrics are already allocated'
+        self._metrics.append(metric)
+        return metric
+
+    def reserve(self, num):
+        """Резервирование num ячеек, возвращает смещение первой из них"""
+        offset = self.size
+        self.size += num
+        return offset
+
+    def allocate(self, rows=1):
+        """Выделение памяти под метрики, rows -- количество процессов, которые в них пишут"""
+        self.rows = rows
+        self.values = RawArray('d', self.size * rows)
+        self.use_row(0)
+
+    def use_row(self, row):
+        self.base = row * self.size
+
+    def slot(self, offset):
+        if self.values is None:
+            self.allocate()
+        return self.base + offset
+
+    def total(self, offset):
+        """Сумма ячейки по всем процессам"""
+        values = self.values
+        return sum(values[row * self.size + offset] for row in range(self.rows))
+
+    def render(self, gauges=()):
+        """Текстовый формат Prometheus
+
+        :param gauges: список (name, documentation, [(labels dict, value)]), значения, которые
+            вычисляются в момент запроса (размер реестра и т.п.)
+        """
+        if self.values is None:
+            self.allocate()
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        for name, documentation, samples in gauges:
+            lines.append('# HELP %s %s' % (name, documentation))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, format_labels(labels.items()), format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+    def __init__(self, registry, name, documentation, labelnames, labelvalues):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.labelvalues = list(labelvalues)
+        offset = registry.reserve(len(self.labelvalues))
+        self._offsets = {values: offset + i for i, values in enumerate(self.labelvalues)}
+
+    def inc(self, labelvalues=(), amount=1):
+        slot = self.registry.slot(self._offsets[labelvalues])
+        self.registry.values[slot] += amount
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s counter' % self.name
+        for values in self.labelvalues:
+            labels = format_labels(zip(self.labelnames, values))
+            yield '%s%s %s' % (self.name, labels, format_value(self.registry.total(self._offsets[values])))
+
+
+class Histogram(object):
+    """Гистограмма: счетчики попаданий в каждый интервал (последний -- +Inf) и сумма значений"""
+    def __init__(self, registry, name, documentation, buckets, labelnames, labelvalues):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.labelvalues = list(labelvalues)
+        width = len(self.buckets) + 2
+        offset = registry.reserve(width * len(self.labelvalues))
+        self._offsets = {values: offset + i * width for i, values in enumerate(self.labelvalues)}
+
+    def observe(self, value, labelvalues=()):
+        registry = self.registry
+        base = registry.slot(self._offsets[labelvalues])
+        registry.values[base + bisect_left(self.buckets, value)] += 1
+        registry.values[base + len(self.buckets) + 1] += value
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s histogram' % self.name
+        for values in self.labelvalues:
+            offset = self._offsets[values]
+            labels = list(zip(self.labelnames, values))
+            count = 0
+            for i, bound in enumerate(self.buckets + (float('inf'),)):
+                count += self.registry.total(offset + i)
+                le = '+Inf' if i == len(self.buckets) else format_value(bound)
+                yield '%s_bucket%s %s' % (self.name, format_labels(labels + [('le', le)]), format_value(count))
+            yield '%s_sum%s %s' % (
+                self.name, format_labels(labels), format_value(self.registry.total(offset + len(self.buckets) + 1))
+            )
+            yield '%s_count%s %s' % (self.name, format_labels(labels), format_value(count))
+
+
+def format_labels(pairs):
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs
+    )
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class IOLoopLagMonitor(object):
+    """Замер задержки ioloop: насколько позже запланированного выполняется обратный вызов
+
+    Каждые interval секунд планируется вызов через call_later, разница между фактическим
+    и запланированным временем его выполнения записывается в гистограмму.
+    """
+    def __init__(self, histogram, interval=0.5, ioloop=None):
+        self.histogram = histogram
+        self.interval = interval
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._expected_at = None
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        self._expected_at = self.ioloop.time() + self.interval
+        self.ioloop.call_at(self._expected_at, self._tick)
+
+    def _tick(self):
+        self.histogram.observe(max(0.0, self.ioloop.time() - self._expected_at))
+        self._schedule()
+
+
+metrics_registry = MetricsRegistry()
+
+ioloop_lag_seconds = metrics_registry.histogram(
+    'agentd_ioloop_lag_seconds',
+    'Delay of scheduled ioloop callbacks',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
@@ -13,28 +13,39 @@ class Process(object):
         'kwargs',
         'spawned_at',
         'host',
+        'resources',
+        'registration_timeout',
     )
 
-    # noinspection PyProtectedMember
-    def __init__(self, cmd=None, process_obj=None, keep_unfilled=False):
+    def __init__(
+        self, cmd=None, pid=None, args=tuple(), kwargs=None, resources=None, registration_timeout=None,
+        keep_unfilled=False,
+    ):
         """
-        Используется в двух сценариях: обертка над объектом multiprocessing.Process либо внутри
-        метода from_record для создания пустого контейнера и дальнейшего заполнения данными из таблицы.
-        В последнем случае нужно указать флаг keep_unfilled
+        Используется в двух сценариях: описание только что порожденного процесса задачи (pid и
+        аргументы задачи передаются явно) либо внутри метода from_record для создания пустого
+        контейнера и дальнейшего заполнения данными из таблицы. В последнем случае нужно указать
+        флаг keep_unfilled
 
         :param cmd: str
+        :param pid: int
+        :param args: list
+        :param kwargs: dict
+        :param resources: dict, описание ресурсов задачи (см. placement.validate_resources)
+        :param registration_timeout: float, сколько секунд процесс может оставаться в waiting
         :param keep_unfilled: bool
-        :param process_obj: multiprocessing.Process object
         """
-        assert (cmd is not None and process_obj is not None) or keep_unfilled
+        assert (cmd is not None and pid is not None) or keep_unfilled
         self._waiting = True
         if keep_unfilled:
             return
 
-        self.pid = process_obj.pid
+        self.pid = pid
         self.cmd = cmd
-        self.args = process_obj._args
-        self.kwargs = process_obj._kwargs
+        self.args = list(args)
+        self.kwargs = kwargs or {}
+        self.resources = resources
+        self.registration_timeout = registration_timeout
         self.host = socket.getfqdn()
         self.spawned_at = time.time()
 
@@ -45,7 +56,8 @@ class Process(object):
     def from_record(cls, waiting=False, **kwargs):
         obj = cls(keep_unfilled=True)
         for field in cls.dict_fields:
-            setattr(obj, field, kwargs[field])
+            # в записях, сделанных до появления resources и registration_timeout, этих полей нет
+            setattr(obj, field, kwargs.get(field))
 
         if not waiting:
             obj.set_as_running()
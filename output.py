@@ -0,0 +1,357 @@
+# coding: utf-8
+import errno
+import os
+from collections import deque, OrderedDict
+
+import tornado.ioloop
+from tornado import gen
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import create_logger
+from utils import set_nonblocking
+
+READ_CHUNK = 65536
+
+
+def output_path(folder, pid):
+    return os.path.join(folder, '%d.log' % pid)
+
+
+class TaskOutput(object):
+    """Вывод задач (stdout и stderr) в демоне
+
+    При запуске задачи ее stdout и stderr направляются в один pipe (см. forking.fork_task),
+    читающий конец которого демон регистрирует в ioloop (watch). За одно событие читается
+    не больше READ_CHUNK байт, поэтому задача, которая много пишет, не задерживает обработку
+    запросов: ioloop чередует ее pipe с остальными дескрипторами.
+
+    Последние buffer_lines строк каждой задачи хранятся в памяти (кольцевой буфер) и отдаются
+    в /logs, полный вывод дописывается в файл <folder>/<pid>.log. Запись в файлы, как и в журнале
+    реестра, накапливается за итерацию ioloop и выполняется одним фоновым потоком. Файл задачи
+    ограничен max_file_bytes, дальше вывод остается только в буфере.
+
+    Когда задача завершается (finish), остаток вывода дочитывается, pipe закрывается,
+    подписчики получают None. Буферы и файлы history_size последних завершившихся задач
+    сохраняются, более старые удаляются. Файлы, оставшиеся от прошлого запуска демона,
+    удаляются при старте: pipe'ы задач, переживших перезапуск, закрылись вместе с демоном.
+    """
+    def __init__(self, folder, buffer_lines=1000, history_size=100, max_file_bytes=0, ioloop=None):
+        self.logger = create_logger('task_output')
+        self.folder = folder
+        self.buffer_lines = buffer_lines
+        self.history_size = history_size
+        self.max_file_bytes = max_file_bytes
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._buffers = {}
+        self._finished = OrderedDict()
+        self._fds = {}
+        self._partial = {}
+        self._followers = {}
+        self._file_bytes = {}
+        self._pending = []
+        self._flush_scheduled = False
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in os.listdir(folder):
+            if name.endswith('.log'):
+                self._remove(os.path.join(folder, name))
+
+    def watch(self, pid, fd):
+        """Начало чтения вывода задачи pid из читающего конца pipe fd"""
+        self._discard(pid)    # pid переиспользован, вывод прошлой задачи с ним больше не нужен
+        self._buffers[pid] = deque(maxlen=self.buffer_lines)
+        self._partial[pid] = ''
+        self._file_bytes[pid] = 0
+        self._fds[pid] = fd
+        self._writer.submit(self._truncate, output_path(self.folder, pid))
+
+        set_nonblocking(fd)
+        self.ioloop.add_handler(fd, lambda fd_, events: self._read(pid), tornado.ioloop.IOLoop.READ)
+
+    def finish(self, pid):
+        """Задача завершилась: дочитывание остатка вывода и закрытие pipe"""
+        if pid not in self._fds:
+            return
+
+        while self._read(pid):
+            pass
+        if pid in self._fds:    # pipe еще держат, например, потомки задачи
+            self._close(pid)
+
+    def tail(self, pid, num):
+        """Последние num строк вывода задачи или None, если вывода задачи pid нет"""
+        lines = self._buffers.get(pid)
+        if lines is None:
+            return None
+        return list(lines)[-num:] if num else []
+
+    def follow(self, pid, num, callback):
+        """Последние num строк вывода задачи и подписка на новые
+
+        :param callback: callable, принимает список строк, а когда вывод закончился -- None
+        :return: False, если вывода задачи pid нет
+        """
+        lines = self.tail(pid, num)
+        if lines is None:
+            return False
+
+        callback(lines)
+        if pid in self._fds:
+            self._followers.setdefault(pid, []).append(callback)
+        else:
+            callback(None)
+        return True
+
+    def unfollow(self, pid, callback):
+        followers = self._followers.get(pid, [])
+        if callback in followers:
+            followers.remove(callback)
+
+    def stop(self):
+        for pid in list(self._fds):
+            self._close(pid)
+        self.flush()
+        self._writer.shutdown(wait=True)
+
+    def _read(self, pid):
+        """Одно чтение из pipe задачи
+
+        :return: True, если данные были прочитаны (в pipe может остаться еще)
+        """
+        fd = self._fds.get(pid)
+        if fd is None:
+            return False
+
+        try:
+            data = os.read(fd, READ_CHUNK)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return False
+            raise
+
+        if not data:
+            self._close(pid)
+            return False
+
+        self._append(pid, data)
+        return True
+
+    def _append(self, pid, data):
+        self._spill(pid, data)
+
+        lines = (self._partial[pid] + data).split('\n')
+        self._partial[pid] = lines.pop()
+        if len(self._partial[pid]) > READ_CHUNK:
+            # очень длинная строка без перевода строки отдается частями
+            lines.append(self._partial[pid])
+            self._partial[pid] = ''
+
+        if lines:
+            self._buffers[pid].extend(lines)
+            for callback in list(self._followers.get(pid, [])):
+                callback(lines)
+
+    def _spill(self, pid, data):
+        if self.max_file_bytes:
+            allowed = self.max_file_bytes - self._file_bytes[pid]
+            if allowed <= 0:
+                return
+            if len(data) > allowed:
+                data = data[:allowed] + '\n[output truncated: max_file_bytes reached]\n'
+
+        self._file_bytes[pid] += len(data)
+        self._pending.append((pid, data))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.ioloop.add_callback(self.flush)
+
+    def flush(self):
+        """Передача накопленного за итерацию вывода в поток записи"""
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+
+        chunks = OrderedDict()
+        for pid, data in self._pending:
+            chunks.setdefault(pid, []).append(data)
+        self._pending = []
+        self._writer.submit(
+            self._write, [(output_path(self.folder, pid), ''.join(data)) for pid, data in chunks.items()]
+        )
+
+    def _close(self, pid):
+        fd = self._fds.pop(pid)
+        self.ioloop.remove_handler(fd)
+        os.close(fd)
+
+        partial = self._partial.pop(pid)
+        if partial:
+            self._buffers[pid].append(partial)
+            for callback in list(self._followers.get(pid, [])):
+                callback([partial])
+
+        for callback in self._followers.pop(pid, []):
+            callback(None)
+
+        self._file_bytes.pop(pid, None)
+        self._finished[pid] = None
+        while len(self._finished) > self.history_size:
+            self._discard(next(iter(self._finished)))
+
+    def _discard(self, pid):
+        """Удаление буфера и файла завершившейся задачи"""
+        if pid not in self._finished:
+            return
+
+        del self._finished[pid]
+        del self._buffers[pid]
+        self._writer.submit(self._remove, output_path(self.folder, pid))
+
+    def _truncate(self, path):
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+        except OSError as e:
+            self.logger.error('Failed to create %s: %s' % (path, e))
+
+    def _write(self, chunks):
+        for path, data in chunks:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                self.logger.error('Failed to write %s: %s' % (path, e))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class TaskOutputFiles(object):
+    """Вывод задач в web процессе: чтение файлов, которые пишет TaskOutput супервизора
+
+    Интерфейс тот же, что у TaskOutput, но файлы читаются в пуле потоков, поэтому tail и follow
+    возвращают Future. follow опрашивает файл раз в poll_interval секунд, пока задача жива
+    (is_alive) или в файле есть непрочитанные данные.
+    """
+    def __init__(self, folder, is_alive, executor, poll_interval=0.25, ioloop=None):
+        """
+        :param is_alive: callable, принимает pid и возвращает, выполняется ли задача
+        :param executor: пул для чтения файлов
+        """
+        self.folder = folder
+        self.is_alive = is_alive
+        self.executor = executor
+        self.poll_interval = poll_interval
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._followers = {}
+
+    @gen.coroutine
+    def tail(self, pid, num):
+        result = yield self.executor.submit(read_tail, output_path(self.folder, pid), num)
+        raise gen.Return(None if result is None else result[0])
+
+    @gen.coroutine
+    def follow(self, pid, num, callback):
+        path = output_path(self.folder, pid)
+        result = yield self.executor.submit(read_tail, path, num)
+        if result is None:
+            raise gen.Return(False)
+
+        lines, offset = result
+        callback(lines)
+        follower = _FileFollower(path, offset, lambda: self.is_alive(pid), callback, self.executor)
+        self._followers[callback] = follower
+        follower.timer = tornado.ioloop.PeriodicCallback(follower.poll, self.poll_interval * 1000)
+        follower.timer.start()
+        raise gen.Return(True)
+
+    def unfollow(self, pid, callback):
+        follower = self._followers.pop(callback, None)
+        if follower is not None:
+            follower.timer.stop()
+
+
+class _FileFollower(object):
+    def __init__(self, path, offset, is_alive, callback, executor):
+        self.path = path
+        self.offset = offset
+        self.is_alive = is_alive
+        self.callback = callback
+        self.executor = executor
+        self.timer = None
+        self._partial = ''
+        self._reading = False
+
+    def poll(self):
+        if self._reading:
+            return
+
+        # жива ли задача, проверяется до чтения: все, что она успела записать, будет прочитано
+        alive = self.is_alive()
+        self._reading = True
+        tornado.ioloop.IOLoop.current().add_future(
+            self.executor.submit(read_from, self.path, self.offset), lambda future: self._on_read(future, alive)
+        )
+
+    def _on_read(self, future, alive):
+        self._reading = False
+        if self.timer is None or not self.timer.is_running():
+            return
+
+        try:
+            data = future.result()
+        except (IOError, OSError):
+            data = ''
+
+        self.offset += len(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        if lines:
+            self.callback(lines)
+
+        if not data and not alive:
+            self.timer.stop()
+            if self._partial:
+                self.callback([self._partial])
+            self.callback(None)
+
+
+def read_from(path, offset, limit=READ_CHUNK * 16):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(limit)
+
+
+def read_tail(path, num, block=READ_CHUNK):
+    """Последние num строк файла (читается с конца блоками)
+
+    :return: (строки, размер файла) или None, если файла нет
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        position, data = size, ''
+        while position > 0 and data.count('\n') <= num:
+            step = min(block, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    # недописанная последняя строка будет прочитана целиком при следующем чтении (follow)
+    end = data.rfind('\n') + 1
+    size -= len(data) - end
+    lines = data[:end].split('\n')[:-1]
+    return (lines[-num:] if num else []), size
@@ -0,0 +1,191 @@
+# coding: utf-8
+import ctypes
+import ctypes.util
+import os
+import resource
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+# маска на 1024 процессора, как cpu_set_t в glibc
+_MASK_BITS = ctypes.sizeof(ctypes.c_ulong) * 8
+_CpuMask = ctypes.c_ulong * (1024 // _MASK_BITS)
+
+AUTO_SPREAD = 'auto'
+
+_rlimits = {
+    'rlimit_as': resource.RLIMIT_AS,
+    'rlimit_nofile': resource.RLIMIT_NOFILE,
+}
+
+
+def get_cpu_affinity(pid=0):
+    """Процессоры, на которых может выполняться процесс (0 -- текущий)
+
+    :return: список номеров процессоров
+    :raise OSError: если процесса нет
+    """
+    mask = _CpuMask()
+    if _libc.sched_getaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    return [
+        word * _MASK_BITS + bit
+        for word in range(len(mask)) for bit in range(_MASK_BITS)
+        if mask[word] >> bit & 1
+    ]
+
+
+def set_cpu_affinity(pid, cpus):
+    """Привязка процесса (0 -- текущий) к процессорам cpus
+
+    :raise OSError: если процесса нет или среди cpus нет доступных процессоров
+    """
+    mask = _CpuMask()
+    for cpu in cpus:
+        mask[cpu // _MASK_BITS] |= 1 << (cpu % _MASK_BITS)
+
+    if _libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def validate_resources(spec):
+    """Проверка описания ресурсов задачи
+
+    Spec example:
+        {
+            "cpus": [0, 1] или "auto",
+            "nice": 10,
+            "rlimit_as": 2147483648,
+            "rlimit_nofile": 4096
+        }
+
+    Все поля необязательные. "cpus": "auto" -- демон сам выбирает задаче одно ядро, равномерно
+    распределяя такие задачи по ядрам (см. CoreAllocator).
+
+    :raise ValueError: если описание некорректное
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('resources must be an object')
+
+    unknown = set(spec) - {'cpus', 'nice'} - set(_rlimits)
+    if unknown:
+        raise ValueError('unknown resources: %s' % ', '.join(sorted(unknown)))
+
+    cpus = spec.get('cpus')
+    if cpus is not None and cpus != AUTO_SPREAD:
+        if not isinstance(cpus, list) or not cpus or not all(_is_int(cpu) and 0 <= cpu < 1024 for cpu in cpus):
+            raise ValueError('cpus must be "auto" or a non-empty list of cpu numbers')
+
+    if 'nice' in spec and not (_is_int(spec['nice']) and -20 <= spec['nice'] <= 19):
+        raise ValueError('nice must be an integer from -20 to 19')
+
+    for name in _rlimits:
+        if name in spec and not (_is_int(spec[name]) and spec[name] >= 0):
+            raise ValueError('%s must be a non-negative integer' % name)
+
+
+def _is_int(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def apply_resources(spec):
+    """Применение описания ресурсов к текущему процессу (вызывается в задаче до ее запуска)
+
+    Поле cpus к этому моменту должно быть списком: "auto" заменяет на ядро демон.
+    """
+    if spec.get('cpus'):
+        set_cpu_affinity(0, spec['cpus'])
+
+    if 'nice' in spec:
+        os.nice(spec['nice'] - os.nice(0))
+
+    for name, limit in _rlimits.items():
+        if name in spec:
+            resource.setrlimit(limit, (spec[name], spec[name]))
+
+
+class CoreAllocator(object):
+    """Равномерное распределение задач с "cpus": "auto" по ядрам
+
+    Каждой такой задаче при запуске достается одно ядро с наименьшим числом задач (при равенстве --
+    следующее по кругу после выданного последним). Ядро резервируется до fork (acquire), а после
+    запуска закрепляется за pid (bind). Когда задача завершается (release), распределение
+    выравнивается: пока на самом загруженном ядре задач больше, чем на самом свободном, хотя бы на две,
+    одна задача переносится (rebalance возвращает переносы, привязку меняет вызывающий).
+    """
+    def __init__(self, cores):
+        """
+        :param cores: номера ядер, доступных для задач
+        """
+        self.cores = list(cores)
+        self._load = {core: 0 for core in self.cores}
+        self._pids = {core: [] for core in self.cores}
+        self._core_of = {}
+        self._next = 0
+
+    def acquire(self):
+        """Резервирование ядра под запускаемую задачу
+
+        :return: номер ядра
+        """
+        count = len(self.cores)
+        order = [self.cores[(self._next + i) % count] for i in range(count)]
+        core = min(order, key=self._load.get)
+        self._next = (self.cores.index(core) + 1) % count
+        self._load[core] += 1
+        return core
+
+    def cancel(self, core):
+        """Отмена резервирования, если задачу запустить не удалось"""
+        self._load[core] -= 1
+
+    def bind(self, pid, core):
+        """Закрепление зарезервированного ядра за запущенной задачей"""
+        self._pids[core].append(pid)
+        self._core_of[pid] = core
+
+    def assign(self, pid, core):
+        """Учет задачи, уже привязанной к ядру (например, пережившей перезапуск демона)"""
+        self._load[core] += 1
+        self.bind(pid, core)
+
+    def release(self, pid):
+        """Освобождение ядра завершившейся задачи
+
+        :return: True, если задача была размещена этим распределителем
+        """
+        core = self._core_of.pop(pid, None)
+        if core is None:
+            return False
+
+        self._pids[core].remove(pid)
+        self._load[core] -= 1
+        return True
+
+    def core_of(self, pid):
+        return self._core_of.get(pid)
+
+    def rebalance(self):
+        """Выравнивание распределения после завершения задач
+
+        :return: список переносов (pid, новое ядро)
+        """
+        moves = []
+        while True:
+            movable = [core for core in self.cores if self._pids[core]]
+            if not movable:
+                return moves
+
+            busiest = max(movable, key=self._load.get)
+            idlest = min(self.cores, key=self._load.get)
+            if self._load[busiest] - self._load[idlest] < 2:
+                return moves
+
+            pid = self._pids[busiest].pop()
+            self._load[busiest] -= 1
+            self._load[idlest] += 1
+            self._pids[idlest].append(pid)
+            self._core_of[pid] = idlest
+            moves.append((pid, idlest))
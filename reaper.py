@@ -0,0 +1,82 @@
+# coding: utf-8
+import errno
+import os
+import signal
+
+import tornado.ioloop
+
+
+def decode_wait_status(status):
+    """Разбор статуса завершения процесса из os.waitpid
+
+    :param status: int
+    :return: (код возврата, номер сигнала) -- как в subprocess, для убитого сигналом процесса
+        код возврата отрицательный, номер сигнала равен None, если процесс завершился сам
+    """
+    if os.WIFSIGNALED(status):
+        signum = os.WTERMSIG(status)
+        return -signum, signum
+
+    return os.WEXITSTATUS(status), None
+
+
+def reap_children():
+    """Неблокирующий сбор всех завершившихся дочерних процессов
+
+    :return: список (pid, код возврата, номер сигнала)
+    """
+    exits = []
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            break   # ECHILD: детей не осталось
+
+        if not pid:
+            break
+
+        returncode, signum = decode_wait_status(status)
+        exits.append((pid, returncode, signum))
+
+    return exits
+
+
+class Reaper(object):
+    """Сборщик завершившихся дочерних процессов демона
+
+    Обработчик SIGCHLD только планирует сбор на следующую итерацию ioloop (add_callback_from_signal),
+    сам сбор выполняется неблокирующим waitpid пачкой: за один вызов собираются все процессы,
+    завершившиеся к этому моменту, и передаются в on_exit одним списком.
+
+    Для SIGCHLD выставляется SA_RESTART (signal.siginterrupt), чтобы сигнал не прерывал
+    системные вызовы демона.
+    """
+    def __init__(self, on_exit, ioloop=None):
+        """
+        :param on_exit: callable, принимает список (pid, код возврата, номер сигнала)
+        :param ioloop: tornado.ioloop.IOLoop
+        """
+        self.on_exit = on_exit
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._reap_scheduled = False
+
+    def install(self):
+        signal.signal(signal.SIGCHLD, self._sighandler)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        # дети могли завершиться до установки обработчика
+        self.ioloop.add_callback(self.reap)
+
+    # noinspection PyUnusedLocal
+    def _sighandler(self, *args):
+        if not self._reap_scheduled:
+            self._reap_scheduled = True
+            self.ioloop.add_callback_from_signal(self.reap)
+
+    def reap(self):
+        self._reap_scheduled = False
+        exits = reap_children()
+        if exits:
+            self.on_exit(exits)
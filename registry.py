@@ -0,0 +1,220 @@
+# coding: utf-8
+import json
+import os
+from collections import OrderedDict
+
+from journal import Journal
+from utils import random_string
+
+
+class Table(object):
+    """Таблица процессов реестра
+
+    Записи хранятся в памяти. Первичный индекс -- по pid (он же определяет порядок записей),
+    вторичный -- по cmd. Поиск по pid выполняется за O(1), выборка по cmd -- за O(количества
+    найденных записей). Индексы обновляются при каждом изменении, в том числе при применении
+    журнала на старте, поэтому после перезапуска они восстанавливаются автоматически.
+
+    Каждое изменение передается реестру (log) для записи в журнал.
+    """
+    def __init__(self, name, log):
+        self.name = name
+        self._log = log
+        self._records = OrderedDict()
+        self._cmd_index = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def all(self):
+        return list(self._records.values())
+
+    def get(self, pid):
+        return self._records.get(pid)
+
+    def contains(self, pid):
+        return pid in self._records
+
+    def search_by_cmd(self, cmd):
+        return list(self._cmd_index.get(cmd, {}).values())
+
+    def count_by_cmd(self, cmd):
+        return len(self._cmd_index.get(cmd, ()))
+
+    def insert(self, record):
+        self._apply_insert(record)
+        self._log(['i', self.name, record])
+
+    def insert_many(self, records):
+        """Вставка пачки записей одной записью журнала"""
+        if not records:
+            return
+
+        for record in records:
+            self._apply_insert(record)
+        self._log(['I', self.name, records])
+
+    def remove(self, pid):
+        if self._apply_remove(pid) is not None:
+            self._log(['d', self.name, pid])
+
+    def purge(self):
+        self._apply_purge()
+        self._log(['p', self.name])
+
+    def _apply_insert(self, record):
+        pid = record['pid']
+        self._apply_remove(pid)
+        self._records[pid] = record
+        self._cmd_index.setdefault(record['cmd'], OrderedDict())[pid] = record
+
+    def _apply_remove(self, pid):
+        record = self._records.pop(pid, None)
+        if record is not None:
+            same_cmd_records = self._cmd_index[record['cmd']]
+            del same_cmd_records[pid]
+            if not same_cmd_records:
+                del self._cmd_index[record['cmd']]
+
+        return record
+
+    def _apply_purge(self):
+        self._records.clear()
+        self._cmd_index.clear()
+
+
+class ProcessRegistry(object):
+    """Реестр процессов демона agentd
+
+    Создается один раз при старте демона и разделяется между обработчиками обоих
+    серверов (web и unix сокет). Таблицы running и waiting живут в памяти.
+
+    Хранение на диске состоит из двух файлов:
+        * снимок состояния db_path (в формате TinyDB, идентификатор записи -- pid);
+        * журнал изменений journal_path (journal.Journal), куда дописываются все изменения таблиц.
+
+    При старте читается снимок, поверх него применяется журнал, после чего сохраняется новый
+    снимок и журнал обрезается. То же самое происходит, когда журнал вырастает до compact_threshold
+    записей, и при закрытии реестра. С флагом background запись на диск выполняется в отдельном
+    потоке (см. journal.Journal).
+
+    Каждое изменение таблиц увеличивает счетчик version. Вместе со случайной эпохой, которая
+    выбирается при каждом старте, он образует etag -- по нему клиенты могут понять, что
+    состояние реестра не изменилось, не запрашивая его целиком.
+    """
+    table_names = ('waiting', 'running')
+
+    def __init__(
+        self, db_path, journal_path, compact_threshold=10000, fsync=True, background=False, ioloop=None
+    ):
+        self.db_path = db_path
+        self.journal = Journal(
+            journal_path,
+            compact_threshold=compact_threshold,
+            compact_callback=self.compact,
+            fsync=fsync,
+            background=background,
+            ioloop=ioloop,
+        )
+        self.tables = {name: Table(name, self._log) for name in self.table_names}
+        self.epoch = random_string(8)
+        self.version = 0
+        self._load()
+
+    @property
+    def waiting(self):
+        return self.tables['waiting']
+
+    @property
+    def running(self):
+        return self.tables['running']
+
+    @property
+    def etag(self):
+        return '"%s-%s"' % (self.epoch, self.version)
+
+    def touch(self):
+        """Увеличение версии без изменения таблиц, для данных, которые отдаются вместе
+        с реестром, но в нем не хранятся (например, время heartbeat)"""
+        self.version += 1
+
+    def _log(self, entry):
+        self.version += 1
+        self.journal.append(entry)
+
+    def move(self, pid, src_name, dst_name):
+        """Перенос записи из одной таблицы в другую (например, из waiting в running)
+
+        В журнал пишется одна запись, поэтому перенос не может примениться наполовину.
+
+        :param pid: int
+        :param src_name: str
+        :param dst_name: str
+        :return: перенесенная запись или None, если записи не было
+        """
+        record = self._apply_move(pid, src_name, dst_name)
+        if record is not None:
+            self._log(['m', src_name, dst_name, pid])
+
+        return record
+
+    def _apply_move(self, pid, src_name, dst_name):
+        record = self.tables[src_name]._apply_remove(pid)
+        if record is not None:
+            self.tables[dst_name]._apply_insert(record)
+
+        return record
+
+    def _load(self):
+        if os.path.exists(self.db_path) and os.path.getsize(self.db_path):
+            with open(self.db_path) as f:
+                snapshot = json.load(f, object_pairs_hook=OrderedDict)
+
+            for name, table in self.tables.items():
+                for record in snapshot.get(name, {}).values():
+                    table._apply_insert(record)
+
+        for entry in self.journal.read():
+            op, table = entry[0], self.tables[entry[1]]
+            if op == 'i':
+                table._apply_insert(entry[2])
+            elif op == 'I':
+                for record in entry[2]:
+                    table._apply_insert(record)
+            elif op == 'd':
+                table._apply_remove(entry[2])
+            elif op == 'p':
+                table._apply_purge()
+            elif op == 'm':
+                self._apply_move(entry[3], entry[1], entry[2])
+
+        self.compact()
+
+    def compact(self):
+        """Сохранение снимка состояния и очистка журнала
+
+        Снимок собирается сразу, а записывается в порядке записи журнала (см. Journal.checkpoint):
+        сначала во временный файл, который затем атомарно переименовывается.
+        """
+        snapshot = {
+            name: OrderedDict((str(pid), record) for pid, record in table._records.items())
+            for name, table in self.tables.items()
+        }
+        data = json.dumps(snapshot, separators=(',', ':'))
+        self.journal.checkpoint(lambda: self._save_snapshot(data))
+
+    def _save_snapshot(self, data):
+        tmp_path = '%s.tmp' % self.db_path
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+            f.flush()
+            if self.journal.fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, self.db_path)
+
+    def close(self):
+        self.compact()
+        self.journal.close()
@@ -0,0 +1,234 @@
+# coding: utf-8
+import threading
+import time
+from collections import deque
+
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.concurrent import Future
+
+from admission import queue_order
+from commands.agentd_client import get_client, decode_response
+from commands.agentd_remote_commands import iter_events
+from events import EventBus
+from logger import create_logger
+from manager import ProcessInfoMixin
+from output import TaskOutputFiles
+from registry import Table
+
+
+# noinspection PyUnusedLocal
+def _skip_log(entry):
+    pass
+
+
+# noinspection PyProtectedMember
+class ProcessReplica(ProcessInfoMixin):
+    """Копия таблиц менеджера процессов для web процесса
+
+    Когда публичный API обслуживается несколькими процессами (--web_processes), менеджер
+    процессов и реестр живут только в процессе-супервизоре: он порождает и собирает задачи
+    и обслуживает unix сокет. Web процессы держат реплику, которая отвечает на чтение
+    (/info, /events) сама, а запуск задач передает супервизору.
+
+    Реплика загружает снимок состояния супервизора (/snapshot на unix сокете) и затем
+    применяет его поток событий (/events) начиная с номера снимка, так что все реплики
+    проходят через одни и те же состояния, а etag у них одинаковый (эпоха и номер события).
+    Поток читается в отдельном потоке, события применяются в ioloop. При обрыве потока
+    или событии reset снимок загружается заново.
+
+    Реплика отстает от супервизора на время доставки события. Запуск задач через реплику
+    завершается после того, как она получила события о запуске (но не дольше sync_timeout),
+    поэтому следующий /info к тому же web процессу уже видит новые процессы.
+
+    Вывод задач (/logs) реплика читает из файлов, которые пишет супервизор (output.TaskOutputFiles).
+    Каталог задач (/tasks) реплика читает сама, модули задач при этом не импортируются.
+    """
+    def __init__(
+        self,
+        url_prefix,
+        exited_history_size=100,
+        events_history_size=10000,
+        retry_sec=0.5,
+        sync_timeout=1.0,
+        output_folder=None,
+        catalog=None,
+        ioloop=None,
+    ):
+        """
+        :param url_prefix: адрес unix сокета супервизора
+        :param retry_sec: float, пауза перед повторной синхронизацией после ошибки
+        :param sync_timeout: float, сколько ждать событий о запущенных через реплику задачах
+        :param output_folder: каталог файлов с выводом задач (см. output.TaskOutput)
+        :param catalog: task_catalog.TaskCatalog
+        """
+        self.logger = create_logger('process_replica')
+        self.url_prefix = url_prefix
+        self.retry_sec = retry_sec
+        self.sync_timeout = sync_timeout
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self.catalog = catalog
+
+        self.running = Table('running', _skip_log)
+        self.waiting = Table('waiting', _skip_log)
+        self.exited = deque(maxlen=exited_history_size)
+        self._queued = {}
+        self._heartbeats = {}
+        self._resources = {}
+        self.events = EventBus(history_size=events_history_size)
+
+        self.ready = Future()
+        self._waiters = []
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.output = TaskOutputFiles(
+            output_folder, is_alive=self._is_alive, executor=ThreadPoolExecutor(max_workers=1), ioloop=self.ioloop
+        )
+
+    @property
+    def queued(self):
+        return sorted(self._queued.values(), key=queue_order)
+
+    @property
+    def etag(self):
+        return '"%s-%s"' % (self.events.epoch, self.events.seq)
+
+    def _is_alive(self, pid):
+        return self.running.contains(pid) or self.waiting.contains(pid)
+
+    def start(self):
+        thread = threading.Thread(target=self._sync, name='replica-sync')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._executor.shutdown(wait=False)
+
+    @gen.coroutine
+    def spawn_process(self, cmd, args, kwargs, resources=None, priority=0, registration_timeout=None):
+        """Запуск задачи через супервизор, см. ProcessManager.spawn_process
+
+        :return: Future с pid нового процесса
+        """
+        task = {
+            'cmd': cmd,
+            'args': args,
+            'kwargs': kwargs,
+            'resources': resources,
+            'priority': priority,
+            'registration_timeout': registration_timeout,
+        }
+        pids = yield self.spawn_processes([task])
+        raise gen.Return(pids[0])
+
+    @gen.coroutine
+    def spawn_processes(self, tasks):
+        """Запуск пачки задач через супервизор, см. ProcessManager.spawn_processes
+
+        :return: Future со списком pid
+        """
+        result = yield self._executor.submit(self._post, 'spawn_processes', {'tasks': tasks})
+        yield self._wait_for(result['seq'])
+        raise gen.Return(result['pids'])
+
+    def _post(self, handler, body):
+        response = get_client().post('%s/%s' % (self.url_prefix, handler), json=body)
+        response.raise_for_status()
+        return decode_response(response)['response']
+
+    def _wait_for(self, seq):
+        """Future, который завершится, когда реплика применит событие seq (или через sync_timeout)"""
+        future = Future()
+        if self.events.seq >= seq:
+            future.set_result(None)
+            return future
+
+        self._waiters.append((seq, future))
+        self.ioloop.call_later(self.sync_timeout, self._release, future)
+        return future
+
+    def _resolve_waiters(self):
+        pending = []
+        for seq, future in self._waiters:
+            if self.events.seq >= seq:
+                self._release(future)
+            else:
+                pending.append((seq, future))
+        self._waiters = pending
+
+    @staticmethod
+    def _release(future):
+        if not future.done():
+            future.set_result(None)
+
+    def _sync(self):
+        """Цикл синхронизации (выполняется в отдельном потоке)"""
+        while not self._stopped:
+            # noinspection PyBroadException
+            try:
+                response = get_client().get('%s/snapshot' % self.url_prefix)
+                response.raise_for_status()
+                snapshot = decode_response(response)['response']
+                self.ioloop.add_callback(self._apply_snapshot, snapshot)
+
+                since = '%s-%s' % (snapshot['epoch'], snapshot['seq'])
+                for event in iter_events(url_prefix=self.url_prefix, since=since):
+                    if event['type'] == 'reset':
+                        break
+                    self.ioloop.add_callback(self._apply_event, event)
+                continue
+            except Exception as e:
+                if not self._stopped:
+                    self.logger.warning('Replica sync with %s failed: %r' % (self.url_prefix, e))
+
+            time.sleep(self.retry_sec)
+
+    def _apply_snapshot(self, snapshot):
+        for table in (self.running, self.waiting):
+            table._apply_purge()
+        for record in snapshot['running']:
+            self.running._apply_insert(record)
+        for record in snapshot['waiting']:
+            self.waiting._apply_insert(record)
+
+        self.exited.clear()
+        self.exited.extend(snapshot['exited'])
+        self._queued = {entry['id']: entry for entry in snapshot['queued']}
+        self._heartbeats = dict(snapshot['heartbeats'])
+        self._resources = {pid: (cpu, rss) for pid, cpu, rss in snapshot['resources']}
+
+        self.events.reset(snapshot['epoch'], snapshot['seq'])
+        self._resolve_waiters()
+        if not self.ready.done():
+            self.ready.set_result(None)
+
+    def _apply_event(self, event):
+        type_, pid, data = event['type'], event['pid'], event['data']
+        if type_ == 'spawn':
+            self.waiting._apply_insert(data)
+        elif type_ == 'register':
+            self.waiting._apply_remove(pid)
+            self.running._apply_insert(data)
+        elif type_ == 'unlink':
+            self.running._apply_remove(pid)
+        elif type_ in ('expire', 'remove'):
+            self.waiting._apply_remove(pid)
+        elif type_ == 'exit':
+            self.running._apply_remove(pid)
+            self.waiting._apply_remove(pid)
+            self._heartbeats.pop(pid, None)
+            self._resources.pop(pid, None)
+            self.exited.append(data)
+        elif type_ == 'heartbeat':
+            self._heartbeats[pid] = event['time']
+        elif type_ == 'resources':
+            self._resources = {pid_: (cpu, rss) for pid_, cpu, rss in data}
+        elif type_ == 'enqueue':
+            self._queued[data['id']] = data
+        elif type_ == 'dequeue':
+            self._queued.pop(data['id'], None)
+
+        self.events.mirror(event)
+        self._resolve_waiters()
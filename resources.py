@@ -0,0 +1,142 @@
+# coding: utf-8
+import os
+import time
+
+import tornado.ioloop
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import create_logger
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_proc_stat(pid):
+    """Потребление ресурсов процессом по /proc/<pid>/stat
+
+    В stat есть и время процессора (utime + stime), и резидентная память (rss, то же, что второе
+    поле statm), поэтому на процесс читается один файл. Время старта процесса нужно, чтобы
+    отличить новый процесс с тем же pid.
+
+    :return: (utime + stime в тиках, время старта в тиках, rss в байтах) или None, если процесса нет
+    """
+    try:
+        fd = os.open('/proc/%d/stat' % pid, os.O_RDONLY)
+    except OSError:
+        return None
+
+    try:
+        data = os.read(fd, 4096)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+    # имя процесса в скобках может содержать пробелы, поля считаются после последней скобки
+    fields = data[data.rfind(')') + 2:].split()
+    if len(fields) < 22:
+        return None
+
+    return int(fields[11]) + int(fields[12]), int(fields[19]), int(fields[21]) * PAGE_SIZE
+
+
+def read_boot_time():
+    """Время загрузки системы (btime из /proc/stat) или None, если его не удалось прочитать"""
+    try:
+        with open('/proc/stat') as f:
+            for line in f:
+                if line.startswith('btime '):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def is_same_process(pid, spawned_at, tolerance=2.0):
+    """Тот ли это процесс, что был запущен в spawned_at (а не другой, получивший тот же pid)
+
+    Время старта процесса берется из /proc/<pid>/stat и сравнивается с spawned_at с точностью
+    до tolerance секунд (время загрузки системы известно с точностью до секунды).
+
+    :return: False, если процесса нет или он запущен в другое время
+    """
+    stat = read_proc_stat(pid)
+    boot_time = read_boot_time()
+    if stat is None or boot_time is None:
+        return False
+    return abs(boot_time + float(stat[1]) / CLOCK_TICKS - spawned_at) <= tolerance
+
+
+def read_proc_stats(pids):
+    """Чтение /proc/<pid>/stat для пачки процессов
+
+    :return: (время замера, {pid: результат read_proc_stat}) без завершившихся процессов
+    """
+    stats = {}
+    for pid in pids:
+        stat = read_proc_stat(pid)
+        if stat is not None:
+            stats[pid] = stat
+
+    return time.time(), stats
+
+
+class ResourceSampler(object):
+    """Периодический замер потребления CPU и памяти процессами задач
+
+    Раз в interval секунд список pid берется из get_pids, /proc всех процессов читается одним
+    проходом в отдельном потоке, а результат обрабатывается в ioloop. Загрузка CPU считается
+    по приросту времени процессора с предыдущего замера, т.е. это среднее за последний интервал;
+    для процесса, замеренного впервые, она еще неизвестна (None). Если прошлый проход еще
+    не закончился, очередной пропускается.
+
+    Результат передается в on_sample словарем {pid: (cpu_percent, rss_bytes)}.
+    """
+    def __init__(self, get_pids, on_sample, interval=5.0, ioloop=None):
+        """
+        :param get_pids: callable, возвращает список pid для замера
+        :param on_sample: callable, принимает {pid: (cpu_percent, rss_bytes)}
+        :param interval: float, период замера в секундах
+        """
+        self.logger = create_logger('resource_sampler')
+        self.get_pids = get_pids
+        self.on_sample = on_sample
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._previous = {}
+        self._in_progress = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._periodic = tornado.ioloop.PeriodicCallback(self.sample, interval * 1000)
+
+    def start(self):
+        self._periodic.start()
+
+    def stop(self):
+        self._periodic.stop()
+        self._executor.shutdown(wait=False)
+
+    def sample(self):
+        if self._in_progress:
+            return
+
+        self._in_progress = True
+        future = self._executor.submit(read_proc_stats, self.get_pids())
+        self.ioloop.add_future(future, self._on_read)
+
+    def _on_read(self, future):
+        self._in_progress = False
+        try:
+            sampled_at, stats = future.result()
+        except Exception as e:
+            self.logger.error('Failed to read /proc: %r' % e)
+            return
+
+        usage, previous = {}, self._previous
+        for pid, (cpu_ticks, started_at, rss_bytes) in stats.items():
+            cpu_percent = None
+            last = previous.get(pid)
+            if last is not None and last[1] == started_at and sampled_at > last[2]:
+                cpu_percent = round(100.0 * (cpu_ticks - last[0]) / CLOCK_TICKS / (sampled_at - last[2]), 1)
+            usage[pid] = (cpu_percent, rss_bytes)
+
+        self._previous = {pid: (stat[0], stat[1], sampled_at) for pid, stat in stats.items()}
+        self.on_sample(usage)
@@ -1,22 +1,88 @@
+# coding: utf-8
 import os
 from tornado.options import define, parse_command_line, options
 
 define("port", default="8888")
+define("zygote", default=False, type=bool, help="spawn tasks through a pre-started fork-server process")
+define("web_processes", default=1, type=int, help="number of processes serving the public port")
+define("log_async", default=True, type=bool, help="write logs from a background thread in batches")
+define("hosts", type=str, multiple=True, help="comma separated agentd addresses for global orchestration")
 parse_command_line()
 
 base_folder = os.path.abspath('./run')
 log_folder = os.path.abspath('./log')
+# асинхронная запись логов пачками (см. logger.AsyncFileHandler)
+log_async = options.log_async
+log_queue_size = 10000
+log_batch_size = 500
+log_flush_interval_sec = 0.2
+# ротация логов по размеру и/или по времени (0 и None -- без ротации)
+log_max_bytes = 100 * 1024 * 1024
+log_backup_count = 5
+log_rotate_interval_sec = None
+
+# вывод задач (stdout и stderr): последние строки в памяти, полный вывод в файлах (см. output.TaskOutput)
+task_output_folder = os.path.join(log_folder, 'tasks')
+task_output_buffer_lines = 1000
+task_output_max_file_bytes = 10 * 1024 * 1024
 
 db_path = os.path.join(base_folder, 'db.json')
+journal_path = os.path.join(base_folder, 'db.journal')
+journal_compact_threshold = 10000
+journal_fsync = True
+journal_background = True
+
+exited_history_size = 100
+events_history_size = 10000
+events_keepalive_sec = 15
 unix_socket_path = os.path.join(base_folder, 'agent.sock')
 unix_socket_url_prefix = 'http+unix://%s' % unix_socket_path.replace('/', '%2F')
 
 port = options.port
+zygote_enabled = options.zygote
+web_processes = options.web_processes
 local_host_prefix = 'http://localhost:%s' % port
 
-hosts = [
+client_connect_timeout = 1.0
+client_read_timeout = 10.0
+client_retries = 2
+client_pool_maxsize = 10
+
+fanout_deadline = 5.0
+fanout_max_workers = 32
+
+handler_executor_max_workers = 4
+handler_executor_max_pending = 64
+spawn_executor_max_pending = 64
+
+metrics_lag_interval_sec = 0.5
+resources_sample_interval_sec = 5.0
+
+# лимиты на количество процессов задач (None -- без лимита), задачи сверх лимита ждут в очереди запуска
+max_processes = 1024
+max_processes_per_cmd = {}
+run_queue_size = 10000
+# пауза перед повторной попыткой запустить задачи из очереди, если пул запуска был переполнен
+run_queue_retry_sec = 0.5
+
+# каталог задач (модуль с dict catalog, см. task_catalog.TaskCatalog) и как часто проверять изменения
+# каталога и модулей задач (None -- без перезагрузки)
+task_catalog_module = 'tasks'
+task_reload_interval_sec = 2.0
+
+# сколько секунд процесс задачи может не регистрироваться, после этого он завершается (None -- без ограничения)
+registration_timeout_sec = 60.0
+
+replica_retry_sec = 0.5
+replica_sync_timeout = 1.0
+
+# адреса демонов для глобальной оркестрации (set_workers_globally), можно задать параметром --hosts
+hosts = options.hosts or [
     'http://localhost:8001',
     'http://localhost:8002'
 ]
 
-random_workers_path = os.path.join(os.path.dirname(__file__), 'random_workers')
+# каталог файлов воркеров, как и run и log, -- относительно текущего каталога демона
+random_workers_path = os.path.abspath('./random_workers')
+# ресурсы воркеров, которые запускает set_workers (см. placement.validate_resources)
+workers_resources = {'cpus': 'auto'}
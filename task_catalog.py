@@ -0,0 +1,254 @@
+# coding: utf-8
+import importlib
+import os
+import sys
+import time
+import traceback as tb
+
+_spec_fields = ('path', 'description', 'registration_timeout', 'max_processes', 'preload')
+
+
+class TaskCatalogError(Exception):
+    pass
+
+
+def split_path(path):
+    """Путь к задаче вида "tasks.tasks_workers:worker" -> ("tasks.tasks_workers", "worker")"""
+    module_name, _, attr = path.partition(':')
+    return module_name, attr
+
+
+def parse_catalog(definition):
+    """Проверка описания каталога задач
+
+    Definition example:
+        {
+            "worker": {
+                "path": "tasks.tasks_workers:worker",
+                "description": "Воркер, обрабатывающий файлы из каталога",
+                "registration_timeout": 30,
+                "max_processes": 8,
+                "preload": true
+            }
+        }
+
+    Обязателен только path. registration_timeout -- сколько секунд ждать регистрации процесса
+    задачи (если не задан при запуске), max_processes -- лимит процессов задачи (если для нее
+    нет settings.max_processes_per_cmd), preload -- импортировать модуль задачи при старте демона.
+
+    :return: dict имя задачи -> описание со всеми полями
+    :raise ValueError: если описание некорректное
+    """
+    if not isinstance(definition, dict):
+        raise ValueError('task catalog must be a dict')
+
+    entries = {}
+    for name, spec in definition.items():
+        if not isinstance(spec, dict):
+            raise ValueError('task %s: spec must be a dict' % name)
+
+        unknown = set(spec) - set(_spec_fields)
+        if unknown:
+            raise ValueError('task %s: unknown fields: %s' % (name, ', '.join(sorted(unknown))))
+
+        module_name, attr = split_path(spec.get('path') or '')
+        if not module_name or not attr:
+            raise ValueError('task %s: path must look like "module:callable"' % name)
+
+        timeout = spec.get('registration_timeout')
+        if timeout is not None and (not isinstance(timeout, (int, long, float)) or isinstance(timeout, bool)
+                                    or timeout <= 0):
+            raise ValueError('task %s: registration_timeout must be a positive number' % name)
+
+        limit = spec.get('max_processes')
+        if limit is not None and (not isinstance(limit, (int, long)) or isinstance(limit, bool) or limit <= 0):
+            raise ValueError('task %s: max_processes must be a positive integer' % name)
+
+        entry = {field: None for field in _spec_fields}
+        entry.update(spec, preload=bool(spec.get('preload')))
+        entries[name] = entry
+
+    return entries
+
+
+def source_mtime(module):
+    """Время изменения исходника модуля или None, если исходника нет"""
+    path = source_path(module)
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+def source_path(module):
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return None
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def reload_source(module):
+    """Повторное выполнение исходника модуля в его же пространстве имен (как reload)
+
+    Исходник компилируется заново, а не берется из .pyc: в python 2 .pyc сверяется
+    с исходником по времени изменения с точностью до секунды и мог бы оказаться устаревшим.
+    """
+    path = source_path(module)
+    with open(path, 'rb') as f:
+        code = compile(f.read(), path, 'exec')
+    exec(code, module.__dict__)
+
+
+class TaskCatalog(object):
+    """Каталог задач: публичные имена задач, пути к ним и параметры запуска
+
+    Каталог описывается dict'ом catalog в модуле module_name (см. parse_catalog). Сам модуль
+    каталога легкий, модули задач он не импортирует: это делает TaskLoader в процессе,
+    который порождает задачи, при первом запуске задачи или заранее (preload).
+
+    Если задан reload_interval, то не чаще раза в reload_interval секунд (при обращении к refresh)
+    проверяется время изменения модуля каталога, и измененный каталог перечитывается без
+    перезапуска демона. Если новый каталог некорректен, остается прежний.
+    """
+    def __init__(self, module_name, reload_interval=None):
+        self.module_name = module_name
+        self.reload_interval = reload_interval
+        self._module = importlib.import_module(module_name)
+        self._mtime = source_mtime(self._module)
+        self._checked_at = time.time()
+        try:
+            self._entries = parse_catalog(getattr(self._module, 'catalog', None))
+        except ValueError as e:
+            raise TaskCatalogError('Invalid task catalog %s: %s' % (module_name, e))
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """Описание задачи name или None, если такой задачи нет"""
+        return self._entries.get(name)
+
+    def max_processes(self, name):
+        spec = self._entries.get(name)
+        return spec and spec['max_processes']
+
+    def registration_timeout(self, name):
+        spec = self._entries.get(name)
+        return spec and spec['registration_timeout']
+
+    def preload_paths(self):
+        return sorted(spec['path'] for spec in self._entries.values() if spec['preload'])
+
+    def describe(self):
+        """Описания всех задач для /tasks, упорядоченные по имени"""
+        return [dict(spec, name=name) for name, spec in sorted(self._entries.items())]
+
+    def refresh(self):
+        """Перечитывание каталога, если его модуль изменился
+
+        :return: True, если каталог перечитан
+        :raise TaskCatalogError: если измененный каталог не удалось загрузить (ошибка
+            сообщается один раз на каждое изменение модуля)
+        """
+        now = time.time()
+        if self.reload_interval is None or now - self._checked_at < self.reload_interval:
+            return False
+
+        self._checked_at = now
+        mtime = source_mtime(self._module)
+        if mtime == self._mtime:
+            return False
+
+        self._mtime = mtime
+        try:
+            reload_source(self._module)
+            self._entries = parse_catalog(getattr(self._module, 'catalog', None))
+        except Exception:
+            raise TaskCatalogError('Failed to reload task catalog %s:\n%s' % (self.module_name, tb.format_exc()))
+        return True
+
+
+class _LoadedModule(object):
+    def __init__(self, module):
+        self.module = module
+        self.mtime = source_mtime(module)
+        self.checked_at = time.time()
+        self.error = None
+
+
+class TaskLoader(object):
+    """Импорт задач по путям из каталога (см. TaskCatalog) с перезагрузкой измененных модулей
+
+    Модуль задачи импортируется при первом load, поэтому тяжелые зависимости задач
+    не замедляют старт демона. Задачи порождаются fork'ом процесса, в котором работает
+    загрузчик (зиготы или самого демона), так что импортированный один раз модуль достается
+    всем следующим задачам готовым.
+
+    Если задан reload_interval, то при load не чаще раза в reload_interval секунд проверяется
+    время изменения исходника модуля, и измененный модуль выполняется заново (reload_source).
+    Перезагружаются только сами модули задач, но не модули, которые они импортируют. Если
+    перезагрузка не удалась, задачи модуля не запускаются, пока исходник не изменится снова.
+    """
+    def __init__(self, reload_interval=None):
+        self.reload_interval = reload_interval
+        self._modules = {}
+        self._created_at = time.time()
+
+    def load(self, path):
+        """Объект задачи по пути вида "module:callable"
+
+        :raise TaskCatalogError: если задачи нет или ее модуль не удалось перезагрузить
+        :raise ImportError: и любые другие исключения при первом импорте модуля
+        """
+        module_name, attr = split_path(path)
+        module = self._load_module(module_name)
+        callable_ = getattr(module, attr, None)
+        if callable_ is None:
+            raise TaskCatalogError('Module %s has no task %s' % (module_name, attr))
+        return callable_
+
+    def preload(self, paths):
+        """Импорт модулей задач paths заранее
+
+        :return: список (путь, текст ошибки) для задач, которые загрузить не удалось
+        """
+        errors = []
+        for path in paths:
+            # noinspection PyBroadException
+            try:
+                self.load(path)
+            except Exception:
+                errors.append((path, tb.format_exc()))
+        return errors
+
+    def _load_module(self, module_name):
+        loaded = self._modules.get(module_name)
+        if loaded is None:
+            imported = module_name in sys.modules
+            loaded = self._modules[module_name] = _LoadedModule(importlib.import_module(module_name))
+            if not imported or (loaded.mtime or 0) <= self._created_at:
+                return loaded.module
+
+            # модуль импортирован раньше, чем создан загрузчик (например, модуль каталога в демоне
+            # до fork зиготы), и с тех пор изменился
+            loaded.mtime = None
+            loaded.checked_at = 0
+
+        now = time.time()
+        if self.reload_interval is not None and now - loaded.checked_at >= self.reload_interval:
+            loaded.checked_at = now
+            mtime = source_mtime(loaded.module)
+            if mtime != loaded.mtime:
+                loaded.mtime = mtime
+                # noinspection PyBroadException
+                try:
+                    reload_source(loaded.module)
+                    loaded.error = None
+                except Exception:
+                    loaded.error = 'Failed to reload %s:\n%s' % (module_name, tb.format_exc())
+
+        if loaded.error is not None:
+            raise TaskCatalogError(loaded.error)
+        return loaded.module
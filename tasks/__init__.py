@@ -2,9 +2,34 @@
 import time
 
 from commands.agentd_local_commands import unlink_at_exit, register_as_successfully_started
-from tasks_workers import set_workers as set_workers_task
-from tasks_workers import set_workers_globally as set_workers_globally_task
-from tasks_workers import worker as worker_task
+
+# каталог задач: публичное имя задачи, под которым она доступна для выполнения извне с помощью
+# web обработчика в agentd, путь к ней и параметры запуска (см. task_catalog.parse_catalog).
+# модули задач импортируются демоном при первом запуске задачи (или заранее, если preload),
+# изменения этого каталога и модулей задач подхватываются без перезапуска демона
+catalog = {
+    'sleep': {
+        'path': 'tasks:sleep',
+        'description': 'Пример задачи: регистрируется и спит num_sec секунд',
+    },
+    'noop': {
+        'path': 'tasks.tasks_bench:noop',
+        'description': 'Пустая задача для бенчмарков: регистрируется и сразу разрегистрируется',
+    },
+    'worker': {
+        'path': 'tasks.tasks_workers:worker',
+        'description': 'Пример воркера: дописывает случайный текст в файл name до получения SIGTERM',
+        'preload': True,
+    },
+    'set_workers': {
+        'path': 'tasks.tasks_workers:set_workers',
+        'description': 'Локальный оркестратор: доводит число воркеров на хосте до num',
+    },
+    'set_workers_globally': {
+        'path': 'tasks.tasks_workers:set_workers_globally',
+        'description': 'Глобальный оркестратор: распределяет num воркеров по хостам из settings.hosts',
+    },
+}
 
 
 @unlink_at_exit
@@ -12,21 +37,13 @@ def sleep(num_sec):
     """Пример задачи для выполнения.
 
     Типичная задача перед началом полезной работы должна отправить подтверждение
-    об успешном запуске с помощью вызова метода register_as_successfully_started,
-    а также перед своим завершением отправить менежеру процессов запрос на удаление.
-    Запрос на удаление можно слать вручную с помощью unlink_as_successfully_completed,
-    а можно воспользоваться декоратором unlink_at_exit
+    об успешном запуске с помощью вызова метода register_as_successfully_started.
+    После завершения процесса демон сам удалит его из списка работающих, но задача
+    может сделать это и явно перед своим завершением: вручную с помощью
+    unlink_as_successfully_completed или декоратором unlink_at_exit
 
     :param num_sec: int
     :return:
     """
     register_as_successfully_started()
     time.sleep(num_sec)
-
-# ниже перечислены остальные задачи. такие странные присваивания сделаны для
-# единообразия, а также чтобы зафиксировать публичное имя задачи, под которым
-# она будет доступна для выполнения извне с помощью web обработчика в agentd
-
-worker = worker_task
-set_workers = set_workers_task
-set_workers_globally = set_workers_globally_task
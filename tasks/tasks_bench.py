@@ -0,0 +1,26 @@
+# coding: utf-8
+import os
+
+from commands.agentd_client import get_client
+from commands.agentd_local_commands import register_as_successfully_started, unlink_as_successfully_completed
+from settings import unix_socket_url_prefix
+
+
+def noop(via_http=False):
+    """Пустая задача: регистрируется и сразу разрегистрируется
+
+    Нужна для замера накладных расходов самого демона на запуск, регистрацию и разрегистрацию
+    задачи (см. benchmarks/api_latency_bench.py).
+
+    :param via_http: bool, отправлять сообщения http запросами на unix сокет (/register_process
+        и /unlink_process), как это делает процесс, запущенный не демоном, а не по каналу задачи
+    :return:
+    """
+    if not via_http:
+        register_as_successfully_started()
+        unlink_as_successfully_completed()
+        return
+
+    client = get_client()
+    for handler in ('register_process', 'unlink_process'):
+        client.post('%s/%s' % (unix_socket_url_prefix, handler), json={'pid': os.getpid()}).raise_for_status()
@@ -1,15 +1,109 @@
 # coding: utf-8
+import errno
 import os
 import random
 import signal
 import string
 import sys
 import time
-from bisect import bisect
 
-from commands.agentd_local_commands import unlink_at_exit, register_as_successfully_started, stop_registered_process
-from commands.agentd_remote_commands import info, cumulative_info, run_task
-from settings import random_workers_path
+from commands.agentd_local_commands import unlink_at_exit, register_as_successfully_started, stop_registered_process, \
+    send_heartbeat
+from commands.agentd_remote_commands import info, cumulative_info, run_tasks, run_task_on_hosts
+from settings import random_workers_path, workers_resources
+
+
+def _water_fill(levels, amount):
+    """Поднятие наименьших уровней на amount единиц в сумме
+
+    Уровни поднимаются "заливкой": находится такой уровень level, что все значения ниже него
+    поднимаются до level, а остаток (меньше числа поднятых значений) раздается по одному.
+
+    :param levels: list of int, отсортированный по возрастанию
+    :param amount: int >= 0
+    :return: list of int -- новые уровни в том же порядке
+    """
+    n = len(levels)
+    prefix = 0
+    for j in range(1, n + 1):
+        prefix += levels[j - 1]
+        # поднять первые j значений до следующего уровня -- хватает ли amount
+        if j < n and levels[j] * j - prefix <= amount:
+            continue
+
+        level, extra = divmod(amount + prefix, j)
+        return [level + 1 if i < extra else level for i in range(j)] + levels[j:]
+
+    return levels
+
+
+def plan_workers(host_to_workers_num, num):
+    """Распределение num воркеров по хостам
+
+    Если воркеров не хватает, то недостающие добавляются на хосты с наименьшим числом воркеров,
+    если воркеров слишком много, то лишние убираются с хостов с наибольшим числом воркеров,
+    так что воркеры размазываются по хостам как можно равномернее. Целевые значения считаются
+    сразу, за O(H log H), а не добавлением/удалением по одному воркеру.
+
+    :param host_to_workers_num: dict, хост -> текущее число воркеров
+    :param num: int, требуемое суммарное число воркеров
+    :return: dict, хост -> целевое число воркеров
+    """
+    if not host_to_workers_num:
+        return {}
+
+    total_workers_num = sum(host_to_workers_num.values())
+    sort_key = lambda host: (host_to_workers_num[host], host)
+
+    if total_workers_num <= num:
+        hosts_order = sorted(host_to_workers_num, key=sort_key)
+        targets = _water_fill([host_to_workers_num[host] for host in hosts_order], num - total_workers_num)
+    else:
+        # убирание лишних -- та же заливка для значений с обратным знаком
+        hosts_order = sorted(host_to_workers_num, key=sort_key, reverse=True)
+        targets = [
+            -target for target in
+            _water_fill([-host_to_workers_num[host] for host in hosts_order], total_workers_num - num)
+        ]
+
+    return dict(zip(hosts_order, targets))
+
+
+def plan_workers_globally(num):
+    """План глобальной оркестрации воркеров без его выполнения
+
+    Хосты, не ответившие за отведенное время, в распределении не участвуют.
+
+    Result example:
+        {
+            "num": 10,
+            "plan": {
+                "http://localhost:8001": {"current": 2, "target": 5},
+                "http://localhost:8002": {"current": 7, "target": 5}
+            },
+            "hosts": {
+                "http://localhost:8001": {"ok": true, "latency_sec": 0.012, "error": null},
+                ...
+            }
+        }
+
+    :param num: int
+    :return: dict
+    """
+    # достаем данные о running воркерах на всех хостах (фильтрация выполняется демонами)
+    all_info = cumulative_info(cmd='worker', states=['running'], fields=['pid'])
+    host_to_workers_num = {
+        host: len(processes_data) for host, processes_data in all_info['running'].items()
+    }
+    targets = plan_workers(host_to_workers_num, num)
+
+    return {
+        'num': num,
+        'plan': {
+            host: {'current': host_to_workers_num[host], 'target': target} for host, target in targets.items()
+        },
+        'hosts': all_info['hosts'],
+    }
 
 
 @unlink_at_exit
@@ -20,47 +114,29 @@ def set_workers_globally(num):
     демонами agentd. Эта задача должна выполняться на одном из серверов, которому
     известны адреса всех остальных.
 
-    После выполнения задачи гарантируется, что суммарное количество воркеров
-    на всех известных хостах будет равным num.
+    num воркеров распределяется по хостам, ответившим на опрос (см. plan_workers_globally).
+    Если ответили все хосты, то после выполнения задачи суммарное количество воркеров
+    на всех известных хостах будет равным num. Хосты, не ответившие вовремя или ответившие
+    ошибкой, пропускаются, и их воркеры не учитываются: суммарное количество воркеров
+    с ними может оказаться больше num. Повторный запуск, когда хосты снова доступны,
+    доводит сумму до num.
+
+    План распределения (см. plan_workers_globally) можно посмотреть без выполнения
+    запросом GET /plan_workers_globally?num=N к демону.
 
     :param num: int
     :return:
     """
     register_as_successfully_started()
 
-    # достаем данные обо всех процессах на всех хостах, оставляем только running
-    all_info = cumulative_info()['running']
-
-    # подсчитываем статистику
-
-    host_to_workers_num = {host: len(processes_data) for host, processes_data in all_info.items()}
-    workers_to_host_list = [[workers_num, h] for h, workers_num in host_to_workers_num.items()]
-    total_workers_num = sum(w for w, h in workers_to_host_list)
-
-    # round-robin стратегией подбираем такие цифры, чтобы количество воркеров
-    # на всех машинах было равным num, а воркеры были размазаны по машинам
-    # как можно равномернее
-    #
-    # если суммарное количество воркеров меньше необходимого, то воркеры будут
-    # итеративно добавляться по одному, начиная с машин с наименьшим числом воркеров.
-    # если воркеров было слишком много, то они будут итеративно убираться по одному,
-    # начиная с машин с наибольшим количеством воркеров
-    natural_order = total_workers_num > num
-    handicap_value = -1 if total_workers_num > num else +1
-
-    total_redundat_workers_num = total_workers_num - num
-    while total_redundat_workers_num:
-        workers_to_host_list.sort(reverse=not natural_order)
-        record = [workers_num, host] = list(workers_to_host_list.pop())
-        record[0] += handicap_value
-        ind_to_insert = bisect(workers_to_host_list, record)
-        workers_to_host_list.insert(ind_to_insert, record)
-        total_redundat_workers_num += handicap_value
-
-    # отправляем демонам на удаленных хостах задачи для локальной оркестрации
-    # в соответствии с полученными выше цифрами
-    for num, host in workers_to_host_list:
-        run_task(cmd='set_workers', kwargs={'num': num}, url_prefix=host)
+    plan = plan_workers_globally(num)['plan']
+
+    # отправляем демонам задачи для локальной оркестрации, параллельно и только
+    # на те хосты, где количество воркеров должно измениться
+    run_task_on_hosts(cmd='set_workers', host_to_kwargs={
+        host: {'num': host_plan['target']}
+        for host, host_plan in plan.items() if host_plan['target'] != host_plan['current']
+    })
 
 
 @unlink_at_exit
@@ -80,19 +156,13 @@ def set_workers(num, *args, **kwargs):
     if num < 0:
         return
 
-    # достаем данные обо всех процессах на этом хосте
-    all_info = info()
-
-    # отфильтровываем только процессы с воркерами
-    worker_info = {
-        process_type: {
-            process_data['pid']: process_data for process_data in processes_list if process_data['cmd'] == 'worker'
-        } for process_type, processes_list in all_info.items()
-    }
-
+    # достаем данные о running воркерах на этом хосте
+    # (фильтрация по cmd выполняется демоном по индексу)
     # todo: check if `waiting` worker becomes `running` and kill him
-    # оставляем только running
-    workers_data = worker_info['running']
+    workers_data = {
+        process_data['pid']: process_data
+        for process_data in info(cmd='worker', states=['running'], fields=['pid', 'kwargs'])['running']
+    }
 
     if len(workers_data) > num:
         # процессов больше, чем нужно -- случайным образом выбираем жертв
@@ -116,9 +186,10 @@ def set_workers(num, *args, **kwargs):
             if len(not_free_names) >= num:
                 break
 
-        # и отправляем демону запрос на создание новых воркеров
-        for name in new_names:
-            run_task(cmd='worker', kwargs={'name': name})
+        # и отправляем демону один запрос на создание всех новых воркеров
+        run_tasks([
+            {'cmd': 'worker', 'kwargs': {'name': new_name}, 'resources': workers_resources} for new_name in new_names
+        ])
 
 
 @unlink_at_exit
@@ -138,6 +209,12 @@ def worker(name, path=random_workers_path):
     """
     register_as_successfully_started()
 
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
     # noinspection PyUnusedLocal
     def _terminate(signum, frame):
         os.unlink(file_path)
@@ -146,6 +223,7 @@ def worker(name, path=random_workers_path):
 
     file_path = os.path.join(path, '%s.txt' % name)
     while True:
+        send_heartbeat()
         with open(file_path, 'a') as f:
             f.write(''.join(random.sample(string.ascii_lowercase, 16)) + '\n')
         time.sleep(random.randint(3, 7))
@@ -1,40 +1,102 @@
+# coding: utf-8
+import fcntl
 import json
+import os
 import random
 import string
 from functools import wraps
 
+from tornado import gen
 from tornado.web import HTTPError
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
 
 def random_string(length=16):
     return ''.join([random.choice(string.ascii_lowercase) for _ in range(length)])
 
 
-def json_content(func):
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _encode(handler, result):
+    """Кодирование ответа в формат, который запросил клиент
+
+    :return: (content type, тело ответа)
+    """
+    accept = handler.request.headers.get('Accept', '')
+    if msgpack is not None and MSGPACK_CONTENT_TYPE in accept:
+        return MSGPACK_CONTENT_TYPE, msgpack.packb(result, use_bin_type=False)
+
+    if handler.get_argument('pretty', None) in ('1', 'true'):
+        return JSON_CONTENT_TYPE, json.dumps(result, indent=4, ensure_ascii=False) + '\n'
+
+    return JSON_CONTENT_TYPE, json.dumps(result, separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def encoded_content(func):
+    """Запись результата обработчика в ответ
+
+    Формат выбирается по заголовку Accept: application/msgpack, если клиент его принимает
+    и установлен пакет msgpack, иначе компактный json. С параметром ?pretty=1 json
+    отдается с отступами.
+    """
     @wraps(func)
+    @gen.coroutine
     def wrapped(self, *args, **kwargs):
-        result = func(self, *args, **kwargs)
-        self.add_header('Content-Type', 'application/json')
+        result = yield gen.maybe_future(func(self, *args, **kwargs))
+        content_type, body = _encode(self, result)
+        self.set_header('Content-Type', content_type)
+        self.add_header('Vary', 'Accept')
 
-        self.write(json.dumps(result, indent=4, ensure_ascii=False))
-        self.write('\n')
+        self.write(body)
     return wrapped
 
 
 def wrap_with_success_value(func):
     @wraps(func)
+    @gen.coroutine
     def wrapped(self, *args, **kwargs):
-        result = func(self, *args, **kwargs)
+        result = yield gen.maybe_future(func(self, *args, **kwargs))
         success = {'success': 1}
 
         if result is None:
-            return success
+            raise gen.Return(success)
         else:
-            return {'success': 1, 'response': result}
+            raise gen.Return({'success': 1, 'response': result})
 
     return wrapped
 
 
+def etag_from(get_etag):
+    """Декоратор обработчика, отдающего данные с известной версией
+
+    Etag ответа берется из get_etag(handler) до вызова обработчика. Если он совпадает
+    с заголовком If-None-Match запроса, то сразу отдается 304 без построения ответа.
+
+    :param get_etag: callable, принимает обработчик и возвращает etag (строка в кавычках)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapped(self, *args, **kwargs):
+            self.set_header('Etag', get_etag(self))
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+
+            return func(self, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
 def get_handler(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
@@ -42,6 +104,7 @@ def get_handler(func):
             raise HTTPError(404)
 
         return func(self, *args, **kwargs)
+    wrapped.http_method = 'GET'
     return wrapped
 
 
@@ -53,4 +116,10 @@ def post_handler(func):
 
         return func(self, *args, **kwargs)
 
+    wrapped.http_method = 'POST'
     return wrapped
+
+
+def handler_names(handler_class):
+    """Имена методов API обработчика (помеченных get_handler или post_handler)"""
+    return sorted(name for name in dir(handler_class) if getattr(getattr(handler_class, name), 'http_method', None))
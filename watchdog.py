@@ -0,0 +1,82 @@
+# coding: utf-8
+import heapq
+import time
+
+import tornado.ioloop
+
+
+class Watchdog(object):
+    """Срабатывание по дедлайнам для большого числа ключей (например, pid процессов из waiting)
+
+    Дедлайны хранятся в куче, а в ioloop запланирован один таймер -- на ближайший дедлайн.
+    Постановка и снятие ключа стоят O(log n), при срабатывании из кучи извлекаются только
+    истекшие записи, вся таблица не просматривается.
+
+    Снятие (discard) ленивое: запись остается в куче и пропускается, когда до нее дойдет очередь.
+    Если таких записей становится больше, чем живых, куча перестраивается.
+
+    Истекшие ключи передаются в on_expire списком, уже снятыми с наблюдения.
+    """
+    def __init__(self, on_expire, ioloop=None):
+        """
+        :param on_expire: callable, принимает список истекших ключей
+        """
+        self.on_expire = on_expire
+        self.ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._heap = []
+        self._deadlines = {}
+        self._timeout = None
+        self._scheduled_at = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def watch(self, key, deadline):
+        """Наблюдение за ключом до deadline (время в секундах, как time.time())"""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._scheduled_at is None or deadline < self._scheduled_at:
+            self._schedule()
+
+    def discard(self, key):
+        """Снятие ключа с наблюдения (если его нет, ничего не происходит)"""
+        if self._deadlines.pop(key, None) is None:
+            return
+
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, key_) for deadline, key_ in self._heap if self._is_live(deadline, key_)]
+            heapq.heapify(self._heap)
+
+    def stop(self):
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+        self._timeout = None
+        self._scheduled_at = None
+
+    def _is_live(self, deadline, key):
+        return self._deadlines.get(key) == deadline
+
+    def _schedule(self):
+        self.stop()
+        # снятые записи с вершины кучи убираются сразу, чтобы не просыпаться ради них
+        while self._heap and not self._is_live(*self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+
+        self._scheduled_at = self._heap[0][0]
+        self._timeout = self.ioloop.call_later(max(0.0, self._scheduled_at - time.time()), self._fire)
+
+    def _fire(self):
+        self._timeout = None
+        now = time.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            if self._is_live(deadline, key):
+                del self._deadlines[key]
+                expired.append(key)
+
+        self._schedule()
+        if expired:
+            self.on_expire(expired)
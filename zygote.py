@@ -0,0 +1,249 @@
+# coding: utf-8
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import traceback as tb
+
+import tornado.ioloop
+# noinspection PyUnresolvedReferences
+from _multiprocessing import sendfd, recvfd
+
+from forking import fork_task_with_channel
+from reaper import reap_children
+from utils import set_nonblocking
+
+
+class ZygoteError(Exception):
+    pass
+
+
+def _split_lines(buf):
+    """Разбиение буфера на готовые строки и недочитанный хвост"""
+    lines = buf.split('\n')
+    return lines[:-1], lines[-1]
+
+
+class Zygote(object):
+    """Fork-сервер для запуска задач
+
+    Небольшой вспомогательный процесс, который порождается демоном на старте, до открытия
+    серверных сокетов и до настройки логгеров. Демон передает ему по socketpair запрос на запуск
+    задачи, зигота делает fork и возвращает pid нового процесса. В итоге задачи не наследуют
+    слушающие сокеты, файловые хендлеры логгеров и накопленную демоном память, а сам fork стоит дешевле.
+
+    Модули задач импортирует сама зигота (task_catalog.TaskLoader): задачи из preload -- сразу
+    после старта, остальные -- при первом запуске, так что демон их не импортирует вовсе.
+    Измененные модули задач зигота перезагружает перед запуском.
+
+    Протокол -- json строки. Запрос: {"cmd": ..., "path": "module:callable", "args": [...], "kwargs": {...},
+    "resources": {...}}, ответ: {"pid": 123} либо {"error": "..."}. Читающие концы канала задачи (channel.ChildChannel)
+    и pipe ее вывода (output.TaskOutput) передаются демону через SCM_RIGHTS по отдельному socketpair
+    до отправки ответа.
+
+    Порожденные задачи являются детьми зиготы, поэтому их собирает она (waitpid по SIGCHLD)
+    и сообщает демону о завершении по второму socketpair строками
+    {"pid": 123, "returncode": 0, "signal": null}. Демон читает их в ioloop (см. attach).
+
+    Зигота завершается, когда демон закрывает свой конец socketpair.
+    """
+    def __init__(self, loader, preload=()):
+        """
+        :param loader: task_catalog.TaskLoader
+        :param preload: пути задач, модули которых импортируются при старте зиготы
+        """
+        self.loader = loader
+        self.preload = preload
+        self.pid = None
+        self._sock = None
+        self._rfile = None
+        self._fds_sock = None
+        self._events_sock = None
+        self._events_buf = ''
+        self._ioloop = None
+
+    def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        parent_fds_sock, child_fds_sock = socket.socketpair()
+        parent_events_sock, child_events_sock = socket.socketpair()
+
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            parent_fds_sock.close()
+            parent_events_sock.close()
+            self._serve(child_sock, child_fds_sock, child_events_sock)
+            os._exit(0)
+
+        child_sock.close()
+        child_fds_sock.close()
+        child_events_sock.close()
+        self.pid = pid
+        self._sock = parent_sock
+        self._rfile = parent_sock.makefile('rb')
+        self._fds_sock = parent_fds_sock
+        self._events_sock = parent_events_sock
+
+    def attach(self, on_exit, ioloop=None):
+        """Подписка на сообщения о завершении задач
+
+        :param on_exit: callable, принимает список (pid, код возврата, номер сигнала)
+        :param ioloop: tornado.ioloop.IOLoop
+        """
+        self._ioloop = ioloop or tornado.ioloop.IOLoop.current()
+        self._events_sock.setblocking(False)
+
+        # noinspection PyUnusedLocal
+        def handler(fd, events):
+            exits = self._read_exit_events()
+            if exits:
+                on_exit(exits)
+
+        self._ioloop.add_handler(self._events_sock.fileno(), handler, tornado.ioloop.IOLoop.READ)
+
+    def _read_exit_events(self):
+        while True:
+            try:
+                chunk = self._events_sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if not chunk:
+                self._ioloop.remove_handler(self._events_sock.fileno())
+                break
+            self._events_buf += chunk
+
+        lines, self._events_buf = _split_lines(self._events_buf)
+        events = [json.loads(line) for line in lines]
+        return [(event['pid'], event['returncode'], event['signal']) for event in events]
+
+    def stop(self):
+        if self._sock is None:
+            return
+
+        if self._ioloop is not None:
+            self._ioloop.remove_handler(self._events_sock.fileno())
+
+        self.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+    def close(self):
+        """Закрытие своих концов socketpair без ожидания зиготы
+
+        Нужно в процессах, порожденных демоном после старта зиготы (например, web процессах):
+        они не должны держать каналы зиготы открытыми.
+        """
+        if self._sock is None:
+            return
+
+        self._rfile.close()
+        self._sock.close()
+        self._fds_sock.close()
+        self._events_sock.close()
+        self._sock = self._rfile = self._fds_sock = self._events_sock = None
+
+    def spawn(self, cmd, path, args, kwargs, resources=None):
+        """Запуск задачи в зиготе
+
+        :param cmd: str
+        :param path: str, путь к задаче вида "module:callable" (см. task_catalog.TaskCatalog)
+        :param args: list
+        :param kwargs: dict
+        :param resources: dict, описание ресурсов задачи (см. forking.fork_task)
+        :return: (pid нового процесса, читающий конец его канала, читающий конец pipe его вывода)
+        """
+        request = json.dumps(
+            {'cmd': cmd, 'path': path, 'args': args, 'kwargs': kwargs, 'resources': resources},
+            separators=(',', ':'),
+        )
+        self._sock.sendall(request + '\n')
+
+        line = self._rfile.readline()
+        if not line:
+            raise ZygoteError('Zygote process %s has gone away' % self.pid)
+
+        response = json.loads(line)
+        if 'error' in response:
+            raise ZygoteError(response['error'])
+
+        channel_fd = recvfd(self._fds_sock.fileno())
+        return response['pid'], channel_fd, recvfd(self._fds_sock.fileno())
+
+    def _serve(self, sock, fds_sock, events_sock):
+        """Основной цикл зиготы: запросы на запуск задач и сбор завершившихся задач
+
+        SIGCHLD будит select через signal.set_wakeup_fd.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+
+        wakeup_r, wakeup_w = os.pipe()
+        set_nonblocking(wakeup_r)
+        set_nonblocking(wakeup_w)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda *args: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        # ошибки импорта здесь не фатальны: они повторятся и будут переданы демону при запуске задачи
+        self.loader.preload(self.preload)
+
+        buf = ''
+        while True:
+            try:
+                readable = select.select([sock, wakeup_r], [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if wakeup_r in readable:
+                try:
+                    os.read(wakeup_r, 4096)
+                except OSError:
+                    pass
+
+                events = [
+                    json.dumps({'pid': pid, 'returncode': returncode, 'signal': signum}) + '\n'
+                    for pid, returncode, signum in reap_children()
+                ]
+                try:
+                    events_sock.sendall(''.join(events))
+                except socket.error as e:
+                    if e.args[0] == errno.EPIPE:
+                        return  # демон уже закрыл свою сторону
+                    raise
+
+            if sock not in readable:
+                continue
+
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+
+            lines, buf = _split_lines(buf + chunk)
+            for line in lines:
+                # noinspection PyBroadException
+                try:
+                    request = json.loads(line)
+                    callable_ = self.loader.load(request['path'])
+                    pid, channel_fd, output_fd = fork_task_with_channel(
+                        callable_, request['args'], request['kwargs'], resources=request.get('resources'),
+                    )
+                    try:
+                        sendfd(fds_sock.fileno(), channel_fd)
+                        sendfd(fds_sock.fileno(), output_fd)
+                    finally:
+                        os.close(channel_fd)
+                        os.close(output_fd)
+                    response = {'pid': pid}
+                except Exception:
+                    response = {'error': tb.format_exc()}
+
+                sock.sendall(json.dumps(response) + '\n')